@@ -0,0 +1,427 @@
+"""
+THIS MODULE INCLUDES NAMED, PARAMETERISED ANALYTICAL QUERIES OVER THE STAR
+SCHEMA AND A LOCAL CACHE FOR THEIR RESULTS
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import logging
+import threading
+from time import monotonic
+from datetime import datetime
+from collections import OrderedDict
+import instrumentation
+import query_registry
+
+logger = logging.getLogger(__name__)
+
+# Named queries. 'tables' lists every table a query reads, so its cached result is
+# dropped when any of them is loaded again. A parameter defaulting to None is required.
+# 'rollup' gives the same query over a rollup table (see rollups.py), used instead
+# when the start and end parameters fall on the rollup's time grain
+QUERIES = {
+    'top_songs': {'sql': ("""
+SELECT  s.title
+        ,a.name
+        ,COUNT(*) AS plays
+FROM    songplay sp
+JOIN    songs    s ON sp.song_id = s.song_id
+JOIN    artists  a ON sp.artist_id = a.artist_id
+WHERE   sp.start_time >= %(start)s
+ AND    sp.start_time < %(end)s
+GROUP BY s.title, a.name
+ORDER BY plays DESC, s.title
+LIMIT   %(limit)s;
+""")
+                  ,'tables': ['songplay', 'songs', 'artists']
+                  ,'params': {'start': '1970-01-01', 'end': '9999-12-31', 'limit': 10}
+                  ,'rollup': {'sql': ("""
+SELECT  s.title
+        ,a.name
+        ,SUM(r.plays)::BIGINT AS plays
+FROM    song_plays_daily r
+JOIN    songs    s ON r.song_id = s.song_id
+JOIN    artists  a ON r.artist_id = a.artist_id
+WHERE   r.play_day >= %(start)s
+ AND    r.play_day < %(end)s
+GROUP BY s.title, a.name
+ORDER BY plays DESC, s.title
+LIMIT   %(limit)s;
+""")
+                              ,'tables': ['song_plays_daily', 'songs', 'artists']
+                              ,'grain': 'day'}}
+    ,'top_artists': {'sql': ("""
+SELECT  a.name
+        ,COUNT(*) AS plays
+        ,COUNT(DISTINCT sp.user_id) AS listeners
+FROM    songplay sp
+JOIN    artists  a ON sp.artist_id = a.artist_id
+WHERE   sp.start_time >= %(start)s
+ AND    sp.start_time < %(end)s
+GROUP BY a.name
+ORDER BY plays DESC, a.name
+LIMIT   %(limit)s;
+""")
+                     ,'tables': ['songplay', 'artists']
+                     ,'params': {'start': '1970-01-01', 'end': '9999-12-31', 'limit': 10}}
+    ,'plays_by_hour': {'sql': ("""
+SELECT  t.hour
+        ,COUNT(*) AS plays
+FROM    songplay sp
+JOIN    time     t ON sp.start_time = t.start_time
+WHERE   sp.start_time >= %(start)s
+ AND    sp.start_time < %(end)s
+GROUP BY t.hour
+ORDER BY t.hour;
+""")
+                       ,'tables': ['songplay', 'time']
+                       ,'params': {'start': '1970-01-01', 'end': '9999-12-31'}
+                       ,'rollup': {'sql': ("""
+SELECT  EXTRACT(HOUR FROM play_hour)::INT AS hour
+        ,SUM(plays)::BIGINT AS plays
+FROM    level_users_hourly
+WHERE   play_hour >= %(start)s
+ AND    play_hour < %(end)s
+GROUP BY 1
+ORDER BY 1;
+""")
+                                   ,'tables': ['level_users_hourly']
+                                   ,'grain': 'hour'}}
+    ,'plays_by_weekday': {'sql': ("""
+SELECT  t.weekday
+        ,COUNT(*) AS plays
+FROM    songplay sp
+JOIN    time     t ON sp.start_time = t.start_time
+WHERE   sp.start_time >= %(start)s
+ AND    sp.start_time < %(end)s
+GROUP BY t.weekday
+ORDER BY t.weekday;
+""")
+                          ,'tables': ['songplay', 'time']
+                          ,'params': {'start': '1970-01-01', 'end': '9999-12-31'}}
+    ,'plays_by_level': {'sql': ("""
+SELECT  sp.level
+        ,COUNT(*) AS plays
+        ,COUNT(DISTINCT sp.user_id) AS users
+FROM    songplay sp
+WHERE   sp.start_time >= %(start)s
+ AND    sp.start_time < %(end)s
+GROUP BY sp.level
+ORDER BY sp.level;
+""")
+                        ,'tables': ['songplay']
+                        ,'params': {'start': '1970-01-01', 'end': '9999-12-31'}}
+    ,'user_history': {'sql': ("""
+SELECT  sp.start_time
+        ,u.first_name
+        ,u.last_name
+        ,s.title
+        ,sp.location
+FROM    songplay sp
+JOIN    users    u ON sp.user_id = u.user_id
+JOIN    songs    s ON sp.song_id = s.song_id
+WHERE   sp.user_id = %(user_id)s
+ORDER BY sp.start_time DESC
+LIMIT   %(limit)s;
+""")
+                      ,'tables': ['songplay', 'users', 'songs']
+                      ,'params': {'user_id': None, 'limit': 20}}
+    ,'song_plays_per_day': {'sql': ("""
+SELECT  DATE_TRUNC('day', start_time) AS day
+        ,COUNT(*) AS plays
+FROM    songplay
+WHERE   song_id = %(song_id)s
+ AND    start_time >= %(start)s
+ AND    start_time < %(end)s
+GROUP BY 1
+ORDER BY 1;
+""")
+                            ,'tables': ['songplay']
+                            ,'params': {'song_id': None, 'start': '1970-01-01', 'end': '9999-12-31'}
+                            ,'rollup': {'sql': ("""
+SELECT  play_day AS day
+        ,plays
+FROM    song_plays_daily
+WHERE   song_id = %(song_id)s
+ AND    play_day >= %(start)s
+ AND    play_day < %(end)s
+ORDER BY 1;
+""")
+                                        ,'tables': ['song_plays_daily']
+                                        ,'grain': 'day'}}
+    ,'active_users_per_level_per_hour': {'sql': ("""
+SELECT  DATE_TRUNC('hour', start_time) AS hour
+        ,level
+        ,COUNT(*) AS plays
+        ,COUNT(DISTINCT user_id) AS active_users
+FROM    songplay
+WHERE   start_time >= %(start)s
+ AND    start_time < %(end)s
+GROUP BY 1, 2
+ORDER BY 1, 2;
+""")
+                                         ,'tables': ['songplay']
+                                         ,'params': {'start': '1970-01-01', 'end': '9999-12-31'}
+                                         ,'rollup': {'sql': ("""
+SELECT  play_hour AS hour
+        ,level
+        ,plays
+        ,active_users
+FROM    level_users_hourly
+WHERE   play_hour >= %(start)s
+ AND    play_hour < %(end)s
+ORDER BY 1, 2;
+""")
+                                                     ,'tables': ['level_users_hourly']
+                                                     ,'grain': 'hour'}}
+    ,'top_artists_per_week': {'sql': ("""
+SELECT  w.week
+        ,a.name
+        ,w.plays
+        ,w.listeners
+FROM    (SELECT DATE_TRUNC('week', start_time) AS week
+                ,artist_id
+                ,COUNT(*) AS plays
+                ,COUNT(DISTINCT user_id) AS listeners
+                ,ROW_NUMBER() OVER (PARTITION BY DATE_TRUNC('week', start_time)
+                                    ORDER BY COUNT(*) DESC, artist_id) AS week_rank
+         FROM   songplay
+         WHERE  start_time >= %(start)s
+          AND   start_time < %(end)s
+         GROUP BY 1, 2) w
+JOIN    artists a ON w.artist_id = a.artist_id
+WHERE   w.week_rank <= %(limit)s
+ORDER BY w.week, w.plays DESC, a.name;
+""")
+                              ,'tables': ['songplay', 'artists']
+                              ,'params': {'start': '1970-01-01', 'end': '9999-12-31', 'limit': 5}
+                              ,'rollup': {'sql': ("""
+SELECT  w.week
+        ,a.name
+        ,w.plays
+        ,w.listeners
+FROM    (SELECT play_week AS week
+                ,artist_id
+                ,plays
+                ,listeners
+                ,ROW_NUMBER() OVER (PARTITION BY play_week ORDER BY plays DESC, artist_id) AS week_rank
+         FROM   artist_plays_weekly
+         WHERE  play_week >= %(start)s
+          AND   play_week < %(end)s) w
+JOIN    artists a ON w.artist_id = a.artist_id
+WHERE   w.week_rank <= %(limit)s
+ORDER BY w.week, w.plays DESC, a.name;
+""")
+                                          ,'tables': ['artist_plays_weekly', 'artists']
+                                          ,'grain': 'week'}}
+}
+
+load_versions_query = ("""
+SELECT  table_name
+        ,MAX(loaded_at)
+FROM    load_versions
+WHERE   table_name IN %(tables)s
+GROUP BY table_name;
+""")
+
+class Query_cache:
+    """
+    LRU cache of query results. Entries expire ttl seconds after they are
+    stored, and the least recently used entry is evicted past max_entries.
+    The load versions results are keyed on are looked up at most once per
+    version_ttl seconds for the same tables
+    """
+    def __init__(self, max_entries=128, ttl=300, version_ttl=30, clock=monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached value of key, or None when missing or expired """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self.clock() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """ Stores value under key, evicting the least recently used entries """
+        with self.lock:
+            self.entries[key] = (self.clock(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def table_versions(self, cur, tables):
+        """ Gets the load version of each table, reusing a lookup made less
+        than version_ttl seconds ago for the same tables
+
+        Args:
+        cur (obj):[object cursor created from the connection]
+        tables (list):[table names]
+
+        Returns:
+        versions (tuple): [load version of each table, as returned by load_versions()]
+        """
+        key = tuple(tables)
+        with self.lock:
+            entry = self.versions.get(key)
+            if entry is not None and self.clock() - entry[0] <= self.version_ttl:
+                return entry[1]
+        versions = load_versions(cur, tables)
+        with self.lock:
+            self.versions[key] = (self.clock(), versions)
+        return versions
+
+    def forget_versions(self):
+        """ Drops the load versions looked up so far, e.g. right after a load """
+        with self.lock:
+            self.versions.clear()
+
+    def clear(self):
+        """ Drops every cached result and load version """
+        with self.lock:
+            self.entries.clear()
+            self.versions.clear()
+
+# Cache shared by every run in the process, created by get_cache()
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache(max_entries=128, ttl=300, version_ttl=30):
+    """ Gets the Query_cache of the process, creating it on first use. Later
+    calls return the same cache, so results outlive a single run
+
+    Args:
+    max_entries (int):[most results kept, used when the cache is created]
+    ttl (int):[seconds a result is kept, used when the cache is created]
+    version_ttl (int):[seconds a load version lookup is reused, used when the cache is created]
+
+    Returns:
+    cache (obj): [Query_cache]
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = Query_cache(max_entries, ttl, version_ttl)
+        return _cache
+
+def load_versions(cur, tables):
+    """ Gets the latest load version of each table, as written by the ETL
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    tables (list):[table names]
+
+    Returns:
+    versions (tuple): [load version of each table, in the order of tables.
+                       None for a table that was never loaded]
+    """
+    cur.execute(load_versions_query, {'tables': tuple(tables)})
+    versions = dict(cur.fetchall())
+    return tuple(str(versions.get(table)) for table in tables)
+
+def on_grain(value, grain):
+    """ Checks whether a timestamp falls on the start of a day, hour or week (Monday)
+
+    Args:
+    value (str):[timestamp, e.g. '2018-11-05' or '2018-11-05 13:00']
+    grain (str):[one of 'hour', 'day' or 'week']
+
+    Returns:
+    aligned (bool): [True when value starts a bucket of the grain]
+    """
+    value = value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+    if (value.minute, value.second, value.microsecond) != (0, 0, 0):
+        return False
+    if grain == 'hour':
+        return True
+    return value.hour == 0 and (grain == 'day' or value.weekday() == 0)
+
+def choose_source(name, params):
+    """ Picks the rollup of a named query when the requested range lines up
+    with the rollup's grain, otherwise the query over the base tables.
+    Bounds left at their defaults are open ended and always line up
+
+    Args:
+    name (str):[name of a query in QUERIES]
+    params (dict):[every parameter of the query, as returned by query_registry.bind_params()]
+
+    Returns:
+    source (dict): [entry holding the 'sql' to run and the 'tables' it reads]
+    """
+    query = QUERIES[name]
+    rollup = query.get('rollup')
+    if rollup is None:
+        return query
+    for bound in ('start', 'end'):
+        if params[bound] != query['params'][bound] and not on_grain(params[bound], rollup['grain']):
+            return query
+    return rollup
+
+def run_query(cur, name, cache=None, use_rollups=True, **params):
+    """ Runs a named query. With a cache, results are keyed on the query name,
+    its parameters and the load version of every table it reads, so a repeated
+    query is answered locally until the next load of one of those tables. When
+    the range lines up with a rollup's grain the rollup is read instead
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    name (str):[name of a query in QUERIES]
+    cache (obj):[Query_cache holding earlier results. Nothing is cached when None]
+    use_rollups (bool):[False to always read the base tables]
+    params (dict):[values for the query parameters, e.g. limit=5]
+
+    Returns:
+    columns (list): [column names of the result]
+    rows (list): [result rows]
+    """
+    try:
+        if name not in QUERIES:
+            raise KeyError(f"Unknown query {name}. Choose one of {', '.join(QUERIES)}")
+        params = query_registry.bind_params(name, params, QUERIES[name]['params'])
+        source = choose_source(name, params) if use_rollups else QUERIES[name]
+        key = None
+        if cache is not None:
+            versions = cache.table_versions(cur, source['tables'])
+            key = (name, tuple(sorted(params.items())), tuple(source['tables']), versions)
+            result = cache.get(key)
+            if result is not None:
+                logger.info(f"####### {name}: served from cache #######")
+                return result
+        if source is not QUERIES[name]:
+            logger.info(f"####### {name}: answered from {source['tables'][0]} #######")
+        instrumentation.execute(cur, source['sql'], label=f"ANALYTICS {name}", params=params)
+        result = ([column[0] for column in cur.description], cur.fetchall())
+        if key is not None:
+            cache.put(key, result)
+        return result
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def log_sample_queries(cur, cache=None):
+    """ Runs every named query that needs no parameters and logs its results
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    cache (obj):[Query_cache holding earlier results]
+    """
+    for name, query in QUERIES.items():
+        if None in query['params'].values():
+            continue
+        columns, rows = run_query(cur, name, cache)
+        logger.info(f"####### {name} #######")
+        logger.info(f"####### {' | '.join(columns)} #######")
+        for row in rows:
+            logger.info(f"####### {' | '.join(str(value) for value in row)} #######")
@@ -4,18 +4,19 @@ THIS MODULE INCLUDES FUNCTIONS THAT ASSIST IN CREATING REDSHIFT CLUSTER
 Author: Lucas Aledi
 Date: December 2022
 """
+import os
 import logging
 import json
 import boto3
+from time import monotonic
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
 from botocore.exceptions import ClientError
-from config_loader import *
-from sql_queries import data_validation_queries
+from sql_queries import table_counts_test, data_validation_checks
+import instrumentation
 
 logger = logging.getLogger(__name__)
 
-# loads config
-db_config = DatabaseConfig.get_config('config/dwh.cfg')
-
 class IAM_role:
     def create_client(key,secret,region):
         """ Creates IAM client for User whose credentials are in the 
@@ -108,6 +109,22 @@ class IAM_role:
             logger.exception(err)
             raise(err)
 
+    def delete_role(iam,iam_role_name):
+        """ Detaches the policy attached by attach_policy() and deletes the role
+        
+        Args:
+        iam (obj): [IAM client]
+        iam_role_name (str): [string representing role name]
+        """
+        try:
+            iam.detach_role_policy(RoleName=iam_role_name, PolicyArn='arn:aws:iam::aws:policy/AdministratorAccess')
+            logger.info("####### Detached Role Policy #######")
+            iam.delete_role(RoleName=iam_role_name)
+            logger.info("####### Deleted Role #######")
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
 class Redshift_cluster:    
     def create_client(key,secret,region):
         """ Creates Redshift client for User whose credentials are in the 
@@ -173,6 +190,123 @@ class Redshift_cluster:
             logger.exception(err)
             raise(err)
 
+    def describe_cluster(redshift,cluster_identifier):
+        """ Gets the properties of a cluster, if it exists
+        
+        Args:
+        redshift (obj):[Object representing Redshift Client]
+        cluster_identifier (str): [string representing the cluster identifier]
+        
+        Returns:
+        cluster_props (dict): [properties of the cluster, or None if it doesn't exist]
+        """
+        try:
+            return redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
+        except redshift.exceptions.ClusterNotFoundFault:
+            return None
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
+    def resume_cluster(redshift,cluster_identifier):
+        """ Resumes a paused cluster
+        
+        Args:
+        redshift (obj):[Object representing Redshift Client]
+        cluster_identifier (str): [string representing the cluster identifier]
+        """
+        try:
+            logger.info("####### Resuming Redshift Cluster #######")
+            redshift.resume_cluster(ClusterIdentifier=cluster_identifier)
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
+    def pause_cluster(redshift,cluster_identifier):
+        """ Pauses a cluster, keeping its data while compute isn't billed
+        
+        Args:
+        redshift (obj):[Object representing Redshift Client]
+        cluster_identifier (str): [string representing the cluster identifier]
+        """
+        try:
+            logger.info("####### Pausing Redshift Cluster #######")
+            redshift.pause_cluster(ClusterIdentifier=cluster_identifier)
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
+    def latest_snapshot(redshift,cluster_identifier):
+        """ Gets the most recent available snapshot of a cluster
+        
+        Args:
+        redshift (obj):[Object representing Redshift Client]
+        cluster_identifier (str): [string representing the cluster identifier]
+        
+        Returns:
+        snapshot_identifier (str): [string representing the snapshot, or None if there is none]
+        """
+        try:
+            paginator = redshift.get_paginator('describe_cluster_snapshots')
+            snapshots = [snapshot
+                         for page in paginator.paginate(ClusterIdentifier=cluster_identifier)
+                         for snapshot in page['Snapshots']
+                         if snapshot['Status'].lower() == 'available']
+            if not snapshots:
+                return None
+            return max(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'])['SnapshotIdentifier']
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
+    def restore_cluster(redshift,db_config,snapshot_identifier):
+        """ Restores the cluster from a snapshot, with the same hardware,
+        role and network settings as create_cluster()
+        
+        Args:
+        redshift (obj):[Object representing Redshift Client]
+        db_config (dict): [dictionary containing database configuration]
+        snapshot_identifier (str): [string representing the snapshot to restore]
+        """
+        try:
+            logger.info(f"####### Restoring Redshift Cluster from {snapshot_identifier} #######")
+            return redshift.restore_from_cluster_snapshot(
+                ClusterIdentifier = db_config['cluster_identifier']
+                ,SnapshotIdentifier = snapshot_identifier
+                ,NodeType = db_config['node_type']
+                ,NumberOfNodes = int(db_config['n_nodes'])
+                ,IamRoles = [db_config['iam_role_arn']]
+                ,PubliclyAccessible = True
+                ,VpcSecurityGroupIds = ['sg-065720dffeacbb1d2' # redshift_security_group
+                                        ]
+            )
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
+    def delete_cluster(redshift,cluster_identifier,final_snapshot=False):
+        """ Deletes a cluster, optionally taking a final snapshot to restore from later
+        
+        Args:
+        redshift (obj):[Object representing Redshift Client]
+        cluster_identifier (str): [string representing the cluster identifier]
+        final_snapshot (bool): [take a final snapshot before deleting]
+        """
+        try:
+            if final_snapshot:
+                snapshot_identifier = f"{cluster_identifier.lower()}-final-{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+                logger.info(f"####### Deleting Redshift Cluster. Final snapshot {snapshot_identifier} #######")
+                redshift.delete_cluster(ClusterIdentifier=cluster_identifier
+                                        ,SkipFinalClusterSnapshot=False
+                                        ,FinalClusterSnapshotIdentifier=snapshot_identifier)
+            else:
+                logger.info("####### Deleting Redshift Cluster #######")
+                redshift.delete_cluster(ClusterIdentifier=cluster_identifier
+                                        ,SkipFinalClusterSnapshot=True)
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
 class Connect_cluster:
     def create_ec2_client(key,secret,region):
         """ Creates EC2 client for User whose credentials are in the 
@@ -198,7 +332,29 @@ class Connect_cluster:
             logger.exception(err)
             raise(err)
     
-    def attach_security_group(ec2,cluster_props,db_config):
+    def get_security_group(ec2,vpc_id=None):
+        """ Looks up the security group used to open the cluster port, so it
+        can be prepared while the cluster is still being created
+    
+        Args:
+        ec2 (obj): [Boto3 ec2 object]
+        vpc_id (str): [string representing the VPC of the cluster. Defaults to the default VPC]
+        
+        Returns:
+        security_group (obj): [Boto3 ec2 SecurityGroup object]
+        """
+        try:
+            logger.info("####### Looking up Security Group #######")
+            if vpc_id is None:
+                vpc = list(ec2.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]))[0]
+            else:
+                vpc = ec2.Vpc(id=vpc_id)
+            return list(vpc.security_groups.all())[-1]
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
+    def attach_security_group(ec2,cluster_props,db_config,security_group=None):
         """ Attaches the security group to open an incoming TCP port to 
         access the cluster endpoint
     
@@ -206,11 +362,11 @@ class Connect_cluster:
         ec2 (obj): [Boto3 ec2 object]
         cluster_props (dict): [Dictionary object of the defined properties]
         db_config (Configurations): [Class containing database configuration]
+        security_group (obj): [Security group found by get_security_group(), if already known]
         """
         try:
             logger.info("####### Attaching Security Group. Opens an incoming TCP port to access the cluster endpoint. #######")
-            vpc = ec2.Vpc(id=cluster_props['VpcId'])
-            defaultSg = list(vpc.security_groups.all())[-1]
+            defaultSg = security_group or Connect_cluster.get_security_group(ec2,cluster_props['VpcId'])
             #defaultSg = ec2.SecurityGroup(id='sg-00dfe631c59aaea17') # redshift_sg
             defaultSg.authorize_ingress(
                     #GroupName=defaultSg.group_name
@@ -228,20 +384,173 @@ class Connect_cluster:
             logger.exception(err)
             raise(err)
 
+class S3_sources:
+    def create_client(key,secret,region):
+        """ Creates S3 client for User whose credentials are in the 
+        config file
+        
+        Args:
+        key (str):[string representing AWS access key ID]
+        secret (str):[string representing AWS Secret Access key]
+        region (str): [string representing region of the source bucket]
+        
+        Returns:
+        s3 (obj): [object representing S3 client]
+        """
+        try:
+            logger.info("####### Creating S3 Client #######")
+            s3 = boto3.client('s3',
+                           region_name=region,
+                           aws_access_key_id=key,
+                           aws_secret_access_key=secret
+                           )
+            return s3
+        except Exception as err:
+            logger.exception(err)
+            raise(err)
+
 class Data_validation:
-    def testing_queries(cur, conn):
-        """ Tests the validity of the data loading and inserting into tables 
-    
+    def table_counts(cur):
+        """ Counts the rows of every table in a single query
+
         Args:
-        ec2 (obj): [Boto3 ec2 object]
-        cluster_props (dict): [Dictionary object of the defined properties]
-        db_config (Configurations): [Class containing database configuration]
+        cur (obj):[object cursor created from the connection]
+
+        Returns:
+        counts (dict): [table name mapped to its number of rows]
+        """
+        instrumentation.execute(cur, table_counts_test, label='VALIDATION table_counts')
+        return {table: rows for table, rows in cur.fetchall()}
+
+    def run_check(cur, check, max_null_rate):
+        """ Runs one reconciliation check and grades its values
+
+        Args:
+        cur (obj):[object cursor created from the connection]
+        check (tuple):[(check name, query, kind) from data_validation_checks]
+        max_null_rate (float):[highest share of NULLs a 'null_rate' check accepts]
+
+        Returns:
+        result (dict): [check name, status ('pass', 'fail' or 'error'), values and seconds]
+        """
+        name, query, kind = check
+        start = monotonic()
+        try:
+            instrumentation.execute(cur, query, label=f"VALIDATION {name}")
+            row = cur.fetchone()
+            values = {column[0]: float(value or 0) for column, value in zip(cur.description, row)}
+            threshold = 0 if kind == 'zero' else max_null_rate
+            status = 'pass' if all(value <= threshold for value in values.values()) else 'fail'
+            return {'check': name, 'status': status, 'values': values
+                    ,'threshold': threshold, 'seconds': monotonic() - start}
+        except Exception as err:
+            return {'check': name, 'status': 'error', 'error': str(err).strip()
+                    ,'seconds': monotonic() - start}
+
+    def _pooled_check(pool, check, max_null_rate, in_flight, deadline):
+        """ Runs a check on its own pooled connection, recorded in in_flight
+        so it can be cancelled when the time budget runs out. A connection
+        that only comes free after the deadline is handed back unused """
+        conn = pool.getconn()
+        in_flight[check[0]] = conn
+        try:
+            # Checked after registering, so a check is either cancelled or skipped
+            if monotonic() > deadline:
+                return {'check': check[0], 'status': 'timeout'}
+            with conn.cursor() as cur:
+                result = Data_validation.run_check(cur, check, max_null_rate)
+            conn.rollback()
+            return result
+        finally:
+            in_flight.pop(check[0], None)
+            pool.putconn(conn)
+
+    def testing_queries(cur, conn, pool=None, time_budget=120, max_null_rate=0.05):
+        """ Tests the validity of the data loading and inserting into tables.
+        Row counts come from a single query; reconciliation checks (staged
+        songplays that didn't load, orphan keys, duplicate dimension keys and
+        NULL rates) run concurrently on pooled connections when a pool is given.
+        Checks still running when time_budget is spent are cancelled and
+        reported as 'timeout'
+
+        Args:
+        cur (obj):[object cursor created from the connection]
+        conn (obj):[object connection created from psycopg2 to database]
+        pool (obj):[object connection pool created from psycopg2.pool. Checks run one by one when None]
+        time_budget (float):[seconds the checks may take in total]
+        max_null_rate (float):[highest share of NULLs accepted in checked columns]
+
+        Returns:
+        report (dict): [overall pass/fail, row counts and the result of every check]
         """
         try:
             logger.info("####### Data Validation Test #######")
-            for query in data_validation_queries:
-                result = cur.execute(query)
-                logger.info(f"####### {result} #######")
+            counts = Data_validation.table_counts(cur)
+            conn.commit()
+            empty = [table for table in ('songplay', 'users', 'songs', 'artists', 'time') if not counts.get(table)]
+            results = [{'check': 'table_counts', 'status': 'fail' if empty else 'pass'
+                        ,'values': {f"empty_{table}": 1.0 for table in empty}, 'threshold': 0}]
+
+            deadline = monotonic() + time_budget
+            if pool is None:
+                for check in data_validation_checks:
+                    if monotonic() > deadline:
+                        results.append({'check': check[0], 'status': 'timeout'})
+                        continue
+                    results.append(Data_validation.run_check(cur, check, max_null_rate))
+                    conn.rollback()
+            else:
+                in_flight = {}
+                # conn is one of the pool's connections, so one less is free for the checks
+                executor = ThreadPoolExecutor(max_workers=max(min(len(data_validation_checks), pool.maxconn - 1), 1))
+                futures = {executor.submit(Data_validation._pooled_check, pool, check, max_null_rate
+                                           ,in_flight, deadline): check[0]
+                           for check in data_validation_checks}
+                done, not_done = wait(futures, timeout=max(deadline - monotonic(), 0))
+                for future in not_done:
+                    future.cancel()
+                for check_conn in list(in_flight.values()):
+                    check_conn.cancel()
+                executor.shutdown(wait=True, cancel_futures=True)
+                for future, name in futures.items():
+                    if future in done:
+                        results.append(future.result())
+                    else:
+                        results.append({'check': name, 'status': 'timeout'})
+
+            report = {'passed': all(result['status'] == 'pass' for result in results)
+                      ,'counts': counts
+                      ,'checks': results}
+            Data_validation.log_report(report)
+            return report
         except Exception as err:
             logger.exception(err)
-            raise(err)
\ No newline at end of file
+            raise(err)
+
+    def log_report(report):
+        """ Logs row counts and a pass/fail line per check """
+        for table, rows in report['counts'].items():
+            logger.info(f"####### {table:<16} {rows:>12} rows #######")
+        for result in report['checks']:
+            failing = {name: value for name, value in result.get('values', {}).items()
+                       if value > result.get('threshold', 0)}
+            detail = result.get('error') or ', '.join(f"{name}={value:g}" for name, value in failing.items())
+            logger.info(f"####### {result['status'].upper():<7} {result['check']:<24} {detail} #######")
+        logger.info(f"####### Data validation {'PASSED' if report['passed'] else 'FAILED'} #######")
+
+    def write_report(report, report_dir):
+        """ Writes a validation report to a JSON file named after the run time
+
+        Args:
+        report (dict):[report returned by testing_queries()]
+        report_dir (str):[string representing path to write the report to]
+
+        Returns:
+        path (str): [string representing path of the report file]
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, f"validation-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json")
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"####### Validation report written to {path} #######")
+        return path
@@ -0,0 +1,231 @@
+"""
+THIS MODULE INCLUDES CONNECTIONS TO LOCAL POSTGRES AND DUCKDB ENGINES THAT
+TRANSLATE THE REDSHIFT STATEMENTS, SO THE PIPELINE RUNS WITHOUT A CLUSTER
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import io
+import os
+import re
+import csv
+import json
+import logging
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import ledger
+import instrumentation
+from local_engine import read_batches, LOG_FIELDS, STAGING_EVENTS_SCHEMA, STAGING_SONGS_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['postgres', 'duckdb']
+
+# Redshift-only syntax mapped to its Postgres equivalent ('' drops it)
+POSTGRES_REWRITES = [(r'IDENTITY\s*\(\s*0\s*,\s*1\s*\)', 'GENERATED BY DEFAULT AS IDENTITY (MINVALUE 0 START WITH 0)')
+                     ,(r'(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', '')
+                     ,(r'DISTKEY\s*\([^)]*\)', '')
+                     ,(r'\b(SORTKEY|DISTKEY)\b', '')
+                     ,(r'\bdiststyle\s+\w+', '')
+                     ,(r'\bENCODE\s+\w+', '')
+                     ,(r'\bGETDATE\(\)', 'NOW()')]
+
+# Same for DuckDB. IDENTITY columns draw from a sequence created on connect, and
+# primary keys are dropped as Redshift doesn't enforce them either
+DUCKDB_REWRITES = [(r'IDENTITY\s*\(\s*0\s*,\s*1\s*\)', "DEFAULT nextval('identity_seq')")
+                   ,(r'\bPRIMARY\s+KEY\b', '')
+                   ,(r'(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', '')
+                   ,(r'DISTKEY\s*\([^)]*\)', '')
+                   ,(r'\b(SORTKEY|DISTKEY)\b', '')
+                   ,(r'\bdiststyle\s+\w+', '')
+                   ,(r'\bENCODE\s+\w+', '')
+                   ,(r'\bGETDATE\(\)', 'CAST(NOW() AS TIMESTAMP)')
+                   # psycopg2 parameters as DuckDB ones. Tuples are passed as lists
+                   ,(r'\bIN\s+%\((\w+)\)s', r'IN (SELECT UNNEST($\1))')
+                   ,(r'%\((\w+)\)s', r'$\1')]
+
+REWRITES = {'postgres': POSTGRES_REWRITES, 'duckdb': DUCKDB_REWRITES}
+
+# Local directory each raw staging table is copied from, under the data directory
+SOURCE_DIRS = {'staging_events_raw': ('log_data', STAGING_EVENTS_SCHEMA, LOG_FIELDS)
+               ,'staging_songs_raw': ('song_data', STAGING_SONGS_SCHEMA, None)}
+
+_copy_statement = re.compile(r'^\s*COPY\s+(\w+)\b', re.IGNORECASE)
+_copy_source = re.compile(r"\bFROM\s+'([^']+)'", re.IGNORECASE)
+
+def translate(query, backend):
+    """ Rewrites a Redshift statement so it runs on a local engine
+
+    Args:
+    query (str):[string representing the Redshift SQL statement]
+    backend (str):[local engine, one of BACKENDS]
+
+    Returns:
+    query (str): [string representing the statement for the local engine]
+    """
+    for pattern, replacement in REWRITES[backend]:
+        query = re.sub(pattern, replacement, query, flags=re.IGNORECASE)
+    return query
+
+def _local_batches(table, directory, batch_size=50000):
+    """ Reads the source files of a staging table under directory as typed batches,
+    applying the same rules as its COPY statement (epoch milliseconds, blanks as NULL) """
+    _, schema, fields = SOURCE_DIRS[table]
+    for batch in read_batches(directory, schema, fields, batch_size):
+        if 'ts' in batch.column_names:
+            i = batch.column_names.index('ts')
+            batch = batch.set_column(i, 'ts', pc.cast(batch['ts'], pa.timestamp('ms')))
+        yield batch
+
+def _download_manifest(s3, url, directory):
+    """ Downloads every object listed by a COPY manifest into directory as
+    .json files, in manifest order """
+    bucket, key = ledger.parse_s3_url(url)
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    for i, entry in enumerate(manifest['entries']):
+        bucket, key = ledger.parse_s3_url(entry['url'])
+        s3.download_file(bucket, key, os.path.join(directory, f"{i:06d}.json"))
+
+class Local_cursor:
+    """
+    Cursor wrapper that translates every statement for the local engine, so
+    the functions in create_tables.py, etl.py and aws_functions.py run
+    unchanged. A COPY into a staging table loads its files from the local
+    data directory instead of S3, or, for a manifest COPY, from the objects
+    its manifest lists
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.cur = connection.conn if connection.backend == 'duckdb' else connection.conn.cursor()
+
+    def execute(self, query, params=None):
+        copy = _copy_statement.match(query)
+        if copy:
+            self.connection.copy_local(copy.group(1).lower(), query)
+            return
+        query = translate(query, self.connection.backend)
+        if self.connection.backend == 'duckdb':
+            self.connection.begin()
+            if params:
+                params = {name: list(value) if isinstance(value, tuple) else value for name, value in params.items()}
+            return self.cur.execute(query, params) if params else self.cur.execute(query)
+        return self.cur.execute(query, params)
+
+    def close(self):
+        # The DuckDB cursor is the connection itself, closed with it
+        if self.connection.backend != 'duckdb':
+            self.cur.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+class Local_connection:
+    """
+    Connection to a local Postgres or DuckDB engine with the psycopg2
+    interface the pipeline uses: cursor(), commit(), rollback() and close().
+    Statements on DuckDB run in a transaction opened on first use, as
+    psycopg2 does. Connecting switches instrumentation.py out of Redshift
+    mode, as local engines have no query IDs or system tables
+    """
+    def __init__(self, backend, dsn=None, data_dir=None, s3=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}. Choose one of {', '.join(BACKENDS)}")
+        instrumentation.configure(redshift=False)
+        self.backend = backend
+        self.data_dir = data_dir
+        self.s3 = s3
+        self.in_transaction = False
+        if backend == 'duckdb':
+            try:
+                import duckdb
+            except ImportError:
+                raise ImportError("The duckdb backend needs the duckdb package (pip install duckdb)")
+            self.conn = duckdb.connect(dsn or ':memory:')
+            self.conn.execute("CREATE SEQUENCE IF NOT EXISTS identity_seq MINVALUE 0 START 0;")
+        else:
+            import psycopg2
+            self.conn = psycopg2.connect(dsn)
+
+    def begin(self):
+        if self.backend == 'duckdb' and not self.in_transaction:
+            self.conn.execute("BEGIN TRANSACTION;")
+            self.in_transaction = True
+
+    def commit(self):
+        if self.backend != 'duckdb':
+            return self.conn.commit()
+        if self.in_transaction:
+            self.conn.execute("COMMIT;")
+            self.in_transaction = False
+
+    def rollback(self):
+        if self.backend != 'duckdb':
+            return self.conn.rollback()
+        if self.in_transaction:
+            self.conn.execute("ROLLBACK;")
+            self.in_transaction = False
+
+    def cursor(self):
+        return Local_cursor(self)
+
+    def close(self):
+        self.conn.close()
+
+    def copy_local(self, table, query):
+        """ Loads a staging table from the data directory, standing in for its COPY.
+        A manifest COPY loads the objects its manifest lists, read with the S3 client
+
+        Args:
+        table (str):[staging table the COPY loads]
+        query (str):[string representing the COPY statement]
+        """
+        if table not in SOURCE_DIRS or re.search(r'\b(GZIP|PARQUET)\b', query, re.IGNORECASE):
+            raise ValueError(f"Only uncompressed JSON COPYs into {', '.join(SOURCE_DIRS)} run locally")
+        if re.search(r'\bMANIFEST\b', query, re.IGNORECASE):
+            if self.s3 is None:
+                raise ValueError("A manifest COPY needs an S3 client. Pass s3 to connect()")
+            with tempfile.TemporaryDirectory() as directory:
+                _download_manifest(self.s3, _copy_source.search(query).group(1), directory)
+                self._insert_batches(table, _local_batches(table, directory))
+            return
+        if self.data_dir is None:
+            raise ValueError("COPY needs a local data directory. Pass data_dir to connect()")
+        self._insert_batches(table, _local_batches(table, os.path.join(self.data_dir, SOURCE_DIRS[table][0])))
+
+    def _insert_batches(self, table, batches):
+        """ Appends typed batches to a table """
+        for batch in batches:
+            columns = ','.join(batch.column_names)
+            if self.backend == 'duckdb':
+                self.begin()
+                self.conn.register('copy_batch', batch)
+                self.conn.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM copy_batch;")
+                self.conn.unregister('copy_batch')
+            else:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(row.values() for row in batch.to_pylist())
+                buffer.seek(0)
+                with self.conn.cursor() as cur:
+                    cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def connect(backend, dsn=None, data_dir=None, s3=None):
+    """ Connects to a local engine
+
+    Args:
+    backend (str):[local engine, one of BACKENDS]
+    dsn (str):[Postgres connection string, or DuckDB database file (in memory when None)]
+    data_dir (str):[string representing path holding log_data and song_data, read by COPY]
+    s3 (obj):[Boto3 S3 client, read by manifest COPYs, e.g. from etl.load_staging_tables_from_ledger()]
+
+    Returns:
+    conn (obj): [Local_connection]
+    """
+    logger.info(f"####### Connecting to local {backend} #######")
+    return Local_connection(backend, dsn, data_dir, s3)
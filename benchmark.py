@@ -0,0 +1,135 @@
+"""
+THIS MODULE INCLUDES A HARNESS THAT TIMES EACH STAGE OF THE ETL PROCESS
+AGAINST A LOCAL POSTGRES OR DUCKDB DATABASE AND WRITES THE RESULTS AS JSON
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import json
+import logging
+import argparse
+import statistics
+import subprocess
+from time import perf_counter
+from datetime import datetime, timezone
+import backends
+import create_tables
+import etl
+import instrumentation
+import rollups
+from aws_functions import Data_validation
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['drop_tables', 'create_tables', 'load_staging_tables', 'insert_tables', 'refresh_rollups', 'validation']
+ANALYTICS_TABLES = ['songplay', 'users', 'songs', 'artists', 'time']
+
+def source_volume(data_dir):
+    """ Counts the files and bytes under log_data and song_data, so results
+    can calibrate cluster_planner.py """
+    objects, size = 0, 0
+    for folder in ['log_data', 'song_data']:
+        for root, _, files in os.walk(os.path.join(data_dir, folder)):
+            objects += len(files)
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return objects, size
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except Exception:
+        return 'unknown'
+
+def run_once(dsn, data_dir, backend='postgres'):
+    """ Runs every stage once and times it. Every statement of the run
+    is also recorded by instrumentation.py. Staging tables are loaded by
+    etl.load_staging_tables(), its COPYs reading data_dir
+
+    Args:
+    dsn (str):[Postgres connection string, or DuckDB database file (in memory when None)]
+    data_dir (str):[string representing path holding log_data and song_data]
+    backend (str):[local engine, one of backends.BACKENDS]
+
+    Returns:
+    timings (dict): [seconds taken by each stage]
+    counts (dict): [number of rows in each analytics table]
+    """
+    instrumentation.reset()
+    conn = backends.connect(backend, dsn, data_dir)
+    cur = conn.cursor()
+    try:
+        stages = {'drop_tables': lambda: create_tables.drop_tables(cur, conn)
+                  ,'create_tables': lambda: create_tables.create_tables(cur, conn)
+                  ,'load_staging_tables': lambda: etl.load_staging_tables(cur, conn)
+                  ,'insert_tables': lambda: etl.insert_tables(cur, conn)
+                  ,'refresh_rollups': lambda: rollups.refresh_rollups(cur, conn)
+                  ,'validation': lambda: Data_validation.testing_queries(cur, conn)}
+        timings = {}
+        for stage in STAGES:
+            start = perf_counter()
+            stages[stage]()
+            timings[stage] = perf_counter() - start
+            logger.info(f"####### {stage}: {timings[stage]:.3f}s #######")
+        counts = {}
+        for table in ANALYTICS_TABLES:
+            cur.execute(f"SELECT COUNT(*) FROM {table};")
+            counts[table] = cur.fetchone()[0]
+        return timings, counts
+    finally:
+        cur.close()
+        conn.close()
+
+def run_benchmark(dsn, data_dir, results_dir='bench_results', repeat=3, backend='postgres'):
+    """ Times every stage repeat times and writes the results, tagged with
+    the current git commit, to a JSON file that can be compared across commits
+
+    Args:
+    dsn (str):[Postgres connection string, or DuckDB database file (in memory when None)]
+    data_dir (str):[string representing path holding log_data and song_data]
+    results_dir (str):[string representing path to write the results file to]
+    repeat (int):[number of runs. The median of each stage is reported]
+    backend (str):[local engine, one of backends.BACKENDS]
+
+    Returns:
+    path (str): [string representing path of the results file]
+    """
+    runs, counts = [], {}
+    for i in range(repeat):
+        logger.info(f"####### Benchmark run {i + 1} of {repeat} #######")
+        timings, counts = run_once(dsn, data_dir, backend)
+        runs.append(timings)
+    commit = _git_commit()
+    source_objects, source_bytes = source_volume(data_dir)
+    result = {'commit': commit
+              ,'run_at': datetime.now(timezone.utc).isoformat()
+              ,'backend': backend
+              ,'data_dir': os.path.abspath(data_dir)
+              ,'repeat': repeat
+              ,'source_objects': source_objects
+              ,'source_bytes': source_bytes
+              ,'median_seconds': {stage: statistics.median(run[stage] for run in runs) for stage in STAGES}
+              ,'runs': runs
+              ,'row_counts': counts
+              ,'statements': instrumentation.records()}
+    result['median_seconds']['total'] = sum(result['median_seconds'].values())
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{commit[:7]}-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    logger.info(f"####### Results written to {path} #######")
+    return path
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Times each ETL stage against a local Postgres or DuckDB")
+    parser.add_argument('data_dir', help="directory created by data_generator.py")
+    parser.add_argument('--backend', choices=backends.BACKENDS, default='postgres')
+    parser.add_argument('--dsn', help="Postgres connection string, or DuckDB database file. "
+                                      "Defaults to a local sparkify_db, or an in-memory DuckDB")
+    parser.add_argument('--results-dir', default='bench_results')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if args.dsn is None and args.backend == 'postgres':
+        args.dsn = "host=localhost dbname=sparkify_db user=postgres"
+    run_benchmark(args.dsn, args.data_dir, args.results_dir, args.repeat, args.backend)
@@ -0,0 +1,214 @@
+"""
+THIS MODULE INCLUDES A PLANNER THAT SIZES THE REDSHIFT CLUSTER FROM THE
+VOLUME OF THE S3 SOURCES AND THE THROUGHPUT MEASURED BY BENCHMARKS
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import json
+import logging
+import argparse
+import ledger
+
+logger = logging.getLogger(__name__)
+
+# Slices per node, storage per node and node count limits of each node type,
+# with on-demand hourly prices (us-east-1)
+NODE_TYPES = {'dc2.large': {'slices': 2, 'storage_gb': 160, 'min_nodes': 1, 'max_nodes': 32, 'hourly_cost': 0.25}
+              ,'dc2.8xlarge': {'slices': 16, 'storage_gb': 2560, 'min_nodes': 2, 'max_nodes': 128, 'hourly_cost': 4.80}
+              ,'ra3.xlplus': {'slices': 2, 'storage_gb': 32768, 'min_nodes': 1, 'max_nodes': 32, 'hourly_cost': 1.086}
+              ,'ra3.4xlarge': {'slices': 4, 'storage_gb': 131072, 'min_nodes': 2, 'max_nodes': 32, 'hourly_cost': 3.26}
+              ,'ra3.16xlarge': {'slices': 16, 'storage_gb': 131072, 'min_nodes': 2, 'max_nodes': 128, 'hourly_cost': 13.04}}
+
+# Throughput of a single slice, used until a benchmark is given. COPY costs a
+# fixed overhead per object on top of its bytes, which dominates small files
+DEFAULT_THROUGHPUT = {'copy_bytes_per_second': 4 * 2**20
+                      ,'insert_bytes_per_second': 16 * 2**20
+                      ,'seconds_per_object': 0.05}
+
+# Staging plus analytics tables, as a multiple of the raw JSON size
+STORAGE_FACTOR = 2
+
+def source_volume(s3, db_config, loaded=None):
+    """ Lists the S3 source prefixes and sums their objects and bytes
+
+    Args:
+    s3 (obj):[Boto3 S3 client for the source bucket]
+    db_config (dict):[dictionary containing database configuration]
+    loaded (dict):[ledger of objects already loaded, as returned by ledger.read_ledger().
+                   Those objects are left out of ledger.INCREMENTAL_TABLES, as a ledger-based load skips them]
+
+    Returns:
+    volume (dict): [staging table mapped to the number of objects and bytes to load]
+    """
+    volume = {}
+    for table, url in [('staging_events', db_config['s3_log_data'])
+                       ,('staging_songs', db_config['s3_song_data'])]:
+        objects = ledger.list_objects(s3, url)
+        if loaded and table in ledger.INCREMENTAL_TABLES:
+            objects = ledger.new_objects(objects, loaded.get(table, {}))
+        volume[table] = {'objects': len(objects)
+                         ,'bytes': sum(obj['size'] for obj in objects.values())}
+        logger.info(f"####### {table}: {volume[table]['objects']} objects, "
+                    f"{volume[table]['bytes'] / 2**20:.1f} MiB under {url} #######")
+    return volume
+
+def calibrate(path):
+    """ Works out the throughput of a single slice from a benchmark.py results
+    file. Results from a Redshift cluster can give its slice count under
+    'slices'. Local Postgres runs count as a single slice
+
+    Args:
+    path (str):[string representing path to the benchmark results file]
+
+    Returns:
+    throughput (dict): [bytes per second per slice for COPY and INSERT, and seconds per object]
+    """
+    with open(path) as f:
+        result = json.load(f)
+    if not result.get('source_bytes'):
+        raise ValueError(f"{path} has no source_bytes. Rerun benchmark.py to calibrate from it")
+    slices = result.get('slices', 1)
+    seconds = result['median_seconds']
+    insert_seconds = seconds['insert_tables'] + seconds.get('refresh_rollups', 0)
+    throughput = {'copy_bytes_per_second': result['source_bytes'] / seconds['load_staging_tables'] / slices
+                  ,'insert_bytes_per_second': result['source_bytes'] / insert_seconds / slices
+                  ,'seconds_per_object': DEFAULT_THROUGHPUT['seconds_per_object']}
+    logger.info(f"####### Calibrated from {path}: COPY {throughput['copy_bytes_per_second'] / 2**20:.1f} MiB/s, "
+                f"INSERT {throughput['insert_bytes_per_second'] / 2**20:.1f} MiB/s per slice #######")
+    return throughput
+
+def estimate(volume, node_type, n_nodes, throughput=DEFAULT_THROUGHPUT):
+    """ Estimates load time, storage and cost of a cluster. Each slice loads
+    one object at a time, so a COPY uses at most as many slices as it has objects
+
+    Args:
+    volume (dict):[objects and bytes per staging table, as returned by source_volume()]
+    node_type (str):[Redshift node type, one of NODE_TYPES]
+    n_nodes (int):[number of nodes]
+    throughput (dict):[throughput of a single slice, as returned by calibrate()]
+
+    Returns:
+    estimate (dict): [slices, COPY, INSERT and total seconds, whether the data fits, and cost]
+    """
+    node = NODE_TYPES[node_type]
+    slices = node['slices'] * n_nodes
+    copy_seconds = 0
+    for source in volume.values():
+        copy_slices = max(min(slices, source['objects']), 1)
+        copy_seconds += (source['bytes'] / throughput['copy_bytes_per_second']
+                         + source['objects'] * throughput['seconds_per_object']) / copy_slices
+    total_bytes = sum(source['bytes'] for source in volume.values())
+    insert_seconds = total_bytes / throughput['insert_bytes_per_second'] / slices
+    seconds = copy_seconds + insert_seconds
+    return {'node_type': node_type
+            ,'n_nodes': n_nodes
+            ,'slices': slices
+            ,'copy_seconds': copy_seconds
+            ,'insert_seconds': insert_seconds
+            ,'seconds': seconds
+            ,'fits': total_bytes * STORAGE_FACTOR <= node['storage_gb'] * n_nodes * 2**30
+            ,'cost': node['hourly_cost'] * n_nodes * seconds / 3600}
+
+def plan(volume, target_runtime, node_types=None, throughput=DEFAULT_THROUGHPUT):
+    """ Chooses the cheapest node type and count that loads the sources within
+    target_runtime. When none does, the fastest cluster is chosen
+
+    Args:
+    volume (dict):[objects and bytes per staging table, as returned by source_volume()]
+    target_runtime (float):[seconds the load should take at most]
+    node_types (list):[node types to choose from. Defaults to every one in NODE_TYPES]
+    throughput (dict):[throughput of a single slice, as returned by calibrate()]
+
+    Returns:
+    plan (dict): [chosen estimate, plus the smallest cluster of each node type under 'options']
+    """
+    candidates = [estimate(volume, node_type, n_nodes, throughput)
+                  for node_type in node_types or NODE_TYPES
+                  for n_nodes in range(NODE_TYPES[node_type]['min_nodes'], NODE_TYPES[node_type]['max_nodes'] + 1)]
+    candidates = [candidate for candidate in candidates if candidate['fits']]
+    if not candidates:
+        raise ValueError("Sources don't fit on any of the node types given")
+    on_time = [candidate for candidate in candidates if candidate['seconds'] <= target_runtime]
+    if on_time:
+        chosen = min(on_time, key=lambda candidate: (candidate['cost'], candidate['n_nodes']))
+    else:
+        logger.info(f"####### No cluster loads the sources within {target_runtime}s. Choosing the fastest #######")
+        chosen = min(candidates, key=lambda candidate: (candidate['seconds'], candidate['cost']))
+    options = {}
+    for candidate in candidates:
+        best = options.get(candidate['node_type'])
+        if best is None or (best['seconds'] > target_runtime and candidate['seconds'] < best['seconds']):
+            options[candidate['node_type']] = candidate
+    options[chosen['node_type']] = chosen
+    return {**chosen
+            ,'cluster_type': 'single-node' if chosen['n_nodes'] == 1 else 'multi-node'
+            ,'target_runtime': target_runtime
+            ,'options': list(options.values())}
+
+def format_report(volume, cluster_plan):
+    """ Formats the source volume and the plan as a table, one row per node
+    type with the smallest cluster of that type that meets the target
+
+    Args:
+    volume (dict):[objects and bytes per staging table, as returned by source_volume()]
+    cluster_plan (dict):[plan returned by plan()]
+
+    Returns:
+    report (str): [string representing the report]
+    """
+    lines = [f"{table}: {source['objects']} objects, {source['bytes'] / 2**20:.1f} MiB"
+             for table, source in volume.items()]
+    lines.append(f"{'node type':<14}{'slices/node':>12}{'nodes':>7}{'slices':>8}"
+                 f"{'copy s':>10}{'insert s':>10}{'total s':>10}{'cost $':>9}  on time")
+    for option in cluster_plan['options']:
+        chosen = ' <- chosen' if (option['node_type'], option['n_nodes']) == (cluster_plan['node_type'], cluster_plan['n_nodes']) else ''
+        lines.append(f"{option['node_type']:<14}{NODE_TYPES[option['node_type']]['slices']:>12}{option['n_nodes']:>7}"
+                     f"{option['slices']:>8}{option['copy_seconds']:>10.1f}{option['insert_seconds']:>10.1f}"
+                     f"{option['seconds']:>10.1f}{option['cost']:>9.2f}  "
+                     f"{'yes' if option['seconds'] <= cluster_plan['target_runtime'] else 'no'}{chosen}")
+    lines.append(f"Chosen: {cluster_plan['n_nodes']} x {cluster_plan['node_type']} ({cluster_plan['cluster_type']}), "
+                 f"about {cluster_plan['seconds']:.0f}s for a target of {cluster_plan['target_runtime']}s")
+    return '\n'.join(lines)
+
+def size_cluster(s3, db_config):
+    """ Plans the cluster for the sources of this run and stores the chosen
+    node type, node count and cluster type in db_config, replacing the ones
+    from dwh.cfg. Only a newly created cluster is sized by it
+
+    Args:
+    s3 (obj):[Boto3 S3 client for the source bucket]
+    db_config (dict):[dictionary containing database configuration]
+
+    Returns:
+    plan (dict): [plan returned by plan()]
+    """
+    loaded = None
+    if db_config['use_ledger'] and db_config['load_mode'] == 'incremental':
+        loaded = ledger.read_ledger(db_config['ledger_path'])
+    volume = source_volume(s3, db_config, loaded)
+    throughput = calibrate(db_config['benchmark_path']) if db_config['benchmark_path'] else DEFAULT_THROUGHPUT
+    node_types = [node_type.strip() for node_type in db_config['planner_node_types'].split(',') if node_type.strip()]
+    cluster_plan = plan(volume, db_config['target_runtime'], node_types, throughput)
+    for line in format_report(volume, cluster_plan).splitlines():
+        logger.info(f"####### {line} #######")
+    db_config['node_type'] = cluster_plan['node_type']
+    db_config['n_nodes'] = str(cluster_plan['n_nodes'])
+    db_config['cluster_type'] = cluster_plan['cluster_type']
+    return cluster_plan
+
+if __name__ == '__main__':
+    import config_loader
+    from aws_functions import S3_sources
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Dry run: sizes the cluster for the configured S3 sources without creating it")
+    parser.add_argument('--target-runtime', type=int, help="seconds the load should take at most. Defaults to dwh.cfg")
+    parser.add_argument('--benchmark', help="benchmark.py results file to calibrate throughput from. Defaults to dwh.cfg")
+    args = parser.parse_args()
+    db_config = config_loader.get_config()
+    if args.target_runtime:
+        db_config['target_runtime'] = args.target_runtime
+    if args.benchmark:
+        db_config['benchmark_path'] = args.benchmark
+    s3 = S3_sources.create_client(db_config['key'], db_config['secret'], db_config['s3_region'])
+    size_cluster(s3, db_config)
@@ -0,0 +1,142 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS THAT MERGE SOURCE FILES OF NEWLINE-DELIMITED
+RECORDS AND RE-SPLIT THEM INTO GZIP CHUNKS, AS MANY AS A MULTIPLE OF THE
+CLUSTER SLICES, SO EVERY SLICE LOADS EQUAL WORK
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import gzip
+import logging
+import tempfile
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+import ledger
+from cluster_planner import NODE_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed bytes per chunk to aim for. Chunks are only made smaller so
+# their count stays a multiple of the slice count
+CHUNK_BYTES = 64 * 2**20
+
+# Bytes read from S3 at a time while streaming an object's records
+READ_BYTES = 2**20
+
+def slice_count(db_config):
+    """ Gets the number of slices of the cluster from its node type and count
+
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+
+    Returns:
+    slices (int): [number of slices]
+    """
+    return NODE_TYPES[db_config['node_type']]['slices'] * int(db_config['n_nodes'])
+
+def plan_chunks(objects, slices, chunk_bytes=CHUNK_BYTES):
+    """ Splits the objects, read one after the other as a single byte stream,
+    into byte ranges of equal size, one per chunk. The number of chunks is the
+    smallest multiple of slices that keeps chunks under chunk_bytes. A range
+    may start or end inside an object; its chunk takes the records starting
+    in it, so records are never split
+
+    Args:
+    objects (dict):[object url mapped to its ETag and size]
+    slices (int):[number of slices of the cluster]
+    chunk_bytes (int):[uncompressed bytes per chunk to aim for]
+
+    Returns:
+    chunks (list): [one list per chunk of (object url, first byte, end byte) ranges, in stream order]
+    """
+    total = sum(meta['size'] for meta in objects.values())
+    n_chunks = slices * max(ceil(total / (slices * chunk_bytes)), 1)
+    bounds = [total * i // n_chunks for i in range(n_chunks + 1)]
+    chunks = [[] for _ in range(n_chunks)]
+    offset = 0
+    for url, meta in sorted(objects.items()):
+        end = offset + meta['size']
+        for i in range(n_chunks):
+            first, last = max(bounds[i], offset), min(bounds[i + 1], end)
+            if first < last:
+                chunks[i].append((url, first - offset, last - offset))
+        offset = end
+    return chunks
+
+def _records(body):
+    """ Yields the records of a streamed S3 object, each with its newline """
+    pending = b''
+    for data in body.iter_chunks(READ_BYTES):
+        *lines, pending = (pending + data).split(b'\n')
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+def _read_range(s3, url, first, end):
+    """ Yields the records of an object that start between its bytes first and
+    end. Reading starts one byte early, so a record cut by first is skipped """
+    bucket, key = ledger.parse_s3_url(url)
+    start = max(first - 1, 0)
+    body = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-")['Body']
+    try:
+        position = start
+        for record in _records(body):
+            if position >= end:
+                break
+            if position >= first:
+                yield record
+            position += len(record)
+    finally:
+        body.close()
+
+def _write_chunk(s3, ranges, url, work_dir):
+    """ Writes the records of the given object ranges into one gzip file, one
+    record per line, and uploads it
+
+    Returns:
+    url (str): [S3 url of the chunk]
+    meta (dict): [ETag and size of the chunk, and the urls of the objects in it]
+    """
+    path = os.path.join(work_dir, os.path.basename(url))
+    with gzip.open(path, 'wb') as f:
+        for source, first, end in ranges:
+            for record in _read_range(s3, source, first, end):
+                if record.strip():
+                    f.write(record.strip() + b'\n')
+    bucket, key = ledger.parse_s3_url(url)
+    s3.upload_file(path, bucket, key)
+    size = os.path.getsize(path)
+    os.remove(path)
+    sources = sorted({source for source, _, _ in ranges})
+    return url, {'etag': s3.head_object(Bucket=bucket, Key=key)['ETag'].strip('"'), 'size': size, 'sources': sources}
+
+def compact(s3, objects, dest, slices, chunk_bytes=CHUNK_BYTES, max_workers=8):
+    """ Merges objects into gzip chunks under dest, replacing the chunks of an
+    earlier run. Every chunk of plan_chunks() is written, so their count is
+    always a multiple of slices and they differ in size by at most a record.
+    A chunk is only empty when there are fewer records than chunks or a
+    record is longer than a chunk. Chunks are written concurrently
+
+    Args:
+    s3 (obj):[Boto3 S3 client for the source and destination buckets]
+    objects (dict):[object url mapped to its ETag and size, e.g. from ledger.list_objects()]
+    dest (str):[string representing the S3 prefix to write the chunks to]
+    slices (int):[number of slices of the cluster]
+    chunk_bytes (int):[uncompressed bytes per chunk to aim for]
+    max_workers (int):[maximum number of chunks written at once]
+
+    Returns:
+    chunks (dict): [chunk url mapped to its ETag, size and source object urls, ready for ledger.build_manifest()]
+    """
+    dest = dest.rstrip('/')
+    for url in ledger.list_objects(s3, dest + '/'):
+        bucket, key = ledger.parse_s3_url(url)
+        s3.delete_object(Bucket=bucket, Key=key)
+    plan = plan_chunks(objects, slices, chunk_bytes)
+    logger.info(f"####### Compacting {len(objects)} objects into {len(plan)} chunks for {slices} slices #######")
+    with tempfile.TemporaryDirectory() as work_dir, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_write_chunk, s3, ranges, f"{dest}/chunk-{i:05d}.json.gz", work_dir)
+                   for i, ranges in enumerate(plan)]
+        return dict(future.result() for future in futures)
@@ -4,14 +4,24 @@ THIS MODULE INCLUDES CODE TO LOAD REDSHIFT CLUSTER CONFIGURATION
 Author: Lucas Aledi
 Date: December 2022
 """
-from dataclasses import dataclass
+import os
+import threading
+from dataclasses import dataclass, fields
 import configparser
 
+DEFAULT_PATH = 'config/dwh.cfg'
+# Any setting can be overridden with SPARKIFY_<NAME>, e.g. SPARKIFY_DB_PASSWORD
+ENV_PREFIX = 'SPARKIFY_'
+
+# Configurations already read, by path. Every caller shares the same dict
+_loaded = {}
+_lock = threading.Lock()
+
 class DatabaseConfig:
     """
     Dataclass used for storing information and returning it for 
-    the main cycle of the ETL process under sparkify_redshift_db.py,
-    aws_functions.py, create_tables.py and etl.py
+    the main cycle of the ETL process under sparkify_redshift_db.py.
+    Use get_config() to share a single, lazily read copy
     """
     @dataclass
     class Configurations:
@@ -33,9 +43,43 @@ class DatabaseConfig:
         db_port: str
         db_host: str
         db_iam_role_arn: str
+        lifecycle_mode: str
+        teardown_mode: str
+        connect_timeout: int
+        connect_retries: int
+        retry_delay: int
+        keepalives_idle: int
+        statement_timeout: int
+        load_timeout: int
         s3_log_data: str
         s3_log_metadata: str
         s3_song_data: str
+        s3_region: str
+        s3_manifest_prefix: str
+        s3_parquet_prefix: str
+        s3_quarantine_prefix: str
+        ledger_path: str
+        parallel_load: bool
+        max_connections: int
+        wlm_slots: int
+        load_mode: str
+        use_ledger: bool
+        use_parquet: bool
+        compact_sources: bool
+        tolerant_load: bool
+        max_errors: int
+        metrics_dir: str
+        encodings_path: str
+        analyze_compression: bool
+        cache_max_entries: int
+        cache_ttl: int
+        cache_version_ttl: int
+        validation_time_budget: int
+        max_null_rate: float
+        size_cluster: bool
+        target_runtime: int
+        benchmark_path: str
+        planner_node_types: str
     
     def get_config(path_to_file):
         """ Storing dwh.cfg information into Configurations dataclass
@@ -62,8 +106,94 @@ class DatabaseConfig:
             ,db_port=config.get("CLUSTER", "db_port")
             ,db_host=config.get("CLUSTER","host")
             ,db_iam_role_arn=config.get("CLUSTER","db_iam_role_arn") # Redshift Cluster
+            ,lifecycle_mode=config.get("CLUSTER","lifecycle_mode")
+            ,teardown_mode=config.get("CLUSTER","teardown_mode")
+            ,connect_timeout=config.getint("CONNECTION","connect_timeout")
+            ,connect_retries=config.getint("CONNECTION","connect_retries")
+            ,retry_delay=config.getint("CONNECTION","retry_delay")
+            ,keepalives_idle=config.getint("CONNECTION","keepalives_idle")
+            ,statement_timeout=config.getint("CONNECTION","statement_timeout")
+            ,load_timeout=config.getint("CONNECTION","load_timeout")
             ,s3_log_data=config.get("S3","log_data")
             ,s3_log_metadata=config.get("S3","log_jsonpath")
             ,s3_song_data=config.get("S3","song_data")
+            ,s3_region=config.get("S3","region")
+            ,s3_manifest_prefix=config.get("S3","manifest_prefix")
+            ,s3_parquet_prefix=config.get("S3","parquet_prefix")
+            ,s3_quarantine_prefix=config.get("S3","quarantine_prefix")
+            ,ledger_path=config.get("S3","ledger_path")
+            ,parallel_load=config.getboolean("ETL","parallel_load")
+            ,max_connections=config.getint("ETL","max_connections")
+            ,wlm_slots=config.getint("ETL","wlm_slots")
+            ,load_mode=config.get("ETL","load_mode")
+            ,use_ledger=config.getboolean("ETL","use_ledger")
+            ,use_parquet=config.getboolean("ETL","use_parquet")
+            ,compact_sources=config.getboolean("ETL","compact_sources")
+            ,tolerant_load=config.getboolean("ETL","tolerant_load")
+            ,max_errors=config.getint("ETL","max_errors")
+            ,metrics_dir=config.get("ETL","metrics_dir")
+            ,encodings_path=config.get("ETL","encodings_path")
+            ,analyze_compression=config.getboolean("ETL","analyze_compression")
+            ,cache_max_entries=config.getint("ANALYTICS","cache_max_entries")
+            ,cache_ttl=config.getint("ANALYTICS","cache_ttl")
+            ,cache_version_ttl=config.getint("ANALYTICS","cache_version_ttl")
+            ,validation_time_budget=config.getint("VALIDATION","time_budget")
+            ,max_null_rate=config.getfloat("VALIDATION","max_null_rate")
+            ,size_cluster=config.getboolean("PLANNER","size_cluster")
+            ,target_runtime=config.getint("PLANNER","target_runtime")
+            ,benchmark_path=config.get("PLANNER","benchmark_path")
+            ,planner_node_types=config.get("PLANNER","node_types")
         ).__dict__
+        DatabaseConfig.apply_overrides(db_config, os.environ)
+        return db_config
+
+    def apply_overrides(db_config, environ):
+        """ Replaces settings with SPARKIFY_<NAME> environment variables,
+        converted to the type of the setting
+
+        Args:
+        db_config (dict):[dictionary containing database configuration]
+        environ (dict):[environment variables, e.g. os.environ]
+        """
+        for field in fields(DatabaseConfig.Configurations):
+            value = environ.get(ENV_PREFIX + field.name.upper())
+            if value is None:
+                continue
+            if field.type is bool:
+                value = configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+            elif field.type in (int, float):
+                value = field.type(value)
+            db_config[field.name] = value
+
+def get_config(path_to_file=DEFAULT_PATH):
+    """ Returns the configuration, reading the file on first use only.
+    Later calls return the same dict, so values set at run time (e.g. the
+    IAM role ARN) are seen by every module
+
+    Args:
+    path_to_file (str):[string representing path to config file]
+
+    Returns:
+    db_config (dict): [dictionary containing database configuration]
+    """
+    with _lock:
+        if path_to_file not in _loaded:
+            _loaded[path_to_file] = DatabaseConfig.get_config(path_to_file)
+        return _loaded[path_to_file]
+
+def reload(path_to_file=DEFAULT_PATH):
+    """ Reads the config file and environment again. The shared dict is
+    updated in place, so modules holding it see the new values
+
+    Args:
+    path_to_file (str):[string representing path to config file]
+
+    Returns:
+    db_config (dict): [dictionary containing database configuration]
+    """
+    fresh = DatabaseConfig.get_config(path_to_file)
+    with _lock:
+        db_config = _loaded.setdefault(path_to_file, {})
+        db_config.clear()
+        db_config.update(fresh)
         return db_config
\ No newline at end of file
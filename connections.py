@@ -0,0 +1,151 @@
+"""
+THIS MODULE INCLUDES A CONNECTION MANAGER THAT HANDS OUT POOLED DATABASE
+CONNECTIONS, TAGGED WITH A WLM QUERY GROUP AND STATEMENT TIMEOUT PER STAGE
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import random
+import logging
+import threading
+from time import sleep
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
+
+logger = logging.getLogger(__name__)
+
+def connection_kwargs(db_config):
+    """ Builds psycopg2.connect arguments from the configuration, with TCP
+    keepalives so idle connections held during long stages aren't dropped
+
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+
+    Returns:
+    kwargs (dict): [keyword arguments for psycopg2.connect]
+    """
+    return {'host': db_config['db_host']
+            ,'dbname': db_config['db_name']
+            ,'user': db_config['db_user']
+            ,'password': db_config['db_password']
+            ,'port': db_config['db_port']
+            ,'connect_timeout': db_config['connect_timeout']
+            ,'keepalives': 1
+            ,'keepalives_idle': db_config['keepalives_idle']
+            ,'keepalives_interval': max(db_config['keepalives_idle'] // 4, 1)
+            ,'keepalives_count': 4
+            ,'application_name': 'sparkify_etl'}
+
+def describe(db_config):
+    """ Describes the connection target for logs, leaving out the password """
+    return f"host={db_config['db_host']} dbname={db_config['db_name']} user={db_config['db_user']} port={db_config['db_port']}"
+
+class Connection_manager:
+    """
+    Bounded pool of database connections. getconn() blocks while every
+    connection is in use, connects are retried with exponential backoff,
+    and every connection is tagged with the WLM query_group and
+    statement_timeout of the current stage. getconn(), putconn() and
+    maxconn match psycopg2.pool, so the parallel stages take a manager
+    wherever they take a pool
+    """
+    def __init__(self, db_config, maxconn, statement_timeout=0, connect_retries=5
+                 ,retry_delay=2, query_groups=True, sleep=sleep):
+        self.kwargs = connection_kwargs(db_config)
+        self.maxconn = maxconn
+        self.statement_timeout = statement_timeout
+        self.connect_retries = connect_retries
+        self.retry_delay = retry_delay
+        self.query_groups = query_groups
+        self.sleep = sleep
+        self.current = ('default', statement_timeout)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.checked_out = set()
+        self.lock = threading.Lock()
+        logger.info(f"####### Connecting to {describe(db_config)} #######")
+        self.pool = self._retry(lambda: psycopg2.pool.ThreadedConnectionPool(1, maxconn, **self.kwargs))
+
+    def _retry(self, connect):
+        """ Calls connect, retrying OperationalErrors with exponential backoff and jitter """
+        delay = self.retry_delay
+        for attempt in range(1, self.connect_retries + 1):
+            try:
+                return connect()
+            except psycopg2.OperationalError as err:
+                if attempt == self.connect_retries:
+                    raise
+                logger.info(f"####### Connection attempt {attempt} failed ({str(err).strip()}). "
+                            f"Retrying in {delay:.0f}s #######")
+                self.sleep(random.uniform(delay / 2, delay))
+                delay *= 2
+
+    def _tag(self, conn):
+        """ Applies the query_group and statement_timeout of the current stage """
+        stage, timeout = self.current
+        with conn.cursor() as cur:
+            if self.query_groups:
+                cur.execute("SET query_group TO %s;", (stage,))
+            cur.execute("SET statement_timeout TO %s;", (int(timeout * 1000),))
+        conn.commit()
+
+    def getconn(self):
+        """ Checks out a connection, waiting for a free one when all are in use
+
+        Returns:
+        conn (obj): [psycopg2 connection tagged for the current stage]
+        """
+        self.slots.acquire()
+        try:
+            while True:
+                conn = self._retry(self.pool.getconn)
+                if not conn.closed:
+                    break
+                self.pool.putconn(conn, close=True)
+            self._tag(conn)
+            with self.lock:
+                self.checked_out.add(conn)
+            return conn
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn):
+        """ Returns a connection to the pool. Broken connections are discarded """
+        with self.lock:
+            self.checked_out.discard(conn)
+        try:
+            if not conn.closed:
+                conn.rollback()
+            self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def stage(self, name, statement_timeout=None):
+        """ Tags the connections checked out now, and the ones checked out
+        until the stage ends, with a WLM query_group and a statement_timeout.
+        Call it between stages, while no parallel work holds connections
+
+        Args:
+        name (str):[stage name, used as the query_group]
+        statement_timeout (float):[seconds after which a statement is cancelled. 0 disables it.
+                                   Defaults to the manager's statement_timeout]
+        """
+        previous = self.current
+        self.current = (name, self.statement_timeout if statement_timeout is None else statement_timeout)
+        with self.lock:
+            held = list(self.checked_out)
+        for conn in held:
+            self._tag(conn)
+        try:
+            yield
+        finally:
+            self.current = previous
+            for conn in held:
+                if not conn.closed:
+                    self._tag(conn)
+
+    def closeall(self):
+        """ Closes every pooled connection """
+        self.pool.closeall()
@@ -4,12 +4,10 @@ THIS MODULE INCLUDES FUNCTIONS FOR DROPING AND CREATING STAGING TABLES
 Author: Lucas Aledi
 Date: December 2022
 """
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import drop_table_queries, truncate_table_queries
+import sql_queries
 import logging
-from config_loader import *
-
-# loads config
-db_config = DatabaseConfig.get_config('config/dwh.cfg')
+import instrumentation
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +22,7 @@ def drop_tables(cur, conn):
         logger.info("####### Droping Tables, if any. #######")
         i = 1
         for query in drop_table_queries:
-            cur.execute(query)
+            instrumentation.execute(cur, query)
             conn.commit()
             logger.info(f"####### Droping {i} of {len(drop_table_queries)} #######")
             i += 1
@@ -42,12 +40,33 @@ def create_tables(cur, conn):
     """
     try:
         logger.info("####### Creating Tables #######")
+        create_table_queries = sql_queries.create_table_queries
         i = 1
         for query in create_table_queries:
-            cur.execute(query)
+            instrumentation.execute(cur, query)
             conn.commit()
             logger.info(f"####### Creating {i} of {len(create_table_queries)} #######")
             i += 1
     except Exception as err:
         logger.exception(err)
-        raise(err)        
\ No newline at end of file
+        raise(err)
+
+
+def truncate_staging_tables(cur, conn):
+    """ Empties staging tables, keeping the analytics tables for incremental loads
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        logger.info("####### Truncating Staging Tables #######")
+        i = 1
+        for query in truncate_table_queries:
+            instrumentation.execute(cur, query)
+            conn.commit()
+            logger.info(f"####### Truncating {i} of {len(truncate_table_queries)} #######")
+            i += 1
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
\ No newline at end of file
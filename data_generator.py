@@ -0,0 +1,159 @@
+"""
+THIS MODULE INCLUDES A GENERATOR OF SYNTHETIC LOG AND SONG DATA, WRITTEN IN
+THE SAME LAYOUT AS s3://udacity-dend/log_data AND s3://udacity-dend/song_data
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import json
+import random
+import string
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+PAGES = ['NextSong'] * 8 + ['Home', 'Logout', 'Settings', 'About']
+FIRST_NAMES = ['Jacob', 'Lily', 'Kate', 'Tegan', 'Aleena', 'Chloe', 'Ryan', 'Sara']
+LAST_NAMES = ['Klein', 'Koch', 'Harrell', 'Levine', 'Kirby', 'Cuevas', 'Smith', 'Lynch']
+LOCATIONS = ['Tampa-St. Petersburg-Clearwater, FL', 'San Francisco-Oakland-Hayward, CA'
+             ,'Lansing-East Lansing, MI', 'Portland-South Portland, ME']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36"'
+               ,'"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2"'
+               ,'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0']
+
+def _random_id(rng, prefix, size=16):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(size))
+
+def generate_songs(out_dir, n_songs, rng):
+    """ Writes one JSON file per song under song_data/<A>/<B>/<C>/, named
+    after the track ID like the real dataset
+
+    Args:
+    out_dir (str):[string representing path to write song_data to]
+    n_songs (int):[number of songs to generate]
+    rng (obj):[random.Random instance]
+
+    Returns:
+    songs (list): [(title, artist_name, duration) of every song, for events to play]
+    """
+    artists = []
+    for i in range(max(1, n_songs // 3)):
+        located = rng.random() < 0.5
+        artists.append((_random_id(rng, 'AR'), f"Artist {i}", rng.choice(LOCATIONS + [''])
+                        ,round(rng.uniform(-90, 90), 5) if located else None
+                        ,round(rng.uniform(-180, 180), 5) if located else None))
+    songs = []
+    for i in range(n_songs):
+        artist_id, artist_name, location, latitude, longitude = rng.choice(artists)
+        track_id = _random_id(rng, 'TR')
+        record = {'num_songs': 1
+                  ,'artist_id': artist_id
+                  ,'artist_latitude': latitude
+                  ,'artist_longitude': longitude
+                  ,'artist_location': location
+                  ,'artist_name': artist_name
+                  ,'song_id': _random_id(rng, 'SO')
+                  ,'title': f"Song {i}"
+                  ,'duration': round(rng.uniform(60, 600), 5)
+                  ,'year': rng.choice([0] + list(range(1960, 2019)))}
+        song_dir = os.path.join(out_dir, 'song_data', *track_id[2:5])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, f"{track_id}.json"), 'w') as f:
+            json.dump(record, f)
+        songs.append((record['title'], artist_name, record['duration']))
+    return songs
+
+def generate_events(out_dir, n_events, songs, n_users, n_days, rng, start=datetime(2018, 11, 1, tzinfo=timezone.utc)):
+    """ Writes newline-delimited events under log_data/<YYYY>/<MM>/<YYYY-MM-DD>-events.json,
+    with the fields mapped by log_json_path.json. About one in ten NextSong
+    events plays a song that is not in song_data, as in the real dataset
+
+    Args:
+    out_dir (str):[string representing path to write log_data to]
+    n_events (int):[number of events to generate]
+    songs (list):[songs returned by generate_songs()]
+    n_users (int):[number of distinct users]
+    n_days (int):[number of daily log files to spread the events over]
+    rng (obj):[random.Random instance]
+    start (obj):[datetime of the first day]
+    """
+    users = [{'userId': str(i + 1)
+              ,'firstName': rng.choice(FIRST_NAMES)
+              ,'lastName': rng.choice(LAST_NAMES)
+              ,'gender': rng.choice(['M', 'F'])
+              ,'location': rng.choice(LOCATIONS)
+              ,'userAgent': rng.choice(USER_AGENTS)
+              ,'registration': float(rng.randint(1535000000000, 1541000000000))
+              ,'level': rng.choice(['free', 'paid'])}
+             for i in range(n_users)]
+    per_day = -(-n_events // n_days)
+    written = 0
+    for day in range(n_days):
+        date = start + timedelta(days=day)
+        day_dir = os.path.join(out_dir, 'log_data', f"{date:%Y}", f"{date:%m}")
+        os.makedirs(day_dir, exist_ok=True)
+        day_ms = int(date.timestamp() * 1000)
+        count = min(per_day, n_events - written)
+        with open(os.path.join(day_dir, f"{date:%Y-%m-%d}-events.json"), 'w') as f:
+            for ts in sorted(rng.randrange(day_ms, day_ms + 86400000) for _ in range(count)):
+                user = rng.choice(users)
+                page = rng.choice(PAGES)
+                logged_in = page != 'Logout' or rng.random() < 0.5
+                if user['level'] == 'free' and rng.random() < 0.001:
+                    user['level'] = 'paid'
+                event = {'artist': None, 'auth': 'Logged In' if logged_in else 'Logged Out'
+                         ,'firstName': user['firstName'] if logged_in else None
+                         ,'gender': user['gender'] if logged_in else None
+                         ,'itemInSession': rng.randint(0, 100)
+                         ,'lastName': user['lastName'] if logged_in else None
+                         ,'length': None, 'level': user['level']
+                         ,'location': user['location'] if logged_in else None
+                         ,'method': 'PUT' if page == 'NextSong' else 'GET', 'page': page
+                         ,'registration': user['registration'] if logged_in else None
+                         ,'sessionId': rng.randint(1, 1000), 'song': None
+                         ,'status': 200 if page != 'Logout' else 307, 'ts': ts
+                         ,'userAgent': user['userAgent'] if logged_in else None
+                         ,'userId': user['userId'] if logged_in else ''}
+                if page == 'NextSong':
+                    title, artist, length = rng.choice(songs)
+                    if rng.random() < 0.1:
+                        title = f"{title} (Live)"
+                    event.update({'artist': artist, 'song': title, 'length': length})
+                f.write(json.dumps(event) + '\n')
+        written += count
+        if written >= n_events:
+            break
+
+def generate(out_dir, n_events, n_songs=None, n_users=None, n_days=30, seed=42):
+    """ Generates a full synthetic dataset: song_data and log_data
+
+    Args:
+    out_dir (str):[string representing path to write the dataset to]
+    n_events (int):[number of log events, e.g. 10_000 to 50_000_000]
+    n_songs (int):[number of songs. Defaults to one per hundred events]
+    n_users (int):[number of users. Defaults to one per thousand events]
+    n_days (int):[number of daily log files]
+    seed (int):[seed for the random generator, so scales are reproducible]
+    """
+    rng = random.Random(seed)
+    n_songs = n_songs or max(100, n_events // 100)
+    n_users = n_users or max(10, n_events // 1000)
+    logger.info(f"####### Generating {n_songs} songs #######")
+    songs = generate_songs(out_dir, n_songs, rng)
+    logger.info(f"####### Generating {n_events} events for {n_users} users over {n_days} days #######")
+    generate_events(out_dir, n_events, songs, n_users, n_days, rng)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Generates synthetic log_data and song_data")
+    parser.add_argument('out_dir')
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--songs', type=int)
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    generate(args.out_dir, args.events, args.songs, args.users, args.days, args.seed)
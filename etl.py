@@ -5,13 +5,23 @@ Author: Lucas Aledi
 Date: December 2022
 """
 import logging
-from config_loader import *
-from sql_queries import copy_table_queries, insert_table_queries
+import re
+from functools import partial
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from scheduler import Node, run_graph
+from sql_queries import insert_table_queries, insert_table_names, upsert_table_names
+from sql_queries import upsert_table_queries, staging_events_prune, load_watermark_update, load_versions_update
+from sql_queries import staging_insert_queries, songplay_table_insert
+import sql_queries
+import query_registry
+import ledger
+import compactor
+import quarantine
+import instrumentation
 
 logger = logging.getLogger(__name__)
 
-# loads config
-db_config = DatabaseConfig.get_config('config/dwh.cfg')
 
 def load_staging_tables(cur, conn):
     """ Copies data from source S3 bucket into staging tables
@@ -21,12 +31,272 @@ def load_staging_tables(cur, conn):
     conn (obj):[object connection created from psycopg2 to database]
     """
     try:
+        # Rendered now, so the COPYs use the IAM role ARN of this run
+        copy_table_queries = sql_queries.copy_table_queries
         i = 1
         for query in copy_table_queries:
             logger.info(f"####### Loading {i} of {len(copy_table_queries)}. This might take some time. #######")
-            cur.execute(query)
+            instrumentation.execute(cur, query)
             conn.commit()
             i += 1
+        insert_staging_tables(cur, conn)
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def insert_staging_tables(cur, conn):
+    """ Copies the raw staging rows into the staging tables, computing 
+    song_match_key, so the songplay join runs on the column they are 
+    distributed on
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        logger.info("####### Computing song match keys #######")
+        for query in staging_insert_queries:
+            instrumentation.execute(cur, query)
+            conn.commit()
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def check_songplay_plan(cur):
+    """ Checks that the songplay join is slice-local, i.e. its plan has no
+    DS_BCAST_INNER or DS_DIST_BOTH step, and logs a warning otherwise
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    
+    Returns:
+    redistributions (list): [plan lines that broadcast or redistribute data]
+    """
+    try:
+        instrumentation.execute(cur, f"EXPLAIN {songplay_table_insert}", label='EXPLAIN songplay')
+        redistributions = [row[0].strip() for row in cur.fetchall()
+                           if 'DS_BCAST_INNER' in row[0] or 'DS_DIST_BOTH' in row[0]]
+        if redistributions:
+            logger.warning("####### songplay join is not co-located: #######")
+            for line in redistributions:
+                logger.warning(f"####### {line} #######")
+        else:
+            logger.info("####### songplay join is co-located on song_match_key #######")
+        return redistributions
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def load_staging_tables_from_ledger(cur, conn, s3, db_config, reset=False):
+    """ Copies only new or changed S3 objects into staging tables. Each 
+    source prefix is listed and diffed against the ledger, and a COPY 
+    manifest with the pending objects is uploaded and loaded. Only tables 
+    in ledger.INCREMENTAL_TABLES are diffed; staging_songs takes every 
+    object, so new events match songs loaded by earlier runs. With 
+    compact_sources, the pending objects are first merged into gzip chunks, 
+    a multiple of the slice count, and the manifest lists the chunks. With 
+    tolerant_load, bad records are quarantined and files that made the COPY 
+    fail are loaded again on their own (see quarantine.py). The ledger is not written
+    here: pass the objects returned to record_ledger() once they reached the
+    analytics tables, so a failed insert doesn't leave them marked as done
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    s3 (obj):[Boto3 S3 client for the source bucket]
+    db_config (dict):[dictionary containing database configuration]
+    reset (bool):[ignore the ledger and load everything, e.g. after tables were rebuilt]
+    
+    Returns:
+    loaded (dict): [staging table mapped to the objects loaded into it]
+    """
+    try:
+        loaded = {}
+        for table, source, copy_name, params, staging_insert in sql_queries.manifest_copy_queries:
+            objects = ledger.list_objects(s3, source)
+            incremental = table in ledger.INCREMENTAL_TABLES and not reset
+            done = ledger.read_ledger(db_config['ledger_path']).get(table, {}) if incremental else {}
+            pending = ledger.new_objects(objects, done)
+            loaded[table] = pending
+            if not pending:
+                logger.info(f"####### No new objects for {table}. Skipping. #######")
+                continue
+            logger.info(f"####### Loading {len(pending)} of {len(objects)} objects into {table} #######")
+            manifest_prefix = db_config['s3_manifest_prefix'].rstrip('/')
+            manifest_url = f"{manifest_prefix}/{table}.manifest"
+            listed, compression = pending, ''
+            if db_config['compact_sources']:
+                listed = compactor.compact(s3, pending, f"{manifest_prefix}/compacted/{table}"
+                                           ,compactor.slice_count(db_config))
+                compression = ' GZIP'
+            if db_config['tolerant_load']:
+                quarantine.copy_with_quarantine(cur, conn, s3, table, listed, manifest_url, copy_name
+                                                ,{**params, 'compression': compression}
+                                                ,quarantine.quarantine_prefix(db_config))
+            else:
+                ledger.upload_manifest(s3, ledger.build_manifest(listed), manifest_url)
+                instrumentation.execute(cur, query_registry.render(copy_name, manifest_url=manifest_url
+                                                                   ,compression=compression, **params))
+            instrumentation.execute(cur, staging_insert)
+            conn.commit()
+        return loaded
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def record_ledger(db_config, loaded, reset=False, suffix=''):
+    """ Adds the objects of the staging tables in ledger.INCREMENTAL_TABLES to
+    the ledger. Call it only after the analytics tables and the high-water
+    mark were committed, so a run that fails before leaves them pending
+    
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+    loaded (dict):[staging table mapped to the objects loaded into it, as returned by load_staging_tables_from_ledger()]
+    reset (bool):[forget what was loaded before, e.g. after tables were rebuilt]
+    suffix (str):[appended to the table name to get its ledger entry, e.g. ledger.PARQUET_LOADED]
+    """
+    try:
+        for table in ledger.INCREMENTAL_TABLES:
+            if table in loaded:
+                logger.info(f"####### Recording {len(loaded[table])} objects of {table}{suffix} in the ledger #######")
+                ledger.record_loaded(db_config['ledger_path'], f"{table}{suffix}", loaded[table], reset)
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def load_staging_tables_from_parquet(cur, conn, s3, db_config, incremental=False):
+    """ Converts the source JSON to Parquet (only objects not converted 
+    before) and copies it into the staging tables with FORMAT AS PARQUET. 
+    The Parquet files already hold song_match_key. Loaded event files are 
+    kept in the ledger apart from the conversions (see ledger.PARQUET_LOADED), 
+    so files converted by a run that failed later are still loaded
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    s3 (obj):[Boto3 S3 client for the source and Parquet buckets]
+    db_config (dict):[dictionary containing database configuration]
+    incremental (bool):[load only the event files not loaded before, through a manifest.
+                        staging_songs always loads every file, so new events match earlier songs]
+    
+    Returns:
+    loaded (dict): [staging table mapped to the Parquet files loaded into it, for the tables
+                    in ledger.INCREMENTAL_TABLES. Pass them to record_ledger() with ledger.PARQUET_LOADED]
+    """
+    try:
+        # Imported here so pyarrow is only needed, and loaded, when use_parquet is on
+        import parquet_converter
+        parts = parquet_converter.convert_sources(s3, db_config)
+        params = sql_queries.copy_params(db_config)
+        loaded = {}
+        for table in parts:
+            name = f"{table}_parquet_copy"
+            source = f"{db_config['s3_parquet_prefix'].rstrip('/')}/{table}/"
+            if table in ledger.INCREMENTAL_TABLES:
+                loaded[table] = ledger.list_objects(s3, source)
+            if incremental and table in ledger.INCREMENTAL_TABLES:
+                done = ledger.read_ledger(db_config['ledger_path']).get(f"{table}{ledger.PARQUET_LOADED}", {})
+                loaded[table] = ledger.new_objects(loaded[table], done)
+                if not loaded[table]:
+                    logger.info(f"####### No new Parquet files for {table}. Skipping. #######")
+                    continue
+                source = f"{db_config['s3_manifest_prefix'].rstrip('/')}/{table}_parquet.manifest"
+                ledger.upload_manifest(s3, ledger.build_manifest(loaded[table]), source)
+                query = query_registry.render(name, source=source, manifest=' MANIFEST', **params[name])
+            else:
+                query = query_registry.render(name, source=source, **params[name])
+            logger.info(f"####### Loading {table} from Parquet #######")
+            instrumentation.execute(cur, query)
+            conn.commit()
+        return loaded
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def table_name(query):
+    """ Gets the name of the table targeted by a COPY or INSERT statement
+    
+    Args:
+    query (str):[string representing the SQL statement]
+    
+    Returns:
+    table (str): [string representing the target table name]
+    """
+    match = re.search(r'(?:COPY|INSERT\s+INTO)\s+(\w+)', query, re.IGNORECASE)
+    return match.group(1) if match else 'unknown'
+
+def run_pooled_query(pool, *queries):
+    """ Runs statements on their own connection borrowed from the 
+    pool and commits them in a single transaction
+    
+    Args:
+    pool (obj):[object connection pool created from psycopg2.pool]
+    queries (str):[strings representing the SQL statements]
+    
+    Returns:
+    elapsed (float): [seconds taken by the statements and their commit]
+    """
+    conn = pool.getconn()
+    try:
+        start = perf_counter()
+        with conn.cursor() as cur:
+            for query in queries:
+                instrumentation.execute(cur, query)
+        conn.commit()
+        return perf_counter() - start
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+def registry_node(pool, names, render=None):
+    """ Builds a scheduler node running registered statements in a single
+    pooled transaction, with the tables they read and write taken from the
+    query registry. The node is named after the first table written
+    
+    Args:
+    pool (obj):[object connection pool created from psycopg2.pool]
+    names (list):[names of statements in query_registry]
+    render (func):[applied to each rendered statement, e.g. publish.shadow_sql]
+    
+    Returns:
+    node (Node): [node for scheduler.run_graph]
+    """
+    inputs, outputs = query_registry.dependencies(names)
+    queries = query_registry.render_all(names)
+    if render:
+        queries = [render(query) for query in queries]
+    return Node(name=outputs[0]
+                ,run=partial(run_pooled_query, pool, *queries)
+                ,inputs=inputs
+                ,outputs=outputs)
+
+def load_staging_tables_parallel(pool, max_workers):
+    """ Copies data from source S3 bucket into staging tables, running 
+    each COPY and its staging insert concurrently on its own pooled connection
+    
+    Args:
+    pool (obj):[object connection pool created from psycopg2.pool]
+    max_workers (int):[maximum number of COPY statements running at once]
+    
+    Returns:
+    timings (dict): [seconds taken to load each staging table]
+    """
+    try:
+        copy_table_queries = sql_queries.copy_table_queries
+        logger.info(f"####### Loading {len(copy_table_queries)} tables in parallel. This might take some time. #######")
+        timings = {}
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run_pooled_query, pool, query, staging_insert): table_name(staging_insert)
+                       for query, staging_insert in zip(copy_table_queries, staging_insert_queries)}
+            for future in as_completed(futures):
+                table = futures[future]
+                timings[table] = future.result()
+                logger.info(f"####### Loaded {table} in {timings[table]:.1f}s #######")
+        logger.info(f"####### Staging load took {perf_counter() - start:.1f}s #######")
+        return timings
     except Exception as err:
         logger.exception(err)
         raise(err)
@@ -42,9 +312,115 @@ def insert_tables(cur, conn):
         i = 1
         for query in insert_table_queries:
             logger.info(f"####### Inserting {i} of {len(insert_table_queries)} #######")
-            cur.execute(query)
+            instrumentation.execute(cur, query)
+            conn.commit()
+            i += 1
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def insert_tables_parallel(pool, max_workers):
+    """ Insert data into tables to be used by Analytics Team, running 
+    inserts that don't depend on each other concurrently on pooled connections
+    
+    Args:
+    pool (obj):[object connection pool created from psycopg2.pool]
+    max_workers (int):[maximum number of inserts running at once, e.g. WLM slots]
+    
+    Returns:
+    timings (dict): [seconds taken to insert into each table]
+    """
+    try:
+        logger.info(f"####### Inserting {len(insert_table_queries)} tables, up to {max_workers} at a time #######")
+        nodes = [registry_node(pool, [name]) for name in insert_table_names]
+        start = perf_counter()
+        timings = run_graph(nodes, max_workers)
+        logger.info(f"####### Insert stage took {perf_counter() - start:.1f}s #######")
+        return timings
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def prune_staging_events(cur, conn):
+    """ Removes staged events already loaded into songplay, as given by 
+    the high-water mark, so incremental loads only process new events
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        logger.info("####### Pruning events older than the high-water mark #######")
+        instrumentation.execute(cur, staging_events_prune)
+        logger.info(f"####### Pruned {cur.rowcount} events #######")
+        conn.commit()
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def update_watermark(cur, conn):
+    """ Stores the latest start_time loaded into songplay as the new high-water mark,
+    and a new load version of every analytics table, in one transaction
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        logger.info("####### Updating high-water mark #######")
+        instrumentation.execute(cur, load_watermark_update)
+        instrumentation.execute(cur, load_versions_update)
+        conn.commit()
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def upsert_tables(cur, conn):
+    """ Incrementally loads new staged data into tables to be used by 
+    Analytics Team. Dimensions are upserted with delete+insert on their 
+    natural key, each in its own transaction
+    
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        prune_staging_events(cur, conn)
+        i = 1
+        for queries in upsert_table_queries:
+            logger.info(f"####### Upserting {i} of {len(upsert_table_queries)} #######")
+            for query in queries:
+                instrumentation.execute(cur, query)
             conn.commit()
             i += 1
+        update_watermark(cur, conn)
+    except Exception as err:
+        conn.rollback()
+        logger.exception(err)
+        raise(err)
+
+def upsert_tables_parallel(pool, max_workers):
+    """ Same as upsert_tables(), running upserts that don't depend on 
+    each other concurrently on pooled connections
+    
+    Args:
+    pool (obj):[object connection pool created from psycopg2.pool]
+    max_workers (int):[maximum number of upserts running at once, e.g. WLM slots]
+    
+    Returns:
+    timings (dict): [seconds taken to upsert into each table]
+    """
+    try:
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                prune_staging_events(cur, conn)
+        finally:
+            pool.putconn(conn)
+        nodes = [registry_node(pool, names) for names in upsert_table_names]
+        timings = run_graph(nodes, max_workers)
+        run_pooled_query(pool, load_watermark_update, load_versions_update)
+        return timings
     except Exception as err:
         logger.exception(err)
         raise(err)
\ No newline at end of file
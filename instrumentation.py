@@ -0,0 +1,153 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS FOR TIMING AND RECORDING EVERY SQL STATEMENT
+EXECUTED BY THE ETL PROCESS
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import re
+import json
+import logging
+import threading
+from time import perf_counter
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Statements recorded during the current run. Parallel stages append from several threads
+_records = []
+_lock = threading.Lock()
+# pg_last_query_id() and the STL/SVL system tables only exist on Redshift
+_settings = {'redshift': True}
+
+def configure(redshift=True):
+    """ Sets whether the target is Redshift, so query IDs and system table
+    stats are collected
+
+    Args:
+    redshift (bool):[True when statements run on a Redshift cluster]
+    """
+    _settings['redshift'] = redshift
+
+def reset():
+    """ Forgets every statement recorded so far, e.g. between benchmark runs """
+    with _lock:
+        _records.clear()
+
+def records():
+    """ Returns a copy of the statements recorded so far """
+    with _lock:
+        return [dict(record) for record in _records]
+
+def statement_label(query):
+    """ Builds a short label for a statement, e.g. 'COPY staging_events'
+
+    Args:
+    query (str):[string representing the SQL statement]
+
+    Returns:
+    label (str): [statement verb followed by the table it targets]
+    """
+    match = re.search(r'^\s*(\w+)(?:\s+(?:TABLE\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?|INTO\s+|FROM\s+))?\s*(\w+)?'
+                      ,query, re.IGNORECASE)
+    if not match:
+        return 'UNKNOWN'
+    verb, table = match.group(1).upper(), match.group(2)
+    if verb in ('SELECT', 'WITH'):
+        source = re.search(r'\bFROM\s+(\w+)', query, re.IGNORECASE)
+        return f"{verb} {source.group(1)}" if source else verb
+    return f"{verb} {table}" if table else verb
+
+def _last_query_id(cur):
+    """ Gets the Redshift query ID of the statement just run on the cursor's
+    connection. A separate cursor is used so results of cur are kept """
+    with cur.connection.cursor() as id_cur:
+        id_cur.execute("SELECT pg_last_query_id();")
+        return id_cur.fetchone()[0]
+
+def execute(cur, query, label=None, params=None):
+    """ Runs a statement and records its wall time, row count, query ID and label
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    query (str):[string representing the SQL statement]
+    label (str):[name of the statement. Defaults to statement_label(query)]
+    params (dict):[values bound to %(name)s placeholders in query]
+    """
+    label = label or statement_label(query)
+    started_at = datetime.now(timezone.utc).isoformat()
+    start = perf_counter()
+    if params is None:
+        cur.execute(query)
+    else:
+        cur.execute(query, params)
+    seconds = perf_counter() - start
+    record = {'label': label
+              ,'started_at': started_at
+              ,'seconds': seconds
+              ,'rowcount': cur.rowcount
+              ,'query_id': _last_query_id(cur) if _settings['redshift'] else None}
+    with _lock:
+        _records.append(record)
+    logger.debug(f"####### {label}: {seconds:.3f}s, {cur.rowcount} rows #######")
+
+def collect_redshift_stats(cur):
+    """ Adds STL_LOAD_COMMITS and SVL_QUERY_SUMMARY figures to the recorded
+    statements, matched on query ID
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    """
+    if not _settings['redshift']:
+        return
+    with _lock:
+        by_id = {record['query_id']: record for record in _records if record['query_id']}
+    if not by_id:
+        return
+    try:
+        ids = ','.join(str(int(query_id)) for query_id in by_id)
+        cur.execute(f"""
+            SELECT  query, COUNT(DISTINCT filename), SUM(lines_scanned)
+            FROM    stl_load_commits
+            WHERE   query IN ({ids})
+            GROUP BY query;""")
+        for query_id, files, lines in cur.fetchall():
+            by_id[query_id].update({'files_loaded': files, 'lines_scanned': lines})
+        cur.execute(f"""
+            SELECT  query, SUM(rows), SUM(bytes), MAX(CASE WHEN is_diskbased = 't' THEN 1 ELSE 0 END)
+            FROM    svl_query_summary
+            WHERE   query IN ({ids})
+            GROUP BY query;""")
+        for query_id, rows, scanned_bytes, disk_based in cur.fetchall():
+            by_id[query_id].update({'step_rows': rows, 'step_bytes': scanned_bytes
+                                    ,'disk_based': bool(disk_based)})
+    except Exception as err:
+        logger.info(f"####### Could not collect Redshift stats: {err} #######")
+
+def write_metrics(metrics_dir):
+    """ Writes the recorded statements to a JSON file named after the run time
+
+    Args:
+    metrics_dir (str):[string representing path to write the metrics file to]
+
+    Returns:
+    path (str): [string representing path of the metrics file]
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, f"run-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json")
+    statements = records()
+    with open(path, 'w') as f:
+        json.dump({'total_seconds': sum(record['seconds'] for record in statements)
+                   ,'statements': statements}, f, indent=2, default=str)
+    logger.info(f"####### Metrics written to {path} #######")
+    return path
+
+def log_summary():
+    """ Logs a table of statements sorted by time, with each one's share of the run """
+    statements = sorted(records(), key=lambda record: record['seconds'], reverse=True)
+    total = sum(record['seconds'] for record in statements) or 1
+    logger.info(f"####### {'statement':<32} {'seconds':>9} {'share':>7} {'rows':>10} #######")
+    for record in statements:
+        logger.info(f"####### {record['label']:<32} {record['seconds']:>9.2f} "
+                    f"{record['seconds'] / total:>7.1%} {record['rowcount']:>10} #######")
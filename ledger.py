@@ -0,0 +1,134 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS FOR TRACKING WHICH S3 OBJECTS HAVE BEEN LOADED
+AND BUILDING COPY MANIFESTS WITH ONLY NEW OR CHANGED OBJECTS
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Staging tables loaded from new objects only. Staging tables are emptied
+# before every load and each new event is matched against all songs, so
+# staging_songs is always loaded from every object
+INCREMENTAL_TABLES = ['staging_events']
+
+# Suffix of the ledger entries listing the Parquet files loaded into a staging
+# table. They are kept apart from the converted sources ('<table>_parquet'), as
+# files are converted before the load and only recorded once it committed
+PARQUET_LOADED = '_parquet_loaded'
+
+def parse_s3_url(url):
+    """ Splits an S3 url, as written in dwh.cfg, into bucket and key prefix
+
+    Args:
+    url (str):[string representing an S3 url, e.g. 's3://udacity-dend/log_data']
+
+    Returns:
+    bucket (str): [string representing the bucket name]
+    prefix (str): [string representing the key prefix]
+    """
+    url = url.strip().strip("'\"")
+    bucket, _, prefix = url.replace('s3://', '', 1).partition('/')
+    return bucket, prefix
+
+def list_objects(s3, url):
+    """ Lists every object under an S3 prefix
+
+    Args:
+    s3 (obj):[Boto3 S3 client]
+    url (str):[string representing the S3 prefix to list]
+
+    Returns:
+    objects (dict): [object url mapped to its ETag and size]
+    """
+    bucket, prefix = parse_s3_url(url)
+    objects = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[f"s3://{bucket}/{obj['Key']}"] = {'etag': obj['ETag'].strip('"')
+                                                      ,'size': obj['Size']}
+    return objects
+
+def read_ledger(path):
+    """ Reads the ledger of loaded objects from a local JSON file
+
+    Args:
+    path (str):[string representing path to the ledger file]
+
+    Returns:
+    ledger (dict): [table name mapped to the objects already loaded into it]
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def write_ledger(path, ledger):
+    """ Writes the ledger of loaded objects to a local JSON file. The file is
+    replaced atomically, so an interrupted run never leaves a partial ledger
+
+    Args:
+    path (str):[string representing path to the ledger file]
+    ledger (dict):[table name mapped to the objects already loaded into it]
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(ledger, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def new_objects(objects, loaded):
+    """ Diffs the objects found in S3 against the ones already loaded
+
+    Args:
+    objects (dict):[objects listed by list_objects()]
+    loaded (dict):[objects recorded in the ledger for the same table]
+
+    Returns:
+    pending (dict): [objects that are new or whose ETag or size changed]
+    """
+    return {url: meta for url, meta in objects.items() if loaded.get(url) != meta}
+
+def build_manifest(objects):
+    """ Builds a COPY manifest listing the given objects
+
+    Args:
+    objects (dict):[object url mapped to its ETag and size]
+
+    Returns:
+    manifest (dict): [manifest in the format expected by COPY ... MANIFEST]
+    """
+    return {'entries': [{'url': url
+                         ,'mandatory': True
+                         ,'meta': {'content_length': meta['size']}}
+                        for url, meta in sorted(objects.items())]}
+
+def upload_manifest(s3, manifest, url):
+    """ Uploads a manifest to S3 so COPY can read it
+
+    Args:
+    s3 (obj):[Boto3 S3 client]
+    manifest (dict):[manifest built by build_manifest()]
+    url (str):[string representing the S3 url of the manifest]
+    """
+    bucket, key = parse_s3_url(url)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+
+def record_loaded(path, table, objects, reset=False):
+    """ Adds the objects just loaded into a table to the ledger
+
+    Args:
+    path (str):[string representing path to the ledger file]
+    table (str):[string representing the table the objects were loaded into]
+    objects (dict):[object url mapped to its ETag and size]
+    reset (bool):[forget what was loaded before, e.g. after the table was rebuilt]
+    """
+    ledger = read_ledger(path)
+    loaded = {} if reset else ledger.get(table, {})
+    loaded.update(objects)
+    ledger[table] = loaded
+    write_ledger(path, ledger)
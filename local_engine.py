@@ -0,0 +1,306 @@
+"""
+THIS MODULE INCLUDES AN IN-PROCESS ENGINE THAT BUILDS THE STAR SCHEMA FROM
+LOCAL LOG AND SONG JSON FILES, WITHOUT A REDSHIFT CLUSTER
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# Staging schemas, named and typed after the staging_events / staging_songs DDL
+STAGING_EVENTS_SCHEMA = pa.schema([
+    ('artist', pa.string())
+    ,('auth', pa.string())
+    ,('first_name', pa.string())
+    ,('gender', pa.string())
+    ,('item_in_session', pa.int32())
+    ,('last_name', pa.string())
+    ,('length', pa.float64())
+    ,('level', pa.string())
+    ,('location', pa.string())
+    ,('method', pa.string())
+    ,('page', pa.string())
+    ,('registration', pa.int64())
+    ,('session_id', pa.int32())
+    ,('song', pa.string())
+    ,('status', pa.int32())
+    ,('ts', pa.int64())
+    ,('user_agent', pa.string())
+    ,('user_id', pa.int32())
+])
+
+STAGING_SONGS_SCHEMA = pa.schema([
+    ('artist_id', pa.string())
+    ,('artist_latitude', pa.float64())
+    ,('artist_longitude', pa.float64())
+    ,('artist_location', pa.string())
+    ,('artist_name', pa.string())
+    ,('num_songs', pa.int32())
+    ,('song_id', pa.string())
+    ,('title', pa.string())
+    ,('duration', pa.float64())
+    ,('year', pa.int32())
+])
+
+# Source JSON field for each staging column (same mapping as log_json_path.json)
+LOG_FIELDS = {'artist': 'artist', 'auth': 'auth', 'first_name': 'firstName'
+              ,'gender': 'gender', 'item_in_session': 'itemInSession'
+              ,'last_name': 'lastName', 'length': 'length', 'level': 'level'
+              ,'location': 'location', 'method': 'method', 'page': 'page'
+              ,'registration': 'registration', 'session_id': 'sessionId'
+              ,'song': 'song', 'status': 'status', 'ts': 'ts'
+              ,'user_agent': 'userAgent', 'user_id': 'userId'}
+
+SONGPLAY_COLUMNS = ['start_time', 'user_id', 'level', 'song_id', 'artist_id'
+                    ,'session_id', 'location', 'user_agent']
+
+def iter_records(directory):
+    """ Streams JSON records from every .json file under a directory. Files
+    may hold one record per line (log_data) or a single record (song_data)
+
+    Args:
+    directory (str):[string representing path to the source directory]
+
+    Yields:
+    record (dict): [one parsed JSON record]
+    """
+    for root, _, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(root, name)) as f:
+                text = f.read()
+            try:
+                yield json.loads(text)
+            except json.JSONDecodeError:
+                for line in text.splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+def _blank_as_null(value):
+    """ Mirrors COPY ... BLANKSASNULL EMPTYASNULL for a single value """
+    if isinstance(value, str) and not value.strip():
+        return None
+    return value
+
+def read_batches(directory, schema, fields=None, batch_size=50000):
+    """ Parses JSON records into columnar batches typed after a staging schema
+
+    Args:
+    directory (str):[string representing path to the source directory]
+    schema (obj):[pyarrow schema of the staging table]
+    fields (dict):[staging column mapped to its JSON field. Defaults to same name]
+    batch_size (int):[number of records per batch]
+
+    Yields:
+    batch (obj): [pyarrow Table with at most batch_size rows]
+    """
+    fields = fields or {name: name for name in schema.names}
+    columns = {name: [] for name in schema.names}
+    rows = 0
+    for record in iter_records(directory):
+        for name in schema.names:
+            columns[name].append(_blank_as_null(record.get(fields[name])))
+        rows += 1
+        if rows == batch_size:
+            yield _to_table(columns, schema)
+            columns = {name: [] for name in schema.names}
+            rows = 0
+    if rows:
+        yield _to_table(columns, schema)
+
+def _to_table(columns, schema):
+    """ Builds a typed pyarrow Table from lists of raw JSON values """
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if pa.types.is_integer(field.type):
+            values = [None if v is None else int(float(v)) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def time_columns(start_time):
+    """ Extracts the time dimension columns from a timestamp array
+
+    Args:
+    start_time (obj):[pyarrow timestamp array]
+
+    Returns:
+    columns (dict): [column name mapped to pyarrow array]
+    """
+    return {'start_time': start_time
+            ,'hour': pc.hour(start_time)
+            ,'day': pc.day(start_time)
+            ,'week': pc.iso_week(start_time)
+            ,'month': pc.month(start_time)
+            ,'year': pc.year(start_time)
+            # Sunday = 0, as EXTRACT(DOW FROM ts)
+            ,'weekday': pc.day_of_week(start_time, count_from_zero=True, week_start=7)}
+
+def normalize(strings):
+    """ Lower-cases and trims strings, as song_match_key does before hashing """
+    return pc.utf8_lower(pc.utf8_trim_whitespace(strings))
+
+def distinct(table):
+    """ Returns the distinct rows of a table, like SELECT DISTINCT """
+    return table.group_by(table.column_names).aggregate([])
+
+def first_per_key(table, key, sort_keys):
+    """ Keeps one row per key, the first in sort_keys order, like
+    ROW_NUMBER() OVER (PARTITION BY key ORDER BY sort_keys) = 1
+
+    Args:
+    table (obj):[pyarrow table]
+    key (str):[name of the key column]
+    sort_keys (list):[(column, 'ascending' | 'descending') pairs ranking rows within a key]
+
+    Returns:
+    table (obj): [pyarrow table with one row per key]
+    """
+    table = table.sort_by([(key, 'ascending')] + sort_keys)
+    keys = table[key].combine_chunks()
+    if len(keys) < 2:
+        return table
+    changed = pc.fill_null(pc.not_equal(keys.slice(1), keys.slice(0, len(keys) - 1)), False)
+    return table.filter(pa.concat_arrays([pa.array([True]), changed]))
+
+class _Spill:
+    """
+    Hash-partitions rows to temporary Parquet files on an integer column,
+    so SELECT DISTINCT can run one partition at a time in bounded memory
+    """
+    def __init__(self, directory, name, key, partitions):
+        self.paths = [os.path.join(directory, f"{name}_{p}.parquet") for p in range(partitions)]
+        self.writers = [None] * partitions
+        self.key = key
+
+    def write(self, table):
+        if table.num_rows == 0:
+            return
+        key = pc.fill_null(pc.cast(table[self.key], pa.int64()), 0)
+        partition = pc.bit_wise_and(pc.abs(key), len(self.paths) - 1)
+        for p in range(len(self.paths)):
+            part = table.filter(pc.equal(partition, p))
+            if part.num_rows == 0:
+                continue
+            if self.writers[p] is None:
+                self.writers[p] = pq.ParquetWriter(self.paths[p], table.schema)
+            self.writers[p].write_table(part)
+
+    def partitions(self):
+        for p, writer in enumerate(self.writers):
+            if writer is not None:
+                writer.close()
+                yield pq.read_table(self.paths[p])
+
+def _write_distinct(spill, path, id_column=None, dedup=distinct):
+    """ Writes the distinct rows of every spilled partition to one Parquet
+    file, optionally numbering them like an IDENTITY(0,1) column. dedup
+    replaces SELECT DISTINCT, e.g. with first_per_key() """
+    writer, rows = None, 0
+    for part in spill.partitions():
+        part = dedup(part)
+        if id_column:
+            part = part.add_column(0, id_column, pa.array(range(rows, rows + part.num_rows), pa.int64()))
+        if writer is None:
+            writer = pq.ParquetWriter(path, part.schema)
+        writer.write_table(part)
+        rows += part.num_rows
+    if writer is not None:
+        writer.close()
+    return rows
+
+def build_star_schema(log_dir, song_dir, out_dir, batch_size=50000, partitions=16):
+    """ Builds songplay, users, songs, artists and time as Parquet files
+    from local log_data and song_data directories. Songs are kept in memory
+    for the join; events are streamed in batches and de-duplicated per
+    partition, so memory is bounded by batch size and partition size
+
+    Args:
+    log_dir (str):[string representing path to the log_data directory]
+    song_dir (str):[string representing path to the song_data directory]
+    out_dir (str):[string representing path to write the Parquet tables to]
+    batch_size (int):[number of records parsed per batch]
+    partitions (int):[number of spill partitions, a power of two]
+
+    Returns:
+    counts (dict): [number of rows written to each table]
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+
+    logger.info("####### Reading song data #######")
+    staging_songs = pa.concat_tables(list(read_batches(song_dir, STAGING_SONGS_SCHEMA, batch_size=batch_size))
+                                     or [STAGING_SONGS_SCHEMA.empty_table()])
+    songs = first_per_key(staging_songs.filter(pc.is_valid(staging_songs['song_id']))
+                          .select(['song_id', 'title', 'artist_id', 'year', 'duration'])
+                          ,'song_id', [('year', 'descending'), ('duration', 'descending')])
+    artists = first_per_key(staging_songs.filter(pc.is_valid(staging_songs['artist_id']))
+                            .select(['artist_id', 'artist_name', 'artist_location'
+                                     ,'artist_latitude', 'artist_longitude'])
+                            .rename_columns(['artist_id', 'name', 'location', 'latitude', 'longitue'])
+                            ,'artist_id', [('location', 'ascending'), ('name', 'ascending')])
+    pq.write_table(songs, os.path.join(out_dir, 'songs.parquet'))
+    pq.write_table(artists, os.path.join(out_dir, 'artists.parquet'))
+    counts['songs'], counts['artists'] = songs.num_rows, artists.num_rows
+    song_lookup = pa.table({'match_title': normalize(staging_songs['title'])
+                            ,'match_artist': normalize(staging_songs['artist_name'])
+                            ,'song_id': staging_songs['song_id']
+                            ,'artist_id': staging_songs['artist_id']})
+
+    spill_dir = tempfile.mkdtemp(prefix='sparkify_spill_')
+    try:
+        songplay_spill = _Spill(spill_dir, 'songplay', 'start_time', partitions)
+        users_spill = _Spill(spill_dir, 'users', 'user_id', partitions)
+        time_spill = _Spill(spill_dir, 'time', 'start_time', partitions)
+
+        logger.info("####### Streaming log data #######")
+        for events in read_batches(log_dir, STAGING_EVENTS_SCHEMA, LOG_FIELDS, batch_size):
+            events = events.set_column(events.schema.get_field_index('ts'), 'ts'
+                                       ,pc.cast(events['ts'], pa.timestamp('ms')))
+            known_users = events.filter(pc.is_valid(events['user_id']))
+            users_spill.write(known_users.select(['user_id', 'first_name', 'last_name', 'gender', 'level', 'ts']))
+
+            plays = known_users.filter(pc.equal(known_users['page'], 'NextSong'))
+            plays = plays.append_column('match_title', normalize(plays['song']))
+            plays = plays.append_column('match_artist', normalize(plays['artist']))
+            plays = plays.join(song_lookup, keys=['match_title', 'match_artist'], join_type='inner')
+            plays = plays.rename_columns(['start_time' if c == 'ts' else c for c in plays.column_names])
+            songplay_spill.write(plays.select(SONGPLAY_COLUMNS))
+            # Like time_table_insert, time only holds the start times of songplays
+            time_spill.write(pa.table(time_columns(plays['start_time'])))
+
+        logger.info("####### Writing analytics tables #######")
+        counts['songplay'] = _write_distinct(songplay_spill, os.path.join(out_dir, 'songplay.parquet'), 'songplay_id')
+        # Users keep their latest event, like user_table_insert
+        counts['users'] = _write_distinct(users_spill, os.path.join(out_dir, 'users.parquet')
+                                          ,dedup=lambda part: first_per_key(part, 'user_id', [('ts', 'descending')])
+                                                              .drop_columns(['ts']))
+        counts['time'] = _write_distinct(time_spill, os.path.join(out_dir, 'time.parquet'), 'time_id')
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    for table, rows in counts.items():
+        logger.info(f"####### {table}: {rows} rows #######")
+    return counts
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Builds the star schema locally as Parquet")
+    parser.add_argument('log_dir')
+    parser.add_argument('song_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--partitions', type=int, default=16)
+    args = parser.parse_args()
+    build_star_schema(args.log_dir, args.song_dir, args.out_dir, args.batch_size, args.partitions)
@@ -0,0 +1,270 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS THAT CONVERT THE SOURCE JSON INTO TYPED
+PARQUET, SO THE STAGING TABLES CAN BE LOADED WITH COPY ... FORMAT AS PARQUET
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import ledger
+import schema
+from local_engine import iter_records, LOG_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Source JSON field of each staging column. Staging songs use the column names
+SOURCE_FIELDS = {'staging_events': LOG_FIELDS, 'staging_songs': {}}
+
+# Width Redshift gives a VARCHAR declared without one, in bytes
+DEFAULT_VARCHAR_BYTES = 256
+
+# Rows parsed before a row group is written, and rows per Parquet file. Files
+# are loaded in parallel, one per slice, so keep at least one per slice
+BATCH_ROWS = 50000
+ROWS_PER_FILE = 1000000
+
+def arrow_type(sql_type):
+    """ Maps a column type of schema.py to the Parquet type COPY loads into it
+
+    Args:
+    sql_type (str):[string representing the Redshift data type, e.g. 'VARCHAR(30)']
+
+    Returns:
+    type (obj): [pyarrow data type]
+    """
+    base = sql_type.split('(')[0].upper()
+    if base in ('VARCHAR', 'CHAR'):
+        return pa.string()
+    if base == 'INT':
+        return pa.int32()
+    if base == 'BIGINT':
+        return pa.int64()
+    if base == 'TIMESTAMP':
+        return pa.timestamp('us')
+    if base == 'DECIMAL':
+        # DECIMAL without precision and scale is DECIMAL(18,0) in Redshift
+        precision, scale = re.findall(r'\d+', sql_type) or (18, 0)
+        return pa.decimal128(int(precision), int(scale))
+    raise ValueError(f"No Parquet type for {sql_type}")
+
+def arrow_schema(table):
+    """ Builds the Parquet schema of a staging table from its DDL in schema.py,
+    with the columns in table order so COPY needs no column list """
+    return pa.schema([(name, arrow_type(sql_type)) for name, sql_type, _, _ in schema.TABLES[table]['columns']])
+
+def _width(sql_type):
+    """ Gets the width in bytes of a VARCHAR or CHAR column """
+    width = re.findall(r'\d+', sql_type)
+    return int(width[0]) if width else DEFAULT_VARCHAR_BYTES
+
+def _truncate(value, width):
+    """ Mirrors COPY ... TRUNCATECOLUMNS, cutting a string to width bytes
+    without splitting a multibyte character """
+    encoded = value.encode('utf-8')
+    return value if len(encoded) <= width else encoded[:width].decode('utf-8', 'ignore')
+
+def _key(value):
+    """ Normalizes a title or artist name, as LOWER(TRIM(...)) does """
+    return value.strip(' ').lower()
+
+def song_match_key(table, row):
+    """ Computes song_match_key as the match key updates in sql_queries.py do.
+    Keys of rows that can't match only need to be unique, so they spread
+    evenly across slices
+
+    Args:
+    table (str):[staging table, staging_events or staging_songs]
+    row (dict):[staging column mapped to its parsed value]
+
+    Returns:
+    key (str): [MD5 hex digest]
+    """
+    if table == 'staging_events':
+        if row['song'] is None or row['artist'] is None:
+            text = (f"unmatched|{row['ts']}|{row['session_id'] or 0}|{row['item_in_session'] or 0}")
+        else:
+            text = f"{_key(row['song'])}|{_key(row['artist'])}"
+    elif row['title'] is None or row['artist_name'] is None:
+        text = f"unmatched|{row['song_id']}"
+    else:
+        text = f"{_key(row['title'])}|{_key(row['artist_name'])}"
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def _parse(value, sql_type):
+    """ Parses a raw JSON value the way COPY ... FORMAT AS json would, with
+    blanks as NULL, epoch milliseconds for timestamps and truncated strings """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    base = sql_type.split('(')[0].upper()
+    if base in ('VARCHAR', 'CHAR'):
+        return _truncate(str(value), _width(sql_type))
+    if base in ('INT', 'BIGINT'):
+        return int(float(value))
+    if base == 'TIMESTAMP':
+        return datetime.fromtimestamp(int(value) / 1000, timezone.utc).replace(tzinfo=None)
+    return float(value)
+
+def to_batch(records, table):
+    """ Converts parsed JSON records into a typed batch of a staging table
+
+    Args:
+    records (list):[JSON records as dicts]
+    table (str):[staging table, staging_events or staging_songs]
+
+    Returns:
+    batch (obj): [pyarrow Table typed after arrow_schema(table)]
+    """
+    fields = SOURCE_FIELDS[table]
+    columns = [column for column in schema.TABLES[table]['columns'] if column[0] != 'song_match_key']
+    rows = []
+    for record in records:
+        row = {name: _parse(record.get(fields.get(name, name)), sql_type) for name, sql_type, _, _ in columns}
+        row['song_match_key'] = song_match_key(table, row)
+        rows.append(row)
+    arrays = []
+    for field in arrow_schema(table):
+        values = [row[field.name] for row in rows]
+        if pa.types.is_decimal(field.type):
+            # Rounded half away from zero, as Redshift does when it narrows a number
+            arrays.append(pc.round(pa.array(values, type=pa.float64()), field.type.scale
+                                   ,round_mode='half_towards_infinity').cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=arrow_schema(table))
+
+def convert_records(records, table, out_dir, on_part=None, prefix='part'
+                    ,batch_rows=BATCH_ROWS, rows_per_file=ROWS_PER_FILE):
+    """ Streams JSON records into Parquet files. Only one batch of records is
+    held in memory at a time; each batch is written as a row group
+
+    Args:
+    records (iter):[JSON records as dicts]
+    table (str):[staging table, staging_events or staging_songs]
+    out_dir (str):[string representing path to write the Parquet files to]
+    on_part (func):[called with the path of every file once it is closed, e.g. to upload it]
+    prefix (str):[file name prefix, e.g. to keep files of different runs apart]
+    batch_rows (int):[records per row group]
+    rows_per_file (int):[records per file]
+
+    Returns:
+    paths (list): [paths of the Parquet files written]
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths, batch, writer, written = [], [], None, 0
+
+    def flush():
+        nonlocal writer, written
+        if writer is None:
+            paths.append(os.path.join(out_dir, f"{prefix}-{len(paths):05d}.parquet"))
+            writer = pq.ParquetWriter(paths[-1], arrow_schema(table))
+        writer.write_table(to_batch(batch, table))
+        written += len(batch)
+        batch.clear()
+        if written >= rows_per_file:
+            close()
+
+    def close():
+        nonlocal writer, written
+        if writer is not None:
+            writer.close()
+            writer, written = None, 0
+            if on_part:
+                on_part(paths[-1])
+
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_rows or written + len(batch) == rows_per_file:
+            flush()
+    if batch:
+        flush()
+    close()
+    return paths
+
+def iter_object_records(s3, urls):
+    """ Streams JSON records from S3 objects, one object in memory at a time.
+    Objects may hold one record per line (log_data) or a single record (song_data)
+
+    Args:
+    s3 (obj):[Boto3 S3 client for the source bucket]
+    urls (list):[S3 urls of the objects]
+
+    Yields:
+    record (dict): [one parsed JSON record]
+    """
+    for url in urls:
+        bucket, key = ledger.parse_s3_url(url)
+        text = s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+        try:
+            yield json.loads(text)
+        except json.JSONDecodeError:
+            for line in text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+def convert_sources(s3, db_config, reset=False):
+    """ Converts the S3 sources of both staging tables into Parquet under
+    parquet_prefix. Conversions are kept in the ledger, so only new objects
+    are converted on later runs. When a converted object changed or is gone,
+    the table is converted again from scratch
+
+    Args:
+    s3 (obj):[Boto3 S3 client for the source and Parquet buckets]
+    db_config (dict):[dictionary containing database configuration]
+    reset (bool):[convert everything again]
+
+    Returns:
+    parts (dict): [staging table mapped to the Parquet files written by this run, with ETag and size]
+    """
+    parts = {}
+    for table, source in [('staging_events', db_config['s3_log_data'])
+                          ,('staging_songs', db_config['s3_song_data'])]:
+        objects = ledger.list_objects(s3, source)
+        done = {} if reset else ledger.read_ledger(db_config['ledger_path']).get(f"{table}_parquet", {})
+        if any(objects.get(url) != meta for url, meta in done.items()):
+            logger.info(f"####### Converted sources of {table} changed. Converting all again #######")
+            done = {}
+        pending = ledger.new_objects(objects, done)
+        dest = f"{db_config['s3_parquet_prefix'].rstrip('/')}/{table}"
+        if not done:
+            for url in ledger.list_objects(s3, dest + '/'):
+                bucket, key = ledger.parse_s3_url(url)
+                s3.delete_object(Bucket=bucket, Key=key)
+        parts[table] = {}
+        if not pending:
+            logger.info(f"####### No new objects to convert for {table} #######")
+            continue
+        logger.info(f"####### Converting {len(pending)} of {len(objects)} objects of {table} to Parquet #######")
+        run = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+
+        def upload(path):
+            url = f"{dest}/{os.path.basename(path)}"
+            bucket, key = ledger.parse_s3_url(url)
+            s3.upload_file(path, bucket, key)
+            etag = s3.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+            parts[table][url] = {'etag': etag, 'size': os.path.getsize(path)}
+            os.remove(path)
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            convert_records(iter_object_records(s3, sorted(pending)), table, out_dir, upload, prefix=run)
+        ledger.record_loaded(db_config['ledger_path'], f"{table}_parquet", pending, reset=not done)
+    return parts
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Converts local log or song JSON files to staging table Parquet")
+    parser.add_argument('source_dir', help="directory holding the JSON files")
+    parser.add_argument('table', choices=list(SOURCE_FIELDS))
+    parser.add_argument('out_dir')
+    args = parser.parse_args()
+    for path in convert_records(iter_records(args.source_dir), args.table, args.out_dir):
+        logger.info(f"####### Wrote {path} #######")
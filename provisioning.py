@@ -0,0 +1,208 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS THAT PROVISION THE IAM ROLE, REDSHIFT CLUSTER
+AND NETWORK ACCESS CONCURRENTLY, AS A TASK GRAPH
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import random
+import logging
+from time import sleep, monotonic
+from configparser import ConfigParser
+from aws_functions import IAM_role, Redshift_cluster, Connect_cluster
+from scheduler import Node, run_graph
+import cluster_planner
+import ledger
+
+logger = logging.getLogger(__name__)
+
+def wait_for_cluster(redshift, cluster_identifier, initial_delay=5, max_delay=20
+                     ,timeout=1800, sleep=sleep):
+    """ Polls describe_clusters until the cluster is available. The delay
+    between polls grows exponentially (with jitter) up to max_delay, and goes
+    back to initial_delay whenever the status changes, since a change usually
+    means the cluster is close to ready
+
+    Args:
+    redshift (obj):[Object representing Redshift Client]
+    cluster_identifier (str):[string representing the cluster identifier]
+    initial_delay (float):[seconds to wait after the first poll]
+    max_delay (float):[upper bound, in seconds, for the wait between polls]
+    timeout (float):[seconds after which to give up]
+    sleep (obj):[function used to wait, replaceable in tests]
+
+    Returns:
+    cluster_props (dict): [properties of the available cluster]
+    """
+    deadline = monotonic() + timeout
+    delay, last_status = initial_delay, None
+    while True:
+        cluster_props = redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
+        status = cluster_props['ClusterStatus'].lower()
+        if status == 'available' and 'Endpoint' in cluster_props:
+            logger.info(f"####### Cluster is now live. Status {status} #######")
+            return cluster_props
+        if monotonic() > deadline:
+            raise TimeoutError(f"Cluster {cluster_identifier} still {status} after {timeout}s")
+        if status != last_status:
+            delay, last_status = initial_delay, status
+        logger.info(f"####### Cluster status is {status}. Checking again in {delay:.0f}s #######")
+        sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, max_delay)
+
+def validate_s3_sources(s3, urls):
+    """ Checks that every S3 source prefix holds at least one object, so a
+    wrong path fails before the load instead of after the cluster is up
+
+    Args:
+    s3 (obj):[Boto3 S3 client for the source bucket]
+    urls (list):[S3 urls of the source prefixes and files]
+    """
+    for url in urls:
+        bucket, prefix = ledger.parse_s3_url(url)
+        if not s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get('KeyCount'):
+            raise ValueError(f"No objects found under {url}")
+        logger.info(f"####### Found source {url} #######")
+
+def create_role(iam, db_config, config_path='config/dwh.cfg'):
+    """ Creates the IAM role, attaches its policy and stores its ARN in
+    db_config and in the config file
+
+    Args:
+    iam (obj):[IAM client]
+    db_config (dict):[dictionary containing database configuration]
+    config_path (str):[string representing path to the config file]
+
+    Returns:
+    role_arn (str): [string representing the role ARN]
+    """
+    IAM_role.create_role(iam,db_config['db_iam_role_name'])
+    IAM_role.attach_policy(iam,db_config['db_iam_role_name'])
+    role_arn = IAM_role.get_role_arn(iam,db_config['db_iam_role_name'])
+    db_config['iam_role_arn'] = role_arn
+    edit = ConfigParser()
+    edit.read(config_path)
+    edit['IAM_ROLE']['arn'] = role_arn
+    with open(config_path,'w') as f:
+        edit.write(f)
+    logger.info(f"####### iam_role_arn : {role_arn} #######")
+    return role_arn
+
+def check_lifecycle(db_config):
+    """ Rejects a lifecycle_mode and teardown_mode pair that would delete a
+    warm cluster the run only attached to or resumed
+
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+    """
+    if db_config['lifecycle_mode'] in ('attach', 'resume') and db_config['teardown_mode'] in ('delete', 'snapshot'):
+        raise ValueError(f"lifecycle_mode = {db_config['lifecycle_mode']} reuses a warm cluster, but "
+                         f"teardown_mode = {db_config['teardown_mode']} deletes it. Use keep or pause")
+
+def start_cluster(redshift, db_config):
+    """ Gets a cluster ready to boot according to lifecycle_mode. An existing
+    cluster is always reused. When there is none, 'attach' and 'resume' fail,
+    'restore' restores the latest snapshot (creating a new cluster if there is
+    no snapshot) and 'create' creates a new cluster
+
+    Args:
+    redshift (obj):[Object representing Redshift Client]
+    db_config (dict):[dictionary containing database configuration]
+    """
+    mode = db_config['lifecycle_mode']
+    cluster_props = Redshift_cluster.describe_cluster(redshift,db_config['cluster_identifier'])
+    if cluster_props is not None:
+        status = cluster_props['ClusterStatus'].lower()
+        logger.info(f"####### Reusing existing cluster. Status {status} #######")
+        if status == 'paused':
+            if mode == 'attach':
+                raise ValueError("Cluster is paused. Set lifecycle_mode = resume to resume it")
+            Redshift_cluster.resume_cluster(redshift,db_config['cluster_identifier'])
+        return
+    if mode in ('attach', 'resume'):
+        raise ValueError(f"Cluster {db_config['cluster_identifier']} not found. Set lifecycle_mode = create or restore")
+    if mode == 'restore':
+        snapshot_identifier = Redshift_cluster.latest_snapshot(redshift,db_config['cluster_identifier'])
+        if snapshot_identifier is not None:
+            Redshift_cluster.restore_cluster(redshift,db_config,snapshot_identifier)
+            return
+        logger.info("####### No snapshot to restore from. Creating a new cluster #######")
+    Redshift_cluster.create_cluster(redshift,db_config)
+
+def teardown(db_config, iam, redshift):
+    """ Releases the cluster according to teardown_mode: 'delete' deletes it,
+    'snapshot' deletes it after a final snapshot, 'pause' pauses it and
+    'keep' leaves it running. The IAM role is only deleted with the cluster
+
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+    iam (obj):[IAM client]
+    redshift (obj):[Object representing Redshift Client]
+    """
+    mode = db_config['teardown_mode']
+    if mode == 'keep':
+        logger.info("####### Leaving Redshift Cluster running #######")
+        return
+    if mode == 'pause':
+        Redshift_cluster.pause_cluster(redshift,db_config['cluster_identifier'])
+        return
+    Redshift_cluster.delete_cluster(redshift,db_config['cluster_identifier'],final_snapshot=mode == 'snapshot')
+    IAM_role.delete_role(iam,db_config['db_iam_role_name'])
+
+def provision(db_config, iam, redshift, ec2, s3=None, sleep=sleep):
+    """ Provisions everything the ETL needs, reusing, resuming or restoring
+    the cluster as set by lifecycle_mode. Independent steps overlap:
+    the security group lookup and S3 source checks run while the role is
+    created and the cluster boots. With size_cluster, a cluster created by
+    the run is sized for its sources by cluster_planner.py. db_config is
+    updated with the role ARN, cluster endpoint and cluster role ARN
+
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+    iam (obj):[IAM client]
+    redshift (obj):[Object representing Redshift Client]
+    ec2 (obj):[Boto3 ec2 object]
+    s3 (obj):[Boto3 S3 client for the source bucket. Sources are not checked when None]
+    sleep (obj):[function used to wait between cluster polls, replaceable in tests]
+
+    Returns:
+    cluster_props (dict): [properties of the available cluster]
+    """
+    check_lifecycle(db_config)
+    state = {}
+
+    def wait_cluster():
+        state['cluster_props'] = wait_for_cluster(redshift, db_config['cluster_identifier'], sleep=sleep)
+
+    def open_port():
+        cluster_props = state['cluster_props']
+        security_group = state['security_group']
+        vpc_id = cluster_props.get('VpcId')
+        if vpc_id and security_group.vpc_id != vpc_id:
+            security_group = None
+        Connect_cluster.attach_security_group(ec2,cluster_props,db_config,security_group)
+
+    nodes = [Node('iam_role', lambda: create_role(iam, db_config), [], ['role_arn'])
+             ,Node('security_group', lambda: state.update(security_group=Connect_cluster.get_security_group(ec2))
+                   ,[], ['security_group'])
+             ,Node('start_cluster', lambda: start_cluster(redshift, db_config), ['role_arn', 'cluster_size'], ['cluster'])
+             ,Node('wait_cluster', wait_cluster, ['cluster'], ['cluster_props'])
+             ,Node('open_port', open_port, ['cluster_props', 'security_group'], ['ingress'])]
+    if s3 is not None:
+        nodes.insert(1, Node('s3_sources'
+                             ,lambda: validate_s3_sources(s3, [db_config['s3_log_data']
+                                                               ,db_config['s3_log_metadata']
+                                                               ,db_config['s3_song_data']])
+                             ,[], ['s3_sources']))
+        if db_config['size_cluster'] and db_config['lifecycle_mode'] in ('create', 'restore'):
+            # Only used when a new cluster gets created
+            nodes.insert(2, Node('size_cluster', lambda: cluster_planner.size_cluster(s3, db_config)
+                                 ,['s3_sources'], ['cluster_size']))
+    run_graph(nodes, max_workers=len(nodes))
+
+    cluster_props = state['cluster_props']
+    # Gets end point to be used for connection. Update db_config
+    db_config['db_host'] = cluster_props['Endpoint']['Address']
+    # Gets Redshift Cluster IAM Role ARN. Update db_config
+    db_config['db_iam_role_arn'] = cluster_props['IamRoles'][0]['IamRoleArn']
+    return cluster_props
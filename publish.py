@@ -0,0 +1,188 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS THAT BUILD THE ANALYTICS TABLES AS SHADOW
+TABLES AND PUBLISH THEM WITH AN ATOMIC RENAME, SO READERS NEVER SEE A
+PARTIAL LOAD
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import re
+import logging
+from scheduler import run_graph
+from sql_queries import insert_table_queries, insert_table_names
+from sql_queries import rollup_table_queries, rollup_table_names, load_watermark_update
+from sql_queries import load_versions_update, table_counts_test, data_validation_checks
+from etl import table_name, registry_node
+from aws_functions import Data_validation
+import instrumentation
+import query_registry
+import sql_queries
+
+logger = logging.getLogger(__name__)
+
+# Tables rebuilt as <table>_shadow and swapped in together. load_versions is
+# left out: versions are written in the swap transaction itself
+PUBLISHED_TABLES = ['songplay', 'users', 'songs', 'artists', 'time', 'load_watermark'
+                    ,'song_plays_daily', 'level_users_hourly', 'artist_plays_weekly']
+SHADOW_SUFFIX = '_shadow'
+OLD_SUFFIX = '_old'
+
+_table_reference = re.compile(r'\b(INTO|FROM|JOIN|TABLE|UPDATE)(\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?)('
+                              + '|'.join(PUBLISHED_TABLES) + r')\b', re.IGNORECASE)
+
+def shadow_sql(query):
+    """ Points a statement at the shadow tables, replacing every published
+    table name that follows INTO, FROM, JOIN, TABLE or UPDATE
+
+    Args:
+    query (str):[string representing the SQL statement]
+
+    Returns:
+    query (str): [string representing the statement over the shadow tables]
+    """
+    return _table_reference.sub(lambda match: match.group(1) + match.group(2)
+                                + match.group(3).lower() + SHADOW_SUFFIX, query)
+
+def _without_versions(queries):
+    """ Leaves out load_versions writes, which only happen when tables are published """
+    return [query for query in queries if table_name(query) != 'load_versions']
+
+def table_name_of_create(query):
+    """ Gets the table name of a CREATE TABLE statement """
+    return re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', query, re.IGNORECASE).group(1)
+
+def create_shadow_tables(cur, conn):
+    """ Drops shadow tables left by an earlier run and creates them empty
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        logger.info("####### Creating Shadow Tables #######")
+        creates = {table_name_of_create(query): query for query in sql_queries.create_table_queries}
+        for table in PUBLISHED_TABLES:
+            instrumentation.execute(cur, f"DROP TABLE IF EXISTS {table}{SHADOW_SUFFIX};")
+            instrumentation.execute(cur, shadow_sql(creates[table]))
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        logger.exception(err)
+        raise(err)
+
+def insert_shadow_tables(cur, conn):
+    """ Builds every shadow table from the staging tables: analytics tables,
+    high-water mark and rollups, each statement committed as it completes
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        queries = (insert_table_queries + [load_watermark_update]
+                   + [query for queries in rollup_table_queries for query in _without_versions(queries)])
+        i = 1
+        for query in queries:
+            logger.info(f"####### Building shadow {i} of {len(queries)} #######")
+            instrumentation.execute(cur, shadow_sql(query))
+            conn.commit()
+            i += 1
+    except Exception as err:
+        conn.rollback()
+        logger.exception(err)
+        raise(err)
+
+def insert_shadow_tables_parallel(pool, max_workers):
+    """ Same as insert_shadow_tables(), running statements that don't depend
+    on each other concurrently on pooled connections
+
+    Args:
+    pool (obj):[object connection pool, e.g. connections.Connection_manager]
+    max_workers (int):[maximum number of statements running at once, e.g. WLM slots]
+
+    Returns:
+    timings (dict): [seconds taken to build each shadow table]
+    """
+    try:
+        steps = ([[name] for name in insert_table_names] + [['load_watermark_update']]
+                 + [[name for name in names if 'load_versions' not in query_registry.get(name).outputs]
+                    for names in rollup_table_names])
+        nodes = [registry_node(pool, names, render=shadow_sql) for names in steps]
+        for node in nodes:
+            node.name += SHADOW_SUFFIX
+            # The high-water mark is read by the time insert, so it's only moved after it
+            if node.outputs == ['load_watermark']:
+                node.inputs = node.inputs + ['time']
+        return run_graph(nodes, max_workers)
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
+
+def validate_shadow_tables(cur, conn, max_null_rate=0.05):
+    """ Runs the data validation checks against the shadow tables
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    max_null_rate (float):[highest share of NULLs accepted in checked columns]
+
+    Returns:
+    results (list): [result of every check, as returned by Data_validation.run_check()]
+    """
+    instrumentation.execute(cur, shadow_sql(table_counts_test), label='VALIDATION shadow table_counts')
+    empty = [table for table, rows in cur.fetchall() if table in ('songplay', 'users', 'songs', 'artists', 'time') and not rows]
+    results = [{'check': 'table_counts', 'status': 'fail' if empty else 'pass'
+                ,'values': {f"empty_{table}": 1.0 for table in empty}, 'threshold': 0}]
+    for name, query, kind in data_validation_checks:
+        results.append(Data_validation.run_check(cur, (name, shadow_sql(query), kind), max_null_rate))
+    conn.rollback()
+    return results
+
+def swap_tables(cur, conn):
+    """ Publishes the shadow tables in a single transaction: each live table
+    is renamed away, its shadow takes its name and a new load version is
+    written. Readers see either the old tables or the new ones. The old
+    tables are dropped once the swap is committed
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        logger.info("####### Swapping in Shadow Tables #######")
+        for table in PUBLISHED_TABLES:
+            instrumentation.execute(cur, f"DROP TABLE IF EXISTS {table}{OLD_SUFFIX};")
+            instrumentation.execute(cur, f"ALTER TABLE {table} RENAME TO {table}{OLD_SUFFIX};")
+            instrumentation.execute(cur, f"ALTER TABLE {table}{SHADOW_SUFFIX} RENAME TO {table};")
+        instrumentation.execute(cur, load_versions_update)
+        for queries in rollup_table_queries:
+            for query in queries:
+                if table_name(query) == 'load_versions':
+                    instrumentation.execute(cur, query)
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        logger.exception(err)
+        raise(err)
+    for table in PUBLISHED_TABLES:
+        instrumentation.execute(cur, f"DROP TABLE IF EXISTS {table}{OLD_SUFFIX};")
+    conn.commit()
+
+def publish_tables(cur, conn, max_null_rate=0.05):
+    """ Validates the shadow tables and swaps them in. When a check doesn't
+    pass, the shadow tables are dropped and the live tables are left as they were
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    max_null_rate (float):[highest share of NULLs accepted in checked columns]
+    """
+    results = validate_shadow_tables(cur, conn, max_null_rate)
+    failed = [result['check'] for result in results if result['status'] != 'pass']
+    if failed:
+        for table in PUBLISHED_TABLES:
+            instrumentation.execute(cur, f"DROP TABLE IF EXISTS {table}{SHADOW_SUFFIX};")
+        conn.commit()
+        raise ValueError(f"Shadow tables failed validation ({', '.join(failed)}). Live tables left unchanged")
+    logger.info("####### Shadow tables passed validation #######")
+    swap_tables(cur, conn)
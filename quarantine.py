@@ -0,0 +1,149 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS FOR TOLERANT COPYS, WHICH READ BACK THE RECORDS
+REDSHIFT REJECTED, QUARANTINE THEM WITH THEIR FILES AND RETRY THE FILES THAT
+MADE A COPY FAIL ON THEIR OWN
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import json
+import logging
+from datetime import datetime, timezone
+import psycopg2
+import ledger
+import query_registry
+import instrumentation
+from sql_queries import load_errors_last_query, load_errors_select
+
+logger = logging.getLogger(__name__)
+
+# Highest MAXERROR Redshift takes. Files that made a COPY fail are retried with
+# it, so only a file that is nearly all bad records fails again
+RETRY_MAX_ERRORS = 100000
+
+# Columns of load_errors_select, in order
+LOAD_ERROR_FIELDS = ['query', 'filename', 'line_number', 'colname', 'err_code'
+                     ,'err_reason', 'raw_field_value', 'raw_line']
+
+def quarantine_prefix(db_config):
+    """ Gets the S3 prefix bad records and files are written to. Defaults to
+    quarantine/ under manifest_prefix
+
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+
+    Returns:
+    prefix (str): [string representing the S3 quarantine prefix]
+    """
+    prefix = db_config['s3_quarantine_prefix'] or f"{db_config['s3_manifest_prefix'].rstrip('/')}/quarantine"
+    return prefix.strip().strip("'\"").rstrip('/')
+
+def last_error_query(cur):
+    """ Gets the latest query id this session logged to STL_LOAD_ERRORS, 0 when none """
+    instrumentation.execute(cur, load_errors_last_query)
+    return cur.fetchone()[0]
+
+def read_load_errors(cur, after):
+    """ Reads the records rejected by COPYs of this session
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    after (int):[only errors of queries after this id are read, see last_error_query()]
+
+    Returns:
+    errors (list): [one dict per rejected record, keyed by LOAD_ERROR_FIELDS]
+    """
+    instrumentation.execute(cur, load_errors_select, params={'after': after})
+    return [dict(zip(LOAD_ERROR_FIELDS, row)) for row in cur.fetchall()]
+
+def quarantine(s3, prefix, table, errors, files):
+    """ Writes rejected records, one JSON object per line, and copies the files
+    they came from under prefix/table/<run timestamp>/
+
+    Args:
+    s3 (obj):[Boto3 S3 client for the source and quarantine buckets]
+    prefix (str):[string representing the S3 quarantine prefix]
+    table (str):[staging table the records were loaded into]
+    errors (list):[rejected records, as returned by read_load_errors()]
+    files (list):[S3 urls of the files to quarantine]
+
+    Returns:
+    dest (str): [string representing the S3 prefix the run was quarantined under]
+    """
+    dest = f"{prefix}/{table}/{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}"
+    bucket, key = ledger.parse_s3_url(f"{dest}/errors.json")
+    body = ''.join(json.dumps(error, default=str) + '\n' for error in errors)
+    s3.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    for url in sorted(files):
+        source_bucket, source_key = ledger.parse_s3_url(url)
+        bucket, key = ledger.parse_s3_url(f"{dest}/files/{source_bucket}/{source_key}")
+        s3.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': source_bucket, 'Key': source_key})
+    logger.info(f"####### Quarantined {len(errors)} records from {len(files)} files of {table} under {dest} #######")
+    return dest
+
+def copy_with_quarantine(cur, conn, s3, table, objects, manifest_url, copy_name, params, prefix):
+    """ Loads objects through a manifest COPY, quarantining bad records. When
+    the COPY fails on more errors than its MAXERROR, it is rolled back and run
+    again without the files that had errors. Those files are then loaded on
+    their own, in the same transaction, through a manifest listing only them
+    and with RETRY_MAX_ERRORS, so their good records load and every bad one
+    is quarantined. Records skipped under MAXERROR are quarantined too. A
+    retry that still fails raises, so no file is left half loaded. The caller
+    commits
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    s3 (obj):[Boto3 S3 client for the source, manifest and quarantine buckets]
+    table (str):[staging table to load]
+    objects (dict):[object url mapped to its ETag and size]
+    manifest_url (str):[string representing the S3 url to write the manifest to]
+    copy_name (str):[name of the registered manifest COPY]
+    params (dict):[parameters of the COPY but the manifest url]
+    prefix (str):[string representing the S3 quarantine prefix]
+
+    Returns:
+    quarantined (dict): [objects with rejected records. Their other records are loaded]
+    """
+    pending, retry, quarantined = dict(objects), {}, {}
+    query = query_registry.render(copy_name, manifest_url=manifest_url, **params)
+    while pending:
+        ledger.upload_manifest(s3, ledger.build_manifest(pending), manifest_url)
+        after = last_error_query(cur)
+        try:
+            instrumentation.execute(cur, query)
+        except psycopg2.Error:
+            conn.rollback()
+            bad = {error['filename'] for error in read_load_errors(cur, after)} & set(pending)
+            if not bad:
+                # Not a load error, e.g. missing permissions. Nothing to retry without
+                raise
+            retry.update({url: pending.pop(url) for url in bad})
+            logger.info(f"####### COPY into {table} failed on {len(bad)} files. "
+                        f"Loading the other {len(pending)} first #######")
+            continue
+        quarantined.update(_quarantine_errors(cur, s3, prefix, table, pending, after))
+        break
+    if retry:
+        logger.info(f"####### Retrying {len(retry)} files of {table} on their own #######")
+        retry_url = f"{manifest_url.rsplit('.manifest', 1)[0]}_retry.manifest"
+        ledger.upload_manifest(s3, ledger.build_manifest(retry), retry_url)
+        after = last_error_query(cur)
+        instrumentation.execute(cur, query_registry.render(copy_name, manifest_url=retry_url
+                                                           ,**{**params, 'maxerror': f" MAXERROR {RETRY_MAX_ERRORS}"}))
+        quarantined.update(_quarantine_errors(cur, s3, prefix, table, retry, after))
+    return quarantined
+
+def _quarantine_errors(cur, s3, prefix, table, objects, after):
+    """ Quarantines the records the last COPY of objects skipped
+
+    Returns:
+    quarantined (dict): [objects with skipped records]
+    """
+    errors = read_load_errors(cur, after)
+    if not errors:
+        return {}
+    bad = {error['filename'] for error in errors} & set(objects)
+    logger.info(f"####### COPY into {table} skipped {len(errors)} bad records #######")
+    quarantine(s3, prefix, table, errors, bad)
+    return {url: objects[url] for url in bad}
@@ -0,0 +1,129 @@
+"""
+THIS MODULE INCLUDES A REGISTRY OF NAMED SQL STATEMENTS, WITH THE PARAMETERS
+THEY TAKE AND THE TABLES THEY READ AND WRITE, RENDERED PER RUN
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import logging
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Rendered statements kept in memory. Every distinct set of parameters
+# (e.g. one COPY per backfilled partition) takes one entry
+RENDER_CACHE_SIZE = 1024
+
+# Tables only ever appended to by independent statements (e.g. a new load
+# version per table). They don't order the statements that write them
+APPEND_ONLY_TABLES = ['load_versions']
+
+@dataclass
+class Query:
+    """
+    Dataclass used for storing a named SQL statement: its str.format template,
+    the parameters it takes with their defaults (None marks a required one),
+    and the tables it reads (inputs) and writes (outputs)
+    """
+    name: str
+    template: str
+    params: dict = field(default_factory=dict)
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+
+REGISTRY = {}
+
+def register(name, template, params=None, inputs=None, outputs=None):
+    """ Adds a statement to the registry
+
+    Args:
+    name (str):[unique name of the statement]
+    template (str):[SQL text, with {param} placeholders when it takes parameters]
+    params (dict):[parameter names mapped to their defaults. None marks a required parameter]
+    inputs (list):[tables read by the statement]
+    outputs (list):[tables written by the statement]
+
+    Returns:
+    query (Query): [the registered statement]
+    """
+    if name in REGISTRY:
+        raise ValueError(f"Query {name} is already registered")
+    REGISTRY[name] = Query(name=name, template=template, params=dict(params or {})
+                           ,inputs=list(inputs or []), outputs=list(outputs or []))
+    return REGISTRY[name]
+
+def get(name):
+    """ Gets a registered statement by name """
+    if name not in REGISTRY:
+        raise KeyError(f"Unknown query {name}. Choose one of {', '.join(REGISTRY)}")
+    return REGISTRY[name]
+
+def bind_params(name, params, defaults=None):
+    """ Merges params over the defaults of a statement and checks them. Also
+    used for the named queries of analytics.py, which pass their own defaults
+
+    Args:
+    name (str):[name of the statement, used in error messages]
+    params (dict):[values given for the statement parameters]
+    defaults (dict):[parameter names mapped to their defaults. None marks a required
+                     parameter. Defaults to those of the registered statement]
+
+    Returns:
+    params (dict): [every parameter of the statement with its value]
+    """
+    defaults = get(name).params if defaults is None else defaults
+    unknown = set(params) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown parameters for {name}: {', '.join(sorted(unknown))}")
+    bound = {**defaults, **params}
+    missing = [param for param, value in bound.items() if value is None]
+    if missing:
+        raise ValueError(f"Missing parameters for {name}: {', '.join(missing)}")
+    return bound
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render(name, params):
+    """ Fills in the template of a statement. params is a sorted tuple of (name, value) pairs """
+    query = REGISTRY[name]
+    return query.template.format(**dict(params)) if query.params else query.template
+
+def render(name, **params):
+    """ Renders a registered statement. Renders are cached, so the same
+    statement rendered again with the same parameters costs a lookup
+
+    Args:
+    name (str):[name of a registered statement]
+    **params:[values for the statement parameters]
+
+    Returns:
+    query (str): [string representing the SQL statement]
+    """
+    return _render(name, tuple(sorted(bind_params(name, params).items())))
+
+def render_all(names, **params):
+    """ Renders a list of statements that take no parameters, or the same ones """
+    return [render(name, **params) for name in names]
+
+def dependencies(names):
+    """ Gets the tables read and written by a group of statements run together,
+    e.g. a delete+insert upsert, for scheduler.Node inputs and outputs.
+    Append-only tables are left out
+
+    Args:
+    names (list):[names of registered statements]
+
+    Returns:
+    inputs (list): [tables read by any of the statements]
+    outputs (list): [tables written by any of the statements]
+    """
+    inputs, outputs = [], []
+    for name in names:
+        query = get(name)
+        inputs += [table for table in query.inputs if table not in inputs + APPEND_ONLY_TABLES]
+        outputs += [table for table in query.outputs if table not in outputs + APPEND_ONLY_TABLES]
+    return inputs, outputs
+
+def cache_info():
+    """ Gets hits, misses and size of the render cache """
+    return _render.cache_info()
@@ -0,0 +1,58 @@
+"""
+THIS MODULE INCLUDES FUNCTIONS THAT REFRESH THE ROLLUP TABLES (SONGPLAY
+PRE-AGGREGATED BY DAY, HOUR AND WEEK) FOR THE TIME BUCKETS A LOAD TOUCHED
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import logging
+from time import perf_counter
+from scheduler import run_graph
+from sql_queries import rollup_table_queries, rollup_table_names
+from etl import registry_node
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+def refresh_rollups(cur, conn):
+    """ Recomputes the rollup buckets touched by the staged events, each
+    rollup in its own transaction. Runs after the analytics tables are loaded
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    """
+    try:
+        i = 1
+        for queries in rollup_table_queries:
+            logger.info(f"####### Refreshing rollup {i} of {len(rollup_table_queries)} #######")
+            for query in queries:
+                instrumentation.execute(cur, query)
+            conn.commit()
+            i += 1
+    except Exception as err:
+        conn.rollback()
+        logger.exception(err)
+        raise(err)
+
+def refresh_rollups_parallel(pool, max_workers):
+    """ Same as refresh_rollups(), refreshing the rollups concurrently on
+    pooled connections
+
+    Args:
+    pool (obj):[object connection pool created from psycopg2.pool]
+    max_workers (int):[maximum number of rollups refreshed at once, e.g. WLM slots]
+
+    Returns:
+    timings (dict): [seconds taken to refresh each rollup]
+    """
+    try:
+        logger.info(f"####### Refreshing {len(rollup_table_queries)} rollups, up to {max_workers} at a time #######")
+        nodes = [registry_node(pool, names) for names in rollup_table_names]
+        start = perf_counter()
+        timings = run_graph(nodes, max_workers)
+        logger.info(f"####### Rollup stage took {perf_counter() - start:.1f}s #######")
+        return timings
+    except Exception as err:
+        logger.exception(err)
+        raise(err)
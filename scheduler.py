@@ -0,0 +1,81 @@
+"""
+THIS MODULE INCLUDES A DEPENDENCY-AWARE SCHEDULER FOR RUNNING TASKS IN PARALLEL
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import logging
+from dataclasses import dataclass, field
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Node:
+    """
+    Dataclass used for storing a task of the graph together with the
+    tables (or any other named resources) it reads and writes
+    """
+    name: str
+    run: object
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+
+def build_graph(nodes):
+    """ Works out which nodes each node has to wait for. A node depends on
+    every earlier node that writes something it reads or writes, so writes
+    to the same table keep their declared order
+
+    Args:
+    nodes (list):[list of Node objects, in declared order]
+
+    Returns:
+    graph (dict): [node name mapped to the set of node names it depends on]
+    """
+    graph = {}
+    for i, node in enumerate(nodes):
+        touched = set(node.inputs) | set(node.outputs)
+        graph[node.name] = {earlier.name for earlier in nodes[:i]
+                            if touched & set(earlier.outputs)}
+    return graph
+
+def run_graph(nodes, max_workers):
+    """ Runs the nodes as soon as their dependencies are done, with at most
+    max_workers running at the same time. Stops scheduling new nodes and
+    re-raises as soon as one of them fails
+
+    Args:
+    nodes (list):[list of Node objects, in declared order]
+    max_workers (int):[maximum number of nodes running at once]
+
+    Returns:
+    timings (dict): [seconds taken by each node]
+    """
+    graph = build_graph(nodes)
+    by_name = {node.name: node for node in nodes}
+    done, timings, running = set(), {}, {}
+
+    def timed(node):
+        start = perf_counter()
+        node.run()
+        return perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(done) < len(nodes):
+            for name, deps in graph.items():
+                if name not in done and name not in running.values() and deps <= done:
+                    logger.info(f"####### Starting {name} #######")
+                    running[executor.submit(timed, by_name[name])] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                except Exception:
+                    for pending in running:
+                        pending.cancel()
+                    raise
+                done.add(name)
+                logger.info(f"####### Finished {name} in {timings[name]:.1f}s #######")
+    return timings
@@ -0,0 +1,202 @@
+"""
+THIS MODULE INCLUDES THE TABLE DEFINITIONS, WITH A COMPRESSION ENCODING PER
+COLUMN, AND FUNCTIONS TO RENDER THEM AS CREATE TABLE STATEMENTS
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each column is (name, data type, encoding, attributes & constraints).
+# Sort key columns stay RAW so range-restricted scans can skip blocks;
+# low-cardinality strings use BYTEDICT, numbers and timestamps AZ64 and
+# free text ZSTD
+TABLES = {
+    'staging_events': {'columns': [('artist', 'VARCHAR', 'zstd', '')
+                                   ,('auth', 'VARCHAR(30)', 'bytedict', '')
+                                   ,('first_name', 'VARCHAR', 'zstd', '')
+                                   ,('gender', 'VARCHAR(2)', 'bytedict', '')
+                                   ,('item_in_session', 'INT', 'az64', '')
+                                   ,('last_name', 'VARCHAR', 'zstd', '')
+                                   ,('length', 'DECIMAL', 'az64', '')
+                                   ,('level', 'VARCHAR(15)', 'bytedict', '')
+                                   ,('location', 'VARCHAR', 'zstd', '')
+                                   ,('method', 'VARCHAR(8)', 'bytedict', '')
+                                   ,('page', 'VARCHAR(20)', 'bytedict', '')
+                                   ,('registration', 'BIGINT', 'az64', '')
+                                   ,('session_id', 'INT', 'az64', '')
+                                   ,('song', 'VARCHAR', 'zstd', '')
+                                   ,('status', 'INT', 'az64', '')
+                                   ,('ts', 'TIMESTAMP', 'az64', '')
+                                   ,('user_agent', 'VARCHAR', 'zstd', '')
+                                   ,('user_id', 'INT', 'az64', '')
+                                   ,('song_match_key', 'CHAR(32)', 'zstd', 'DISTKEY')]
+                       ,'attributes': ''}
+    ,'staging_songs': {'columns': [('artist_id', 'VARCHAR(30)', 'zstd', 'NOT NULL')
+                                   ,('artist_latitude', 'DECIMAL', 'az64', '')
+                                   ,('artist_longitude', 'DECIMAL', 'az64', '')
+                                   ,('artist_location', 'VARCHAR', 'zstd', '')
+                                   ,('artist_name', 'VARCHAR', 'zstd', '')
+                                   ,('num_songs', 'INT', 'az64', '')
+                                   ,('song_id', 'VARCHAR', 'zstd', 'NOT NULL')
+                                   ,('title', 'VARCHAR', 'zstd', '')
+                                   ,('duration', 'DECIMAL', 'az64', '')
+                                   ,('year', 'INT', 'az64', '')
+                                   ,('song_match_key', 'CHAR(32)', 'zstd', 'DISTKEY')]
+                       ,'attributes': ''}
+    ,'songplay': {'columns': [('songplay_id', 'INT IDENTITY(0,1)', 'raw', 'PRIMARY KEY SORTKEY DISTKEY')
+                              ,('start_time', 'TIMESTAMP', 'az64', '')
+                              ,('user_id', 'INT', 'az64', '')
+                              ,('level', 'VARCHAR(15)', 'bytedict', '')
+                              ,('song_id', 'VARCHAR', 'zstd', '')
+                              ,('artist_id', 'VARCHAR(30)', 'zstd', '')
+                              ,('session_id', 'INT', 'az64', '')
+                              ,('location', 'VARCHAR', 'zstd', '')
+                              ,('user_agent', 'VARCHAR', 'zstd', '')]
+                  ,'attributes': ''}
+    ,'users': {'columns': [('user_id', 'INT', 'raw', 'NOT NULL SORTKEY')
+                           ,('first_name', 'VARCHAR', 'zstd', '')
+                           ,('last_name', 'VARCHAR', 'zstd', '')
+                           ,('gender', 'VARCHAR(2)', 'bytedict', '')
+                           ,('level', 'VARCHAR(15)', 'bytedict', '')]
+               ,'attributes': 'diststyle all'}
+    ,'songs': {'columns': [('song_id', 'VARCHAR', 'raw', 'NOT NULL SORTKEY')
+                           ,('title', 'VARCHAR', 'zstd', '')
+                           ,('artist_id', 'VARCHAR(30)', 'zstd', '')
+                           ,('year', 'INT', 'az64', '')
+                           ,('duration', 'DECIMAL', 'az64', '')]
+               ,'attributes': 'diststyle all'}
+    ,'artists': {'columns': [('artist_id', 'VARCHAR(30)', 'raw', 'NOT NULL SORTKEY')
+                             ,('name', 'VARCHAR', 'zstd', '')
+                             ,('location', 'VARCHAR', 'zstd', '')
+                             ,('latitude', 'DECIMAL', 'az64', '')
+                             ,('longitue', 'DECIMAL', 'az64', '')]
+                 ,'attributes': 'diststyle all'}
+    ,'time': {'columns': [('time_id', 'INT IDENTITY(0,1)', 'az64', '')
+                          ,('start_time', 'TIMESTAMP', 'raw', 'NOT NULL SORTKEY')
+                          ,('hour', 'INT', 'az64', 'NOT NULL')
+                          ,('day', 'INT', 'az64', 'NOT NULL')
+                          ,('week', 'INT', 'az64', 'NOT NULL')
+                          ,('month', 'INT', 'az64', 'NOT NULL')
+                          ,('year', 'INT', 'az64', 'NOT NULL')
+                          ,('weekday', 'INT', 'az64', 'NOT NULL')]
+              ,'attributes': 'diststyle all'}
+    # High-water mark: latest start_time already loaded into songplay
+    ,'load_watermark': {'columns': [('table_name', 'VARCHAR(30)', 'zstd', 'NOT NULL')
+                                    ,('high_water_mark', 'TIMESTAMP', 'az64', '')
+                                    ,('loaded_at', 'TIMESTAMP', 'az64', 'NOT NULL')]
+                        ,'attributes': 'diststyle all'}
+    # Rollups of songplay at a time grain, refreshed for the buckets each load touches
+    ,'song_plays_daily': {'columns': [('play_day', 'TIMESTAMP', 'raw', 'NOT NULL SORTKEY')
+                                      ,('song_id', 'VARCHAR', 'zstd', 'NOT NULL')
+                                      ,('artist_id', 'VARCHAR(30)', 'zstd', '')
+                                      ,('plays', 'BIGINT', 'az64', 'NOT NULL')]
+                          ,'attributes': ''}
+    ,'level_users_hourly': {'columns': [('play_hour', 'TIMESTAMP', 'raw', 'NOT NULL SORTKEY')
+                                        ,('level', 'VARCHAR(15)', 'bytedict', '')
+                                        ,('plays', 'BIGINT', 'az64', 'NOT NULL')
+                                        ,('active_users', 'BIGINT', 'az64', 'NOT NULL')]
+                            ,'attributes': 'diststyle all'}
+    ,'artist_plays_weekly': {'columns': [('play_week', 'TIMESTAMP', 'raw', 'NOT NULL SORTKEY')
+                                         ,('artist_id', 'VARCHAR(30)', 'zstd', 'NOT NULL')
+                                         ,('plays', 'BIGINT', 'az64', 'NOT NULL')
+                                         ,('listeners', 'BIGINT', 'az64', 'NOT NULL')]
+                             ,'attributes': 'diststyle all'}
+    # One row per analytics table load. The latest loaded_at of a table is its
+    # load version, which analytics.py keys cached results on
+    ,'load_versions': {'columns': [('table_name', 'VARCHAR(30)', 'zstd', 'NOT NULL')
+                                   ,('loaded_at', 'TIMESTAMP', 'az64', 'NOT NULL')]
+                       ,'attributes': 'diststyle all'}
+}
+
+# Landing tables staging COPYs load into, without song_match_key. Spread evenly
+# so every slice parses its share of the files; rows reach the staging tables
+# through a single INSERT ... SELECT that computes the key and distributes on it
+for _table in ['staging_events', 'staging_songs']:
+    TABLES[f"{_table}_raw"] = {'columns': [column for column in TABLES[_table]['columns']
+                                           if column[0] != 'song_match_key']
+                               ,'attributes': 'diststyle even'}
+
+def create_table_sql(table, encodings=None):
+    """ Renders the CREATE TABLE statement of a table
+
+    Args:
+    table (str):[string representing the table name, a key of TABLES]
+    encodings (dict):[column mapped to an encoding that replaces the default, e.g.
+                      from read_encodings()]
+
+    Returns:
+    query (str): [string representing the CREATE TABLE statement]
+    """
+    encodings = encodings or {}
+    definition = TABLES[table]
+    lines = []
+    for i, (name, data_type, encoding, extra) in enumerate(definition['columns']):
+        # Lines after the first start with a comma, so names line up one column earlier
+        column = f"{name:<{19 if i == 0 else 18}} {data_type} ENCODE {encodings.get(name, encoding)}"
+        lines.append(f"{column} {extra}".rstrip())
+    attributes = f"\n{definition['attributes']}" if definition['attributes'] else ''
+    return (f"\nCREATE TABLE IF NOT EXISTS {table} (\n    "
+            + "\n    ,".join(lines)
+            + f"\n){attributes};\n")
+
+def sort_key_columns(table):
+    """ Returns the sort key columns of a table, which are kept RAW """
+    return {name for name, _, _, extra in TABLES[table]['columns'] if 'SORTKEY' in extra.upper()}
+
+def analyze_compression(cur, conn, tables=None, comprows=100000):
+    """ Runs ANALYZE COMPRESSION on loaded tables and collects the suggested
+    encoding of each column. Sort key columns keep RAW. The statement can't
+    run inside a transaction block, so the connection is in autocommit meanwhile
+
+    Args:
+    cur (obj):[object cursor created from the connection]
+    conn (obj):[object connection created from psycopg2 to database]
+    tables (list):[tables to analyze. Defaults to every table in TABLES]
+    comprows (int):[number of rows sampled per table]
+
+    Returns:
+    encodings (dict): [table mapped to {column: encoding}]
+    """
+    encodings = {}
+    conn.commit()
+    conn.autocommit = True
+    try:
+        for table in tables or TABLES:
+            logger.info(f"####### Analyzing compression of {table} #######")
+            cur.execute(f"ANALYZE COMPRESSION {table} COMPROWS {int(comprows)};")
+            keep_raw = sort_key_columns(table)
+            encodings[table] = {column: ('raw' if column in keep_raw else encoding.lower())
+                                for _, column, encoding, *_ in cur.fetchall()}
+    finally:
+        conn.autocommit = False
+    return encodings
+
+def read_encodings(path):
+    """ Reads encodings written by write_encodings(), if the file exists
+
+    Args:
+    path (str):[string representing path to the encodings file]
+
+    Returns:
+    encodings (dict): [table mapped to {column: encoding}]
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def write_encodings(path, encodings):
+    """ Stores encodings so the next run creates tables with them
+
+    Args:
+    path (str):[string representing path to the encodings file]
+    encodings (dict):[table mapped to {column: encoding}]
+    """
+    with open(path, 'w') as f:
+        json.dump(encodings, f, indent=2, sort_keys=True)
+    logger.info(f"####### Encodings written to {path} #######")
@@ -5,11 +5,16 @@ Author: Lucas Aledi
 Date: December 2022
 """
 import sys
-from time import sleep
-import psycopg2
-from configparser import ConfigParser
 import logging
+import analytics
+import connections
 import create_tables
+import schema
+import instrumentation
+import ledger
+import provisioning
+import publish
+import rollups
 from etl import *
 from config_loader import *
 from aws_functions import *
@@ -21,106 +26,126 @@ logger = logging.getLogger(__name__)
 
 # Main workflow 
 def main():
+    manager = conn = cur = None
+    db_config = iam = redshift = None
     try:
         # Gets Database configuration from dwh.cfg file
-        db_config = DatabaseConfig.get_config('config/dwh.cfg')
+        db_config = get_config()
+        # Fails before any client exists, so a rejected pair tears nothing down
+        provisioning.check_lifecycle(db_config)
 
-        # Creates S3 ReadOnly IAM role
-        logger.info("======= Creating IAM Role =======")
-        iam = IAM_role.create_client(db_config['key'],db_config['secret'],db_config['region'])        
-        IAM_role.create_role(iam,db_config['db_iam_role_name'])
-        IAM_role.attach_policy(iam,db_config['db_iam_role_name'])
-        role_arn = IAM_role.get_role_arn(iam,db_config['db_iam_role_name'])
-        # Inserts S3 IAM Role ARN into db_config
-        db_config['iam_role_arn'] = role_arn
-        # Set variable for edits to the config file
-        edit = ConfigParser()
-        edit.read('config/dwh.cfg')
-        edit_iamRole = edit['IAM_ROLE']
-        edit_iamRole['arn'] = role_arn
-        with open('config/dwh.cfg','w') as f:
-            edit.write(f)
-            f.close()
-        # Gets Database configuration from dwh.cfg file WITH UPDATE
-        db_config = DatabaseConfig.get_config('config/dwh.cfg')
-
-        logger.info(f"======= iam_role_arn : {db_config['iam_role_arn']} =======")
-
-        # Creates Redshift Cluster
-        logger.info("======= Creating Redshift Cluster =======")
+        # Creates AWS clients
+        iam = IAM_role.create_client(db_config['key'],db_config['secret'],db_config['region'])
         redshift = Redshift_cluster.create_client(db_config['key'],db_config['secret'],db_config['region'])
-        response = Redshift_cluster.create_cluster(redshift,db_config)
-        # Tests cluster creation
-        if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-            cluster_props = redshift.describe_clusters(
-                    ClusterIdentifier=db_config['cluster_identifier']
-                    )['Clusters'][0]
-            cluster_status = cluster_props['ClusterStatus'].lower()
-            # Tests cluster availability
-            while cluster_status != 'available':
-                logger.info(f'Cluster status is {cluster_status}. This might take a moment.')
-                cluster_props = redshift.describe_clusters(
-                    ClusterIdentifier=db_config['cluster_identifier']
-                    )['Clusters'][0]
-                cluster_status = cluster_props['ClusterStatus'].lower()
-                sleep(30)
-            # Once cluster is available...
-            cluster_props = redshift.describe_clusters(
-                    ClusterIdentifier=db_config['cluster_identifier']
-                    )['Clusters'][0]
-            cluster_status = cluster_props['ClusterStatus'].lower()
-            logger.info(f'Cluster is now live. Status {cluster_status}')
-            # Gets end point to be used for connection. Update db_config
-            end_point = cluster_props['Endpoint']['Address']
-            db_config['db_host'] = end_point
-            # Gets Redshift Cluster IAM Role ARN. Update db_config
-            redshift_IamRoleArn = cluster_props['IamRoles'][0]['IamRoleArn']
-            db_config['db_iam_role_arn'] = redshift_IamRoleArn
-            logger.info(f"======= db_iam_role_arn : {cluster_props} =======")
-        else:
-            logger.info(f"Something went wrong while creating Redshift Cluster.\n \
-                        Code returned: {response['ResponseMetadata']['HTTPStatusCode']}")
-
-        # CONNECTING TO DATABASE
-        # Creates EC2 client
         ec2 = Connect_cluster.create_ec2_client(db_config['key']
                                                 ,db_config['secret']
                                                 ,db_config['region'])
-        # Open TCP port
-        Connect_cluster.attach_security_group(ec2,cluster_props,db_config)
+        s3 = S3_sources.create_client(db_config['key'],db_config['secret'],db_config['s3_region'])
+
+        # Creates IAM Role, Redshift Cluster and opens TCP port. Independent
+        # steps run concurrently while the cluster boots
+        logger.info("======= Provisioning IAM Role & Redshift Cluster =======")
+        cluster_props = provisioning.provision(db_config, iam, redshift, ec2, s3)
         
         logger.info(f"======= Connecting to Database {db_config['db_name']} =======")
-        conn_string = "host={} dbname={} user={} password={} port={}".format(
-            db_config['db_host']
-            ,db_config['db_name']
-            ,db_config['db_user']
-            ,db_config['db_password']
-            ,db_config['db_port']
-            )
-        logger.info(f"======= {conn_string} =======")
-        
-        conn = psycopg2.connect(conn_string)
+        # One connection serves the sequential stages, the rest are used by
+        # the parallel ones. Each stage tags its statements with a WLM
+        # query_group and is bounded by a statement_timeout
+        manager = connections.Connection_manager(db_config
+                                                 ,db_config['max_connections'] + 1
+                                                 ,db_config['statement_timeout']
+                                                 ,db_config['connect_retries']
+                                                 ,db_config['retry_delay'])
+        conn = manager.getconn()
         cur = conn.cursor()
+        pool = manager if db_config['parallel_load'] else None
 
+        incremental = db_config['load_mode'] == 'incremental'
+        shadow = db_config['load_mode'] == 'publish'
         logger.info("======= Creating Staging & Analytics tables =======")
-        create_tables.drop_tables(cur, conn)
-        create_tables.create_tables(cur, conn)
+        with manager.stage('create_tables'):
+            if incremental or shadow:
+                create_tables.create_tables(cur, conn)
+                create_tables.truncate_staging_tables(cur, conn)
+                if shadow:
+                    publish.create_shadow_tables(cur, conn)
+            else:
+                create_tables.drop_tables(cur, conn)
+                create_tables.create_tables(cur, conn)
 
         logger.info("======= Loading Staging Tables =======")
         logger.info(db_config['iam_role_arn'])
-        load_staging_tables(cur, conn)
+        # Objects loaded through the ledger, recorded once they reached the analytics tables
+        loaded, suffix = None, ''
+        with manager.stage('load_staging', db_config['load_timeout']):
+            if db_config['use_parquet']:
+                reset, suffix = not incremental, ledger.PARQUET_LOADED
+                loaded = load_staging_tables_from_parquet(cur, conn, s3, db_config, incremental)
+            elif db_config['use_ledger'] or db_config['compact_sources'] or db_config['tolerant_load']:
+                # Without the ledger, compacted and tolerant loads take every object
+                reset = not (incremental and db_config['use_ledger'])
+                loaded = load_staging_tables_from_ledger(cur, conn, s3, db_config, reset)
+            elif db_config['parallel_load']:
+                load_staging_tables_parallel(pool, db_config['max_connections'])
+            else:
+                load_staging_tables(cur, conn)
 
         logger.info("======= Inserting data from Staging tables to Analytics =======")
-        insert_tables(cur, conn)
+        max_workers = min(db_config['wlm_slots'], db_config['max_connections'])
+        with manager.stage('insert_tables'):
+            check_songplay_plan(cur)
+            if shadow and db_config['parallel_load']:
+                publish.insert_shadow_tables_parallel(pool, max_workers)
+            elif shadow:
+                publish.insert_shadow_tables(cur, conn)
+            elif incremental and db_config['parallel_load']:
+                upsert_tables_parallel(pool, max_workers)
+            elif incremental:
+                upsert_tables(cur, conn)
+            elif db_config['parallel_load']:
+                insert_tables_parallel(pool, max_workers)
+                update_watermark(cur, conn)
+            else:
+                insert_tables(cur, conn)
+                update_watermark(cur, conn)
+        if loaded is not None:
+            record_ledger(db_config, loaded, reset, suffix)
+
+        if shadow:
+            # Rollups were built with the shadow tables
+            logger.info("======= Publishing Shadow tables =======")
+            with manager.stage('publish'):
+                publish.publish_tables(cur, conn, db_config['max_null_rate'])
+        else:
+            logger.info("======= Refreshing Rollup tables =======")
+            with manager.stage('rollups'):
+                if db_config['parallel_load']:
+                    rollups.refresh_rollups_parallel(pool, max_workers)
+                else:
+                    rollups.refresh_rollups(cur, conn)
 
-        # ADD DATA VALIDATION QUERIES
         logger.info("======= Initiating Data Validation Tests =======")
-        ## SELECT COUNT(*)
-        ## FROM each table
-        Data_validation.testing_queries(cur, conn)
+        with manager.stage('validation'):
+            report = Data_validation.testing_queries(cur, conn, pool
+                                                     ,db_config['validation_time_budget']
+                                                     ,db_config['max_null_rate'])
+        Data_validation.write_report(report, db_config['metrics_dir'])
+        instrumentation.collect_redshift_stats(cur)
 
-        # ADD SAMPLE ANALYTICAL QUERIES
+        if db_config['analyze_compression']:
+            # Stores the suggested encodings. Tables created from the next
+            # run on use them
+            logger.info("======= Analyzing column compression =======")
+            with manager.stage('analyze_compression'):
+                schema.write_encodings(db_config['encodings_path'], schema.analyze_compression(cur, conn))
 
+        logger.info("======= Running Sample Analytical Queries =======")
+        cache = analytics.get_cache(db_config['cache_max_entries'], db_config['cache_ttl']
+                                    ,db_config['cache_version_ttl'])
+        # This run just wrote new load versions
+        cache.forget_versions()
+        with manager.stage('analytics'):
+            analytics.log_sample_queries(cur, cache)
 
     except Exception as err:
         logger.info("======= Exception name:" + err.__class__.__name__ + " =======")
@@ -128,17 +153,20 @@ def main():
         #sys.exit(1)
     
     finally:
-        cur.close()
-        logger.info(f"======= Closed Cursor =======")
-        conn.close()
-        logger.info(f"======= Closed connection with Database {db_config['db_name']} =======")
-        redshift.delete_cluster(ClusterIdentifier=db_config['cluster_identifier']
-                                ,SkipFinalClusterSnapshot=True)
-        logger.info(f"======= Deleted Cluster  =======")
-        iam.detach_role_policy(RoleName=db_config['db_iam_role_name'], PolicyArn='arn:aws:iam::aws:policy/AdministratorAccess')
-        logger.info(f"======= Detached Role Policy  =======")
-        iam.delete_role(RoleName=db_config['db_iam_role_name'])
-        logger.info(f"======= Deleted Role  =======")
+        if db_config is not None:
+            instrumentation.write_metrics(db_config['metrics_dir'])
+        instrumentation.log_summary()
+        if cur is not None:
+            cur.close()
+            logger.info(f"======= Closed Cursor =======")
+        if manager is not None:
+            if conn is not None:
+                manager.putconn(conn)
+            manager.closeall()
+            logger.info(f"======= Closed connections with Database {db_config['db_name']} =======")
+        if iam is not None and redshift is not None:
+            provisioning.teardown(db_config, iam, redshift)
+            logger.info(f"======= Cluster teardown ({db_config['teardown_mode']}) done  =======")
         logger.info(f"======= All done  =======")
 
 if __name__ == '__main__':
@@ -4,12 +4,14 @@ THIS MODULE INCLUDES QUERIES USED IN CREATING/DROPING TABLES
 Author: Lucas Aledi
 Date: December 2022
 """
-from config_loader import *
-# Gets Database configuration from dwh.cfg file
-db_config = DatabaseConfig.get_config('config/dwh.cfg')
+import config_loader
+import query_registry
+import schema
 
 
 # DROP TABLES
+staging_events_raw_table_drop = "DROP TABLE IF EXISTS staging_events_raw;"
+staging_songs_raw_table_drop = "DROP TABLE IF EXISTS staging_songs_raw;"
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs;"
 songplay_table_drop = "DROP TABLE IF EXISTS songplay;"
@@ -17,139 +19,139 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+load_watermark_table_drop = "DROP TABLE IF EXISTS load_watermark;"
+load_versions_table_drop = "DROP TABLE IF EXISTS load_versions;"
+song_plays_daily_table_drop = "DROP TABLE IF EXISTS song_plays_daily;"
+level_users_hourly_table_drop = "DROP TABLE IF EXISTS level_users_hourly;"
+artist_plays_weekly_table_drop = "DROP TABLE IF EXISTS artist_plays_weekly;"
+
+
+# TRUNCATE STAGING TABLES (incremental loads keep the analytics tables)
+staging_events_raw_table_truncate = "TRUNCATE staging_events_raw;"
+staging_songs_raw_table_truncate = "TRUNCATE staging_songs_raw;"
+staging_events_table_truncate = "TRUNCATE staging_events;"
+staging_songs_table_truncate = "TRUNCATE staging_songs;"
 
 
 # CREATE TABLES
-staging_events_table_create= ("""
-CREATE TABLE IF NOT EXISTS staging_events (
-    artist              VARCHAR
-    ,auth               VARCHAR(30)
-    ,first_name         VARCHAR
-    ,gender             VARCHAR(2)
-    ,item_in_session    INT
-    ,last_name          VARCHAR
-    ,length             DECIMAL
-    ,level              VARCHAR(15)
-    ,location           VARCHAR
-    ,method             VARCHAR(8)
-    ,page               VARCHAR(20)
-    ,registration       BIGINT
-    ,session_id         INT
-    ,song               VARCHAR
-    ,status             INT
-    ,ts                 TIMESTAMP
-    ,user_agent         VARCHAR
-    ,user_id            INT
-);
-""")
-
-staging_songs_table_create = ("""
-CREATE TABLE IF NOT EXISTS staging_songs (
-    artist_id           VARCHAR(30) NOT NULL
-    ,artist_latitude    DECIMAL
-    ,artist_longitude   DECIMAL
-    ,artist_location    VARCHAR
-    ,artist_name        VARCHAR
-    ,num_songs          INT
-    ,song_id            VARCHAR NOT NULL
-    ,title              VARCHAR
-    ,duration           DECIMAL
-    ,year               INT
-);
-""")
-
-songplay_table_create = ("""
-CREATE TABLE IF NOT EXISTS songplay (
-    songplay_id     INT IDENTITY(0,1) PRIMARY KEY SORTKEY DISTKEY
-    ,start_time     TIMESTAMP
-    ,user_id        INT
-    ,level          VARCHAR(15)
-    ,song_id        VARCHAR
-    ,artist_id      VARCHAR(30)
-    ,session_id     INT
-    ,location       VARCHAR
-    ,user_agent     VARCHAR
-);
-""")
-
-user_table_create = ("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id         INT NOT NULL SORTKEY
-    ,first_name     VARCHAR 
-    ,last_name      VARCHAR 
-    ,gender         VARCHAR(2) 
-    ,level          VARCHAR(15) 
-)
-diststyle all;
-""")
-
-song_table_create = ("""
-CREATE TABLE IF NOT EXISTS songs (
-    song_id         VARCHAR NOT NULL SORTKEY
-    ,title          VARCHAR
-    ,artist_id      VARCHAR(30)
-    ,year           INT
-    ,duration       DECIMAL
-)
-diststyle all;
-""")
-
-artist_table_create = ("""
-CREATE TABLE IF NOT EXISTS artists (
-    artist_id       VARCHAR(30) NOT NULL SORTKEY
-    ,name           VARCHAR
-    ,location       VARCHAR
-    ,latitude       DECIMAL
-    ,longitue       DECIMAL
-)
-diststyle all;
-""")
-
-time_table_create = ("""
-CREATE TABLE IF NOT EXISTS time (
-    time_id         INT IDENTITY(0,1)
-    ,start_time     TIMESTAMP NOT NULL SORTKEY
-    ,hour           INT NOT NULL
-    ,day            INT NOT NULL
-    ,week           INT NOT NULL
-    ,month          INT NOT NULL
-    ,year           INT NOT NULL
-    ,weekday        INT NOT NULL
-)
-diststyle all;
+## Rendered from schema.py on first use (see __getattr__ below), with the
+## encodings suggested by ANALYZE COMPRESSION (see schema.analyze_compression)
+## replacing the defaults once they are stored
+create_table_names = {'staging_events_raw_table_create': 'staging_events_raw'
+                      ,'staging_songs_raw_table_create': 'staging_songs_raw'
+                      ,'staging_events_table_create': 'staging_events'
+                      ,'staging_songs_table_create': 'staging_songs'
+                      ,'songplay_table_create': 'songplay'
+                      ,'user_table_create': 'users'
+                      ,'song_table_create': 'songs'
+                      ,'artist_table_create': 'artists'
+                      ,'time_table_create': 'time'
+                      ## High-water mark: latest start_time already loaded into songplay
+                      ,'load_watermark_table_create': 'load_watermark'
+                      ## Load version of every analytics table, used to invalidate cached query results
+                      ,'load_versions_table_create': 'load_versions'
+                      ## Rollups of songplay by day, hour and week
+                      ,'song_plays_daily_table_create': 'song_plays_daily'
+                      ,'level_users_hourly_table_create': 'level_users_hourly'
+                      ,'artist_plays_weekly_table_create': 'artist_plays_weekly'}
+
+# STAGING TABLES
+## COPY loads the source files into the evenly distributed raw tables, then
+## the staging inserts below add song_match_key and distribute rows on it
+staging_events_columns = ("artist,auth,first_name,gender,item_in_session,last_name,length,level"
+                          ",location,method,page,registration,session_id,song,status,ts,user_agent,user_id")
+staging_songs_columns = ("artist_id,artist_latitude,artist_longitude,artist_location,artist_name"
+                         ",num_songs,song_id,title,duration,year")
+
+## COPY templates are registered in query_registry.py and rendered per run, with the
+## parameters taken from the configuration by copy_params() below. source can point
+## at a narrower prefix, e.g. a single date partition for a backfill
+staging_events_copy_template = ("""
+    COPY staging_events_raw ({columns})
+    FROM {source}
+    CREDENTIALS 'aws_iam_role={iam_role_arn}'
+    COMPUPDATE OFF
+    REGION '{region}'
+    FORMAT AS json {jsonpaths}
+    TIMEFORMAT AS 'epochmillisecs'
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL{maxerror};
 """)
 
+staging_songs_copy_template = ("""
+    COPY staging_songs_raw ({columns})
+    FROM {source}
+    CREDENTIALS 'aws_iam_role={iam_role_arn}'
+    COMPUPDATE OFF
+    REGION '{region}'
+    FORMAT AS json 'auto'
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL{maxerror};
+""")
 
-# STAGING TABLES
-staging_events_copy = ("""
-    COPY staging_events 
-    FROM {}
-    CREDENTIALS 'aws_iam_role={}'
+## Manifest COPYs load only the objects listed by ledger.py. The manifest url is filled in per run,
+## and compression is ' GZIP' when the manifest lists chunks written by compactor.py.
+## JSON COPYs take maxerror, e.g. ' MAXERROR 100', to skip up to that many bad records
+staging_events_manifest_copy_template = ("""
+    COPY staging_events_raw ({columns})
+    FROM '{manifest_url}'
+    CREDENTIALS 'aws_iam_role={iam_role_arn}'
     COMPUPDATE OFF
-    REGION '{}'
-    FORMAT AS json {}
+    REGION '{region}'
+    FORMAT AS json {jsonpaths}
     TIMEFORMAT AS 'epochmillisecs'
-    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL;
-""").format(db_config['s3_log_data']
-            ,db_config['iam_role_arn']
-            # S3 bucket is in a different region from Redshift Cluster
-            #,db_config['region']
-            ,'us-west-2'
-            ,db_config['s3_log_metadata'])
-
-staging_songs_copy = ("""
-    COPY staging_songs 
-    FROM {}
-    CREDENTIALS 'aws_iam_role={}'
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+    MANIFEST{compression}{maxerror};
+""")
+
+staging_songs_manifest_copy_template = ("""
+    COPY staging_songs_raw ({columns})
+    FROM '{manifest_url}'
+    CREDENTIALS 'aws_iam_role={iam_role_arn}'
     COMPUPDATE OFF
-    REGION '{}'
+    REGION '{region}'
     FORMAT AS json 'auto'
-    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL;
-""").format(db_config['s3_song_data']
-            ,db_config['iam_role_arn']
-            # S3 bucket is in a different region from Redshift Cluster
-            #,db_config['region']
-            ,'us-west-2')
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+    MANIFEST{compression}{maxerror};
+""")
+
+## Parquet COPYs load files written by parquet_converter.py, which holds every
+## column in table order, song_match_key included, so they load the staging tables
+## directly. source is a prefix, or a manifest when manifest is ' MANIFEST'
+parquet_copy_template = ("""
+    COPY {table}
+    FROM '{source}'
+    CREDENTIALS 'aws_iam_role={iam_role_arn}'
+    COMPUPDATE OFF
+    REGION '{region}'
+    FORMAT AS PARQUET{manifest};
+""")
+
+
+## Normalized, hashed title/artist key. Both staging tables are distributed on it,
+## so the songplay join is slice-local. Rows that can't match get a key of their
+## own so they still spread evenly across slices. Computed while the raw rows are
+## copied over, so COPY itself runs on every slice and no row is rewritten
+staging_events_table_insert = ("""
+INSERT INTO staging_events ({columns},song_match_key)
+SELECT  {columns}
+        ,CASE
+            WHEN song IS NULL OR artist IS NULL
+            THEN MD5('unmatched|' || ts::VARCHAR || '|' || COALESCE(session_id, 0)::VARCHAR
+                     || '|' || COALESCE(item_in_session, 0)::VARCHAR)
+            ELSE MD5(LOWER(TRIM(song)) || '|' || LOWER(TRIM(artist)))
+        END
+FROM    staging_events_raw;
+""").format(columns=staging_events_columns)
+
+staging_songs_table_insert = ("""
+INSERT INTO staging_songs ({columns},song_match_key)
+SELECT  {columns}
+        ,CASE
+            WHEN title IS NULL OR artist_name IS NULL
+            THEN MD5('unmatched|' || song_id)
+            ELSE MD5(LOWER(TRIM(title)) || '|' || LOWER(TRIM(artist_name)))
+        END
+FROM    staging_songs_raw;
+""").format(columns=staging_songs_columns)
 
 
 # ANALYTICS TABLES
@@ -167,103 +169,474 @@ SELECT DISTINCT
         ,se.user_agent
 FROM    staging_events se
 JOIN    staging_songs  ss
-  ON    se.song = ss.title
- AND    se.artist = ss.artist_name
+  ON    se.song_match_key = ss.song_match_key
 WHERE   se.page = 'NextSong'
  AND    se.user_id IS NOT NULL;
 """)
 
+## Dimensions keep one row per natural key, ranked with ROW_NUMBER() over the
+## key alone instead of a DISTINCT over every column. Users keep their latest
+## event, so a level change doesn't add a second row
 user_table_insert = ("""
 INSERT INTO users (user_id,first_name,last_name,gender,level)
-SELECT DISTINCT
-        user_id
+SELECT  user_id
         ,first_name
         ,last_name
         ,gender
         ,level
-FROM    staging_events
-WHERE   user_id IS NOT NULL;
+FROM    (SELECT user_id
+                ,first_name
+                ,last_name
+                ,gender
+                ,level
+                ,ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS key_rank
+         FROM   staging_events
+         WHERE  user_id IS NOT NULL) se
+WHERE   key_rank = 1;
 """)
 
 song_table_insert = ("""
 INSERT INTO songs (song_id,title,artist_id,year,duration)
-SELECT DISTINCT
-        song_id
+SELECT  song_id
         ,title
         ,artist_id
         ,year
         ,duration
-FROM    staging_songs
-WHERE   song_id IS NOT NULL;
+FROM    (SELECT song_id
+                ,title
+                ,artist_id
+                ,year
+                ,duration
+                ,ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC, duration DESC) AS key_rank
+         FROM   staging_songs
+         WHERE  song_id IS NOT NULL) ss
+WHERE   key_rank = 1;
 """)
 
 artist_table_insert = ("""
 INSERT INTO artists (artist_id,name,location,latitude,longitue)
-SELECT DISTINCT
-        artist_id
+SELECT  artist_id
         ,artist_name
         ,artist_location
         ,artist_latitude
         ,artist_longitude
-FROM    staging_songs
-WHERE   artist_id IS NOT NULL;
+FROM    (SELECT artist_id
+                ,artist_name
+                ,artist_location
+                ,artist_latitude
+                ,artist_longitude
+                ,ROW_NUMBER() OVER (PARTITION BY artist_id
+                                    ORDER BY artist_location NULLS LAST, artist_name) AS key_rank
+         FROM   staging_songs
+         WHERE  artist_id IS NOT NULL) ss
+WHERE   key_rank = 1;
 """)
 
 ## Note: IDENTITY columns (e.g., time_id) are automatically generated
+## Built from the start times of songplays newer than the high-water mark, which
+## is updated after the inserts, so only new timestamps are extracted. Runs after
+## songplay_table_insert
 time_table_insert = ("""
 INSERT INTO time (start_time,hour,day,week,month,year,weekday)
-SELECT DISTINCT
-        ts
-        ,EXTRACT(HOUR FROM ts)
-        ,EXTRACT(DAY FROM ts)
-        ,EXTRACT(WEEK FROM ts)
-        ,EXTRACT(MONTH FROM ts)
-        ,EXTRACT(YEAR FROM ts)
-        ,EXTRACT(DOW FROM ts)
-FROM    staging_events;
+SELECT  start_time
+        ,EXTRACT(HOUR FROM start_time)
+        ,EXTRACT(DAY FROM start_time)
+        ,EXTRACT(WEEK FROM start_time)
+        ,EXTRACT(MONTH FROM start_time)
+        ,EXTRACT(YEAR FROM start_time)
+        ,EXTRACT(DOW FROM start_time)
+FROM    (SELECT DISTINCT start_time
+         FROM   songplay
+         WHERE  start_time > (SELECT    COALESCE(MAX(high_water_mark), '1970-01-01'::TIMESTAMP)
+                              FROM      load_watermark
+                              WHERE     table_name = 'songplay')) sp
+WHERE   NOT EXISTS (SELECT 1 FROM time t WHERE t.start_time = sp.start_time);
+""")
+
+# INCREMENTAL LOADS
+## Drops staged events already covered by the songplay high-water mark
+staging_events_prune = ("""
+DELETE FROM staging_events
+WHERE   ts <= (SELECT   COALESCE(MAX(high_water_mark), '1970-01-01'::TIMESTAMP)
+               FROM     load_watermark
+               WHERE    table_name = 'songplay');
+""")
+
+## Dimensions are upserted with delete+insert keyed on their natural key
+user_table_delete = ("""
+DELETE FROM users
+USING   staging_events se
+WHERE   users.user_id = se.user_id;
+""")
+
+song_table_delete = ("""
+DELETE FROM songs
+USING   staging_songs ss
+WHERE   songs.song_id = ss.song_id;
+""")
+
+artist_table_delete = ("""
+DELETE FROM artists
+USING   staging_songs ss
+WHERE   artists.artist_id = ss.artist_id;
+""")
+
+load_watermark_update = ("""
+INSERT INTO load_watermark (table_name,high_water_mark,loaded_at)
+SELECT  'songplay'
+        ,MAX(start_time)
+        ,GETDATE()
+FROM    songplay;
+""")
+
+## A new version for every analytics table. Written after each full or incremental load
+load_versions_update = ("""
+INSERT INTO load_versions (table_name,loaded_at)
+VALUES  ('songplay', GETDATE())
+        ,('users', GETDATE())
+        ,('songs', GETDATE())
+        ,('artists', GETDATE())
+        ,('time', GETDATE());
+""")
+
+# ROLLUPS
+## Buckets are recomputed from songplay only where the staged events (already
+## pruned to new events on incremental loads) fall, then a new load version is
+## stored for the rollup. Each delete+insert runs in a single transaction
+song_plays_daily_delete = ("""
+DELETE FROM song_plays_daily
+WHERE   play_day IN (SELECT DISTINCT DATE_TRUNC('day', ts) FROM staging_events WHERE page = 'NextSong');
+""")
+
+song_plays_daily_insert = ("""
+INSERT INTO song_plays_daily (play_day,song_id,artist_id,plays)
+SELECT  DATE_TRUNC('day', start_time)
+        ,song_id
+        ,artist_id
+        ,COUNT(*)
+FROM    songplay
+WHERE   DATE_TRUNC('day', start_time) IN (SELECT DISTINCT DATE_TRUNC('day', ts)
+                                          FROM   staging_events
+                                          WHERE  page = 'NextSong')
+GROUP BY 1, 2, 3;
+""")
+
+level_users_hourly_delete = ("""
+DELETE FROM level_users_hourly
+WHERE   play_hour IN (SELECT DISTINCT DATE_TRUNC('hour', ts) FROM staging_events WHERE page = 'NextSong');
+""")
+
+level_users_hourly_insert = ("""
+INSERT INTO level_users_hourly (play_hour,level,plays,active_users)
+SELECT  DATE_TRUNC('hour', start_time)
+        ,level
+        ,COUNT(*)
+        ,COUNT(DISTINCT user_id)
+FROM    songplay
+WHERE   DATE_TRUNC('hour', start_time) IN (SELECT DISTINCT DATE_TRUNC('hour', ts)
+                                           FROM   staging_events
+                                           WHERE  page = 'NextSong')
+GROUP BY 1, 2;
+""")
+
+artist_plays_weekly_delete = ("""
+DELETE FROM artist_plays_weekly
+WHERE   play_week IN (SELECT DISTINCT DATE_TRUNC('week', ts) FROM staging_events WHERE page = 'NextSong');
 """)
 
+artist_plays_weekly_insert = ("""
+INSERT INTO artist_plays_weekly (play_week,artist_id,plays,listeners)
+SELECT  DATE_TRUNC('week', start_time)
+        ,artist_id
+        ,COUNT(*)
+        ,COUNT(DISTINCT user_id)
+FROM    songplay
+WHERE   DATE_TRUNC('week', start_time) IN (SELECT DISTINCT DATE_TRUNC('week', ts)
+                                           FROM   staging_events
+                                           WHERE  page = 'NextSong')
+GROUP BY 1, 2;
+""")
+
+song_plays_daily_version = "INSERT INTO load_versions (table_name,loaded_at) VALUES ('song_plays_daily', GETDATE());"
+level_users_hourly_version = "INSERT INTO load_versions (table_name,loaded_at) VALUES ('level_users_hourly', GETDATE());"
+artist_plays_weekly_version = "INSERT INTO load_versions (table_name,loaded_at) VALUES ('artist_plays_weekly', GETDATE());"
+
 ## DATA VALIDATION QUERIES
-staging_events_test = "SELECT COUNT(*) FROM staging_events;"
-staging_songs_test = "SELECT COUNT(*) FROM staging_songs;"
-songplay_test = "SELECT COUNT(*) FROM songplay;"
-users_test = "SELECT COUNT(*) FROM users;"
-songs_test = "SELECT COUNT(*) FROM songs;"
-artists_test = "SELECT COUNT(*) FROM artists;"
-time_test = "SELECT COUNT(*) FROM time;"
+## Row counts of every table in a single round trip
+table_counts_test = ("""
+SELECT 'staging_events', COUNT(*) FROM staging_events
+UNION ALL SELECT 'staging_songs', COUNT(*) FROM staging_songs
+UNION ALL SELECT 'songplay', COUNT(*) FROM songplay
+UNION ALL SELECT 'users', COUNT(*) FROM users
+UNION ALL SELECT 'songs', COUNT(*) FROM songs
+UNION ALL SELECT 'artists', COUNT(*) FROM artists
+UNION ALL SELECT 'time', COUNT(*) FROM time;
+""")
+
+## Reconciliation checks. Each returns one row, and every value must be 0
+## Staged NextSong events that match a song but didn't reach songplay
+songplay_reconciliation_test = ("""
+SELECT  COUNT(*) AS missing_songplays
+FROM    staging_events se
+JOIN    staging_songs  ss
+  ON    se.song_match_key = ss.song_match_key
+WHERE   se.page = 'NextSong'
+ AND    se.user_id IS NOT NULL
+ AND    NOT EXISTS (SELECT 1
+                    FROM   songplay sp
+                    WHERE  sp.start_time = se.ts
+                     AND   sp.user_id = se.user_id
+                     AND   sp.session_id = se.session_id);
+""")
+
+## songplay keys without a row in their dimension
+songplay_orphans_test = ("""
+SELECT  SUM(CASE WHEN s.song_id IS NULL THEN 1 ELSE 0 END) AS orphan_song_id
+        ,SUM(CASE WHEN a.artist_id IS NULL THEN 1 ELSE 0 END) AS orphan_artist_id
+        ,SUM(CASE WHEN u.user_id IS NULL THEN 1 ELSE 0 END) AS orphan_user_id
+        ,SUM(CASE WHEN t.start_time IS NULL THEN 1 ELSE 0 END) AS orphan_start_time
+FROM    songplay sp
+LEFT JOIN songs   s ON sp.song_id = s.song_id
+LEFT JOIN artists a ON sp.artist_id = a.artist_id
+LEFT JOIN users   u ON sp.user_id = u.user_id
+LEFT JOIN time    t ON sp.start_time = t.start_time;
+""")
+
+## Dimension keys held by more than one row
+duplicate_keys_test = ("""
+SELECT  (SELECT COUNT(*) FROM (SELECT user_id FROM users GROUP BY user_id HAVING COUNT(*) > 1) d) AS duplicate_user_id
+        ,(SELECT COUNT(*) FROM (SELECT song_id FROM songs GROUP BY song_id HAVING COUNT(*) > 1) d) AS duplicate_song_id
+        ,(SELECT COUNT(*) FROM (SELECT artist_id FROM artists GROUP BY artist_id HAVING COUNT(*) > 1) d) AS duplicate_artist_id
+        ,(SELECT COUNT(*) FROM (SELECT start_time FROM time GROUP BY start_time HAVING COUNT(*) > 1) d) AS duplicate_start_time;
+""")
+
+## Share of NULLs in columns analytics rely on. Every value must stay under max_null_rate
+songplay_null_rate_test = ("""
+SELECT  AVG(CASE WHEN user_id IS NULL THEN 1.0 ELSE 0.0 END) AS user_id
+        ,AVG(CASE WHEN level IS NULL THEN 1.0 ELSE 0.0 END) AS level
+        ,AVG(CASE WHEN session_id IS NULL THEN 1.0 ELSE 0.0 END) AS session_id
+        ,AVG(CASE WHEN location IS NULL THEN 1.0 ELSE 0.0 END) AS location
+FROM    songplay;
+""")
+
+users_null_rate_test = ("""
+SELECT  AVG(CASE WHEN first_name IS NULL THEN 1.0 ELSE 0.0 END) AS first_name
+        ,AVG(CASE WHEN last_name IS NULL THEN 1.0 ELSE 0.0 END) AS last_name
+        ,AVG(CASE WHEN level IS NULL THEN 1.0 ELSE 0.0 END) AS level
+FROM    users;
+""")
+
+songs_null_rate_test = ("""
+SELECT  AVG(CASE WHEN title IS NULL THEN 1.0 ELSE 0.0 END) AS title
+        ,AVG(CASE WHEN artist_id IS NULL THEN 1.0 ELSE 0.0 END) AS artist_id
+FROM    songs;
+""")
+
+artists_null_rate_test = ("""
+SELECT  AVG(CASE WHEN name IS NULL THEN 1.0 ELSE 0.0 END) AS name
+FROM    artists;
+""")
 
 
 
+# LOAD ERRORS
+## Rows COPY rejected are logged to STL_LOAD_ERRORS, which keeps them after a rollback.
+## The latest query id logged by this session is read before a COPY, so only rows
+## logged after it, i.e. by that COPY and its retries, are read back
+load_errors_last_query = ("""
+SELECT  COALESCE(MAX(query), 0)
+FROM    stl_load_errors
+WHERE   session = pg_backend_pid();
+""")
+
+load_errors_select = ("""
+SELECT  query
+        ,TRIM(filename) AS filename
+        ,line_number
+        ,TRIM(colname) AS colname
+        ,err_code
+        ,TRIM(err_reason) AS err_reason
+        ,TRIM(raw_field_value) AS raw_field_value
+        ,TRIM(raw_line) AS raw_line
+FROM    stl_load_errors
+WHERE   session = pg_backend_pid()
+AND     query > %(after)s
+ORDER BY query, filename, line_number;
+""")
+
+
+
+# QUERY REGISTRY
+## Name, parameters, and tables read (inputs) and written (outputs) of every
+## load statement. The parallel stages schedule statements from these
+query_registry.register('staging_events_copy', staging_events_copy_template
+                        ,params={'columns': staging_events_columns, 'source': None
+                                 ,'iam_role_arn': None, 'region': None, 'jsonpaths': None
+                                 ,'maxerror': ''}
+                        ,outputs=['staging_events_raw'])
+query_registry.register('staging_songs_copy', staging_songs_copy_template
+                        ,params={'columns': staging_songs_columns, 'source': None
+                                 ,'iam_role_arn': None, 'region': None, 'maxerror': ''}
+                        ,outputs=['staging_songs_raw'])
+query_registry.register('staging_events_manifest_copy', staging_events_manifest_copy_template
+                        ,params={'columns': staging_events_columns, 'manifest_url': None
+                                 ,'iam_role_arn': None, 'region': None, 'jsonpaths': None
+                                 ,'compression': '', 'maxerror': ''}
+                        ,outputs=['staging_events_raw'])
+query_registry.register('staging_songs_manifest_copy', staging_songs_manifest_copy_template
+                        ,params={'columns': staging_songs_columns, 'manifest_url': None
+                                 ,'iam_role_arn': None, 'region': None, 'compression': ''
+                                 ,'maxerror': ''}
+                        ,outputs=['staging_songs_raw'])
+for table in ['staging_events', 'staging_songs']:
+    query_registry.register(f"{table}_parquet_copy", parquet_copy_template
+                            ,params={'table': table, 'source': None, 'iam_role_arn': None
+                                     ,'region': None, 'manifest': ''}
+                            ,outputs=[table])
+query_registry.register('staging_events_table_insert', staging_events_table_insert
+                        ,inputs=['staging_events_raw'], outputs=['staging_events'])
+query_registry.register('staging_songs_table_insert', staging_songs_table_insert
+                        ,inputs=['staging_songs_raw'], outputs=['staging_songs'])
+query_registry.register('songplay_table_insert', songplay_table_insert
+                        ,inputs=['staging_events', 'staging_songs'], outputs=['songplay'])
+query_registry.register('user_table_insert', user_table_insert
+                        ,inputs=['staging_events'], outputs=['users'])
+query_registry.register('song_table_insert', song_table_insert
+                        ,inputs=['staging_songs'], outputs=['songs'])
+query_registry.register('artist_table_insert', artist_table_insert
+                        ,inputs=['staging_songs'], outputs=['artists'])
+query_registry.register('time_table_insert', time_table_insert
+                        ,inputs=['songplay', 'load_watermark', 'time'], outputs=['time'])
+query_registry.register('staging_events_prune', staging_events_prune
+                        ,inputs=['load_watermark', 'staging_events'], outputs=['staging_events'])
+query_registry.register('user_table_delete', user_table_delete
+                        ,inputs=['staging_events', 'users'], outputs=['users'])
+query_registry.register('song_table_delete', song_table_delete
+                        ,inputs=['staging_songs', 'songs'], outputs=['songs'])
+query_registry.register('artist_table_delete', artist_table_delete
+                        ,inputs=['staging_songs', 'artists'], outputs=['artists'])
+query_registry.register('load_watermark_update', load_watermark_update
+                        ,inputs=['songplay'], outputs=['load_watermark'])
+query_registry.register('load_versions_update', load_versions_update
+                        ,outputs=['load_versions'])
+for rollup in ['song_plays_daily', 'level_users_hourly', 'artist_plays_weekly']:
+    query_registry.register(f"{rollup}_delete", globals()[f"{rollup}_delete"]
+                            ,inputs=['staging_events', rollup], outputs=[rollup])
+    query_registry.register(f"{rollup}_insert", globals()[f"{rollup}_insert"]
+                            ,inputs=['songplay', 'staging_events'], outputs=[rollup])
+    query_registry.register(f"{rollup}_version", globals()[f"{rollup}_version"]
+                            ,outputs=['load_versions'])
+
+
 # QUERY LISTS
-drop_table_queries = [staging_events_table_drop
+drop_table_queries = [staging_events_raw_table_drop
+                      ,staging_songs_raw_table_drop
+                      ,staging_events_table_drop
                       ,staging_songs_table_drop
                       ,songplay_table_drop
                       ,user_table_drop
                       ,song_table_drop
                       ,artist_table_drop
-                      ,time_table_drop]
-
-create_table_queries = [staging_events_table_create
-                        ,staging_songs_table_create
-                        ,songplay_table_create
-                        ,user_table_create
-                        ,song_table_create
-                        ,artist_table_create
-                        ,time_table_create]
-
-copy_table_queries = [staging_events_copy
-                      ,staging_songs_copy]
-
-insert_table_queries = [songplay_table_insert
-                        ,user_table_insert
-                        ,song_table_insert
-                        ,artist_table_insert
-                        ,time_table_insert]
-
-data_validation_queries = [staging_events_test
-                        ,staging_songs_test
-                        ,songplay_test
-                        ,users_test
-                        ,songs_test
-                        ,artists_test
-                        ,time_test]
\ No newline at end of file
+                      ,time_table_drop
+                      ,load_watermark_table_drop
+                      ,load_versions_table_drop
+                      ,song_plays_daily_table_drop
+                      ,level_users_hourly_table_drop
+                      ,artist_plays_weekly_table_drop]
+
+truncate_table_queries = [staging_events_raw_table_truncate
+                          ,staging_songs_raw_table_truncate
+                          ,staging_events_table_truncate
+                          ,staging_songs_table_truncate]
+
+## Run after the COPY at the same position in copy_table_names
+copy_table_names = ['staging_events_copy', 'staging_songs_copy']
+staging_insert_names = ['staging_events_table_insert', 'staging_songs_table_insert']
+staging_insert_queries = query_registry.render_all(staging_insert_names)
+
+insert_table_names = ['songplay_table_insert'
+                      ,'user_table_insert'
+                      ,'song_table_insert'
+                      ,'artist_table_insert'
+                      ,'time_table_insert']
+insert_table_queries = query_registry.render_all(insert_table_names)
+
+## Each entry runs in a single transaction, so readers never see a dimension mid-upsert
+upsert_table_names = [['songplay_table_insert']
+                      ,['user_table_delete', 'user_table_insert']
+                      ,['song_table_delete', 'song_table_insert']
+                      ,['artist_table_delete', 'artist_table_insert']
+                      ,['time_table_insert']]
+upsert_table_queries = [query_registry.render_all(names) for names in upsert_table_names]
+
+## Each entry runs in a single transaction after the analytics tables are loaded
+rollup_table_names = [['song_plays_daily_delete', 'song_plays_daily_insert', 'song_plays_daily_version']
+                      ,['level_users_hourly_delete', 'level_users_hourly_insert', 'level_users_hourly_version']
+                      ,['artist_plays_weekly_delete', 'artist_plays_weekly_insert', 'artist_plays_weekly_version']]
+rollup_table_queries = [query_registry.render_all(names) for names in rollup_table_names]
+
+## (check name, query, kind). 'zero' checks pass when every value is 0,
+## 'null_rate' checks when every value is at most max_null_rate
+data_validation_checks = [('songplay_reconciliation', songplay_reconciliation_test, 'zero')
+                          ,('songplay_orphans', songplay_orphans_test, 'zero')
+                          ,('duplicate_keys', duplicate_keys_test, 'zero')
+                          ,('songplay_null_rate', songplay_null_rate_test, 'null_rate')
+                          ,('users_null_rate', users_null_rate_test, 'null_rate')
+                          ,('songs_null_rate', songs_null_rate_test, 'null_rate')
+                          ,('artists_null_rate', artists_null_rate_test, 'null_rate')]
+
+
+# CONFIG-DEPENDENT QUERIES
+def copy_params(db_config):
+    """ Gets the parameters of every registered COPY from the configuration.
+    Override any of them when rendering, e.g. source for a single partition
+
+    Args:
+    db_config (dict):[dictionary containing database configuration]
+
+    Returns:
+    params (dict): [COPY name mapped to its parameters]
+    """
+    common = {'iam_role_arn': db_config['iam_role_arn']
+              # S3 bucket can be in a different region from the Redshift Cluster
+              ,'region': db_config['s3_region']}
+    # Tolerant loads skip up to max_errors bad records per COPY. Parquet COPYs don't take MAXERROR
+    json_common = {**common, 'maxerror': f" MAXERROR {db_config['max_errors']}" if db_config['tolerant_load'] else ''}
+    events = {**json_common, 'jsonpaths': db_config['s3_log_metadata']}
+    return {'staging_events_copy': {**events, 'source': db_config['s3_log_data']}
+            ,'staging_songs_copy': {**json_common, 'source': db_config['s3_song_data']}
+            ,'staging_events_manifest_copy': events
+            ,'staging_songs_manifest_copy': json_common
+            ,'staging_events_parquet_copy': common
+            ,'staging_songs_parquet_copy': common}
+
+## Rendered when first read, e.g. sql_queries.copy_table_queries, so importing this
+## module does no I/O and COPYs pick up the IAM role ARN created by the run
+def _render(name, db_config):
+    if name in create_table_names:
+        table = create_table_names[name]
+        return schema.create_table_sql(table, schema.read_encodings(db_config['encodings_path']).get(table))
+    if name == 'create_table_queries':
+        return [_render(query, db_config) for query in create_table_names]
+    if name in ('staging_events_copy', 'staging_songs_copy'):
+        return query_registry.render(name, **copy_params(db_config)[name])
+    if name == 'copy_table_queries':
+        return [_render(query, db_config) for query in copy_table_names]
+    if name == 'manifest_copy_queries':
+        ## (target table, S3 source prefix, manifest COPY name, its parameters but the
+        ## manifest url, staging insert) for ledger-based loads
+        params = copy_params(db_config)
+        return [('staging_events', db_config['s3_log_data'], 'staging_events_manifest_copy'
+                 ,params['staging_events_manifest_copy'], staging_events_table_insert)
+                ,('staging_songs', db_config['s3_song_data'], 'staging_songs_manifest_copy'
+                  ,params['staging_songs_manifest_copy'], staging_songs_table_insert)]
+    raise AttributeError(f"module 'sql_queries' has no attribute '{name}'")
+
+_rendered_names = set(create_table_names) | {'create_table_queries', 'copy_table_queries', 'manifest_copy_queries'
+                                             ,'staging_events_copy', 'staging_songs_copy'}
+
+def __getattr__(name):
+    # Unknown names (e.g. __path__, probed by the import system) must not read the config
+    if name not in _rendered_names:
+        raise AttributeError(f"module 'sql_queries' has no attribute '{name}'")
+    return _render(name, config_loader.get_config())
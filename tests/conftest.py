@@ -0,0 +1,65 @@
+"""
+THIS MODULE INCLUDES FIXTURES SHARED BY THE TESTS: A MOTO S3 BUCKET AND THE
+CONFIGURATION POINTED AT IT
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import sys
+import boto3
+import pytest
+from moto import mock_aws
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_loader
+import instrumentation
+
+BUCKET = 'sparkify-test'
+REGION = 'us-west-2'
+
+@pytest.fixture
+def aws(monkeypatch):
+    """ Mocks every AWS service for the test """
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    with mock_aws():
+        yield
+
+@pytest.fixture
+def s3(aws):
+    """ S3 client with an empty source bucket """
+    client = boto3.client('s3', region_name=REGION)
+    client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+    return client
+
+@pytest.fixture
+def db_config(tmp_path, monkeypatch):
+    """ The shared configuration, read by sql_queries, pointed at the test
+    bucket and a ledger under tmp_path. Changes are undone after the test """
+    db_config = config_loader.get_config()
+    for name, value in {'s3_log_data': f"s3://{BUCKET}/log_data/"
+                        ,'s3_song_data': f"s3://{BUCKET}/song_data/"
+                        ,'s3_manifest_prefix': f"s3://{BUCKET}/manifests"
+                        ,'s3_parquet_prefix': f"s3://{BUCKET}/parquet"
+                        ,'s3_quarantine_prefix': ''
+                        ,'ledger_path': str(tmp_path / 'ledger.json')
+                        ,'iam_role_arn': 'arn:aws:iam::123456789012:role/test'
+                        ,'use_ledger': True
+                        ,'use_parquet': False
+                        ,'compact_sources': False
+                        ,'tolerant_load': False
+                        ,'parallel_load': False}.items():
+        monkeypatch.setitem(db_config, name, value)
+    instrumentation.configure(redshift=False)
+    instrumentation.reset()
+    return db_config
+
+def upload_dir(s3, directory, prefix=''):
+    """ Uploads every file under directory, keyed by its relative path after prefix """
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            s3.upload_file(path, BUCKET, prefix + os.path.relpath(path, directory).replace(os.sep, '/'))
@@ -0,0 +1,64 @@
+"""
+THIS MODULE INCLUDES TESTS OF THE ANALYTICS RESULT CACHE ON THE DUCKDB BACKEND
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import pytest
+import analytics
+
+@pytest.fixture
+def loaded_cur(db_config, tmp_path):
+    pytest.importorskip('duckdb')
+    import backends
+    import create_tables
+    import data_generator
+    import etl
+    import rollups
+    data_generator.generate(str(tmp_path), 2000, n_songs=100, n_users=20, n_days=2)
+    conn = backends.connect('duckdb', data_dir=str(tmp_path))
+    cur = conn.cursor()
+    create_tables.create_tables(cur, conn)
+    etl.load_staging_tables(cur, conn)
+    etl.insert_tables(cur, conn)
+    rollups.refresh_rollups(cur, conn)
+    yield cur
+    cur.close()
+    conn.close()
+
+class Counting_cursor:
+    """ Counts the load_versions lookups run through a cursor """
+    def __init__(self, cur):
+        self.cur = cur
+        self.version_lookups = 0
+
+    def execute(self, query, params=None):
+        if query is analytics.load_versions_query:
+            self.version_lookups += 1
+        return self.cur.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+def test_cache_hits_skip_version_lookups(loaded_cur):
+    now = [0]
+    cache = analytics.Query_cache(ttl=300, version_ttl=30, clock=lambda: now[0])
+    cur = Counting_cursor(loaded_cur)
+    first = analytics.run_query(cur, 'top_artists', cache)
+    assert analytics.run_query(cur, 'top_artists', cache) == first
+    assert (cache.hits, cache.misses, cur.version_lookups) == (1, 1, 1)
+
+    # Past version_ttl the versions are looked up again, and still match
+    now[0] = 31
+    assert analytics.run_query(cur, 'top_artists', cache) == first
+    assert (cache.hits, cur.version_lookups) == (2, 2)
+
+    cache.forget_versions()
+    analytics.run_query(cur, 'top_artists', cache)
+    assert cur.version_lookups == 3
+
+def test_get_cache_is_shared(monkeypatch):
+    monkeypatch.setattr(analytics, '_cache', None)
+    cache = analytics.get_cache(10, 60, 5)
+    assert analytics.get_cache() is cache
+    assert (cache.max_entries, cache.ttl, cache.version_ttl) == (10, 60, 5)
@@ -0,0 +1,38 @@
+"""
+THIS MODULE INCLUDES TESTS OF THE LOCAL DUCKDB BACKEND, RUNNING THE PIPELINE
+MODULES ON IT AS THE README SHOWS
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import pytest
+import instrumentation
+
+def test_readme_snippet_runs_the_pipeline(tmp_path, monkeypatch):
+    pytest.importorskip('duckdb')
+    import analytics
+    import backends
+    import create_tables
+    import data_generator
+    import etl
+    import rollups
+    from aws_functions import Data_validation
+    data_generator.generate(str(tmp_path), 500, n_songs=50, n_users=10, n_days=2)
+    # As in a fresh process, with nothing switched to local mode by hand
+    monkeypatch.setitem(instrumentation._settings, 'redshift', True)
+
+    conn = backends.connect('duckdb', data_dir=str(tmp_path))
+    cur = conn.cursor()
+    try:
+        create_tables.create_tables(cur, conn)
+        etl.load_staging_tables(cur, conn)
+        etl.insert_tables(cur, conn)
+        etl.update_watermark(cur, conn)
+        rollups.refresh_rollups(cur, conn)
+        report = Data_validation.testing_queries(cur, conn)
+        assert report['counts']['songplay'] > 0
+        analytics.log_sample_queries(cur)
+    finally:
+        cur.close()
+        conn.close()
+    assert all(record['query_id'] is None for record in instrumentation.records())
@@ -0,0 +1,55 @@
+"""
+THIS MODULE INCLUDES TESTS OF CLUSTER SIZING FROM THE VOLUME OF A MOTO S3 SOURCE
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import json
+import cluster_planner
+import ledger
+from conftest import BUCKET
+
+def _put_sources(s3, n_events, n_songs, size):
+    for i in range(n_events):
+        s3.put_object(Bucket=BUCKET, Key=f"log_data/{i:04d}-events.json", Body=b'x' * size)
+    for i in range(n_songs):
+        s3.put_object(Bucket=BUCKET, Key=f"song_data/A/{i:04d}.json", Body=b'x' * size)
+
+def test_source_volume_skips_loaded_events_only(s3, db_config, tmp_path):
+    _put_sources(s3, 4, 3, 100)
+    volume = cluster_planner.source_volume(s3, db_config)
+    assert volume == {'staging_events': {'objects': 4, 'bytes': 400}
+                      ,'staging_songs': {'objects': 3, 'bytes': 300}}
+    loaded = {table: ledger.list_objects(s3, url) for table, url in
+              [('staging_events', db_config['s3_log_data']), ('staging_songs', db_config['s3_song_data'])]}
+    volume = cluster_planner.source_volume(s3, db_config, loaded)
+    assert volume['staging_events']['objects'] == 0
+    assert volume['staging_songs']['objects'] == 3
+
+def test_size_cluster_small_sources_get_one_node(s3, db_config, monkeypatch):
+    _put_sources(s3, 2, 2, 1000)
+    for name, value in {'benchmark_path': '', 'target_runtime': 1800, 'load_mode': 'full'
+                        ,'planner_node_types': 'dc2.large, ra3.xlplus, ra3.4xlarge'}.items():
+        monkeypatch.setitem(db_config, name, value)
+    cluster_plan = cluster_planner.size_cluster(s3, db_config)
+    assert (db_config['node_type'], db_config['n_nodes'], db_config['cluster_type']) == ('dc2.large', '1', 'single-node')
+    assert cluster_plan['seconds'] <= 1800
+
+def test_size_cluster_scales_out_with_calibrated_throughput(s3, db_config, tmp_path, monkeypatch):
+    _put_sources(s3, 32, 32, 4096)
+    # 1 KiB/s per slice for COPY and INSERT, so 256 KiB of sources need many slices
+    benchmark_path = tmp_path / 'benchmark.json'
+    benchmark_path.write_text(json.dumps({'source_bytes': 1024
+                                          ,'median_seconds': {'load_staging_tables': 1, 'insert_tables': 1}}))
+    for name, value in {'benchmark_path': str(benchmark_path), 'target_runtime': 60, 'load_mode': 'full'
+                        ,'planner_node_types': 'dc2.large'}.items():
+        monkeypatch.setitem(db_config, name, value)
+    cluster_plan = cluster_planner.size_cluster(s3, db_config)
+    assert db_config['node_type'] == 'dc2.large'
+    assert int(db_config['n_nodes']) > 1 and db_config['cluster_type'] == 'multi-node'
+    assert cluster_plan['seconds'] <= 60
+    # The cheapest cluster on time: one node less misses the target
+    throughput = cluster_planner.calibrate(str(benchmark_path))
+    volume = cluster_planner.source_volume(s3, db_config)
+    smaller = cluster_planner.estimate(volume, 'dc2.large', int(db_config['n_nodes']) - 1, throughput)
+    assert smaller['seconds'] > 60
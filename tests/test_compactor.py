@@ -0,0 +1,56 @@
+"""
+THIS MODULE INCLUDES TESTS OF HOW SOURCE OBJECTS ARE SPLIT INTO CHUNKS, AND OF
+THE CHUNKS COMPACT() WRITES TO A MOTO S3 BUCKET
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import gzip
+import compactor
+from conftest import BUCKET
+
+MIB = 2**20
+
+def _objects(sizes):
+    return {f"s3://{BUCKET}/song_data/{i:04d}.json": {'etag': str(i), 'size': size} for i, size in enumerate(sizes)}
+
+def _bytes(chunk):
+    return sum(end - first for _, first, end in chunk)
+
+def test_large_objects_are_split_over_a_multiple_of_slices():
+    # 1000 MiB over 8 slices at 64 MiB per chunk needs 16 chunks, not one per object
+    chunks = compactor.plan_chunks(_objects([100 * MIB] * 10), 8)
+    assert len(chunks) == 16
+    assert {_bytes(chunk) for chunk in chunks} == {1000 * MIB // 16}
+    assert sum(_bytes(chunk) for chunk in chunks) == 1000 * MIB
+
+def test_few_and_empty_objects_still_fill_every_slice():
+    chunks = compactor.plan_chunks(_objects([0, 0, 0, 300, 100, 0]), 4)
+    assert len(chunks) == 4
+    assert [_bytes(chunk) for chunk in chunks] == [100] * 4
+    # Empty objects have no bytes to place
+    assert {url for chunk in chunks for url, _, _ in chunk} == {f"s3://{BUCKET}/song_data/0003.json"
+                                                                 ,f"s3://{BUCKET}/song_data/0004.json"}
+
+def test_compact_streams_every_record_into_chunks_of_equal_size(s3):
+    records = []
+    for i in range(10):
+        lines = [f'{{"object": {i}, "line": {j:02d}, "pad": "{"x" * 20}"}}'.encode() for j in range(20)]
+        records += lines
+        s3.put_object(Bucket=BUCKET, Key=f"log_data/{i:04d}.json", Body=b'\n'.join(lines) + b'\n')
+    s3.put_object(Bucket=BUCKET, Key='log_data/empty.json', Body=b'')
+    objects = {f"s3://{BUCKET}/log_data/{name}": None for name in [f"{i:04d}.json" for i in range(10)] + ['empty.json']}
+    objects = {url: {'etag': '', 'size': s3.head_object(Bucket=BUCKET, Key=url.split('/', 3)[3])['ContentLength']}
+               for url in objects}
+    total = sum(meta['size'] for meta in objects.values())
+
+    chunks = compactor.compact(s3, objects, f"s3://{BUCKET}/manifests/compacted", 8, chunk_bytes=total // 12)
+    assert len(chunks) == 16
+    written = []
+    for url in sorted(chunks):
+        body = gzip.decompress(s3.get_object(Bucket=BUCKET, Key=url.split('/', 3)[3])['Body'].read())
+        written.append(body.splitlines())
+    # Every record exactly once, in order, and chunks within a record of the budget
+    assert [record for chunk in written for record in chunk] == records
+    record_bytes = len(records[0]) + 1
+    assert all(abs(sum(len(record) + 1 for record in chunk) - total / 16) <= record_bytes for chunk in written)
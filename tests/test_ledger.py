@@ -0,0 +1,129 @@
+"""
+THIS MODULE INCLUDES TESTS OF THE LOAD LEDGER AND OF LEDGER-BASED LOADS,
+AGAINST A MOTO S3 BUCKET AND THE DUCKDB BACKEND
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import os
+import json
+import pytest
+import ledger
+from conftest import BUCKET, upload_dir
+
+def test_new_objects_and_manifest(s3, tmp_path):
+    s3.put_object(Bucket=BUCKET, Key='log_data/a.json', Body=b'{}')
+    s3.put_object(Bucket=BUCKET, Key='log_data/b.json', Body=b'{"a": 1}')
+    path = str(tmp_path / 'ledger.json')
+    objects = ledger.list_objects(s3, f"s3://{BUCKET}/log_data/")
+    assert ledger.new_objects(objects, ledger.read_ledger(path).get('staging_events', {})) == objects
+
+    ledger.record_loaded(path, 'staging_events', objects)
+    s3.put_object(Bucket=BUCKET, Key='log_data/b.json', Body=b'{"a": 2, "b": 3}')
+    s3.put_object(Bucket=BUCKET, Key='log_data/c.json', Body=b'{}')
+    objects = ledger.list_objects(s3, f"s3://{BUCKET}/log_data/")
+    pending = ledger.new_objects(objects, ledger.read_ledger(path)['staging_events'])
+    assert sorted(pending) == [f"s3://{BUCKET}/log_data/b.json", f"s3://{BUCKET}/log_data/c.json"]
+
+    url = f"s3://{BUCKET}/manifests/staging_events.manifest"
+    ledger.upload_manifest(s3, ledger.build_manifest(pending), url)
+    manifest = json.loads(s3.get_object(Bucket=BUCKET, Key='manifests/staging_events.manifest')['Body'].read())
+    assert [entry['url'] for entry in manifest['entries']] == sorted(pending)
+    assert all(entry['mandatory'] for entry in manifest['entries'])
+    assert manifest['entries'][0]['meta']['content_length'] == 16
+
+def _songplays(cur):
+    cur.execute("SELECT COUNT(*) FROM songplay;")
+    return cur.fetchone()[0]
+
+def test_incremental_ledger_load_matches_songs_of_earlier_runs(s3, db_config, tmp_path):
+    pytest.importorskip('duckdb')
+    import backends
+    import create_tables
+    import etl
+    import data_generator
+    data_dir = tmp_path / 'data'
+    data_generator.generate(str(data_dir), 2000, n_songs=100, n_users=20, n_days=4)
+    log_files = sorted(os.path.relpath(os.path.join(root, name), data_dir / 'log_data')
+                       for root, _, files in os.walk(data_dir / 'log_data') for name in files)
+    upload_dir(s3, data_dir / 'song_data', 'song_data/')
+    for name in log_files[:2]:
+        s3.upload_file(str(data_dir / 'log_data' / name), BUCKET, f"log_data/{name}")
+
+    conn = backends.connect('duckdb', s3=s3)
+    cur = conn.cursor()
+    try:
+        # Full load, as main() runs it
+        create_tables.drop_tables(cur, conn)
+        create_tables.create_tables(cur, conn)
+        loaded = etl.load_staging_tables_from_ledger(cur, conn, s3, db_config, reset=True)
+        assert {table: len(objects) for table, objects in loaded.items()} == {'staging_events': 2, 'staging_songs': 100}
+        etl.insert_tables(cur, conn)
+        etl.update_watermark(cur, conn)
+        etl.record_ledger(db_config, loaded, reset=True)
+        full = _songplays(cur)
+        assert full > 0
+
+        # Incremental load of the next two days
+        for name in log_files[2:]:
+            s3.upload_file(str(data_dir / 'log_data' / name), BUCKET, f"log_data/{name}")
+        create_tables.create_tables(cur, conn)
+        create_tables.truncate_staging_tables(cur, conn)
+        etl.load_staging_tables_from_ledger(cur, conn, s3, db_config)
+        # The insert stage failed, so nothing was recorded and the next run loads the same objects
+        create_tables.truncate_staging_tables(cur, conn)
+        loaded = etl.load_staging_tables_from_ledger(cur, conn, s3, db_config)
+        assert {table: len(objects) for table, objects in loaded.items()} == {'staging_events': 2, 'staging_songs': 100}
+        etl.upsert_tables(cur, conn)
+        etl.record_ledger(db_config, loaded)
+        incremental = _songplays(cur)
+        assert incremental > full * 1.5
+        assert len(ledger.read_ledger(db_config['ledger_path'])['staging_events']) == 4
+    finally:
+        cur.close()
+        conn.close()
+
+class _Recording_cursor:
+    """ Cursor that records statements instead of running them, as Parquet
+    COPYs don't run on the local backends """
+    def __init__(self):
+        self.queries = []
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        self.queries.append(query)
+
+class _Recording_connection:
+    def commit(self):
+        pass
+
+def _manifest_urls(s3, name):
+    manifest = json.loads(s3.get_object(Bucket=BUCKET, Key=f"manifests/{name}")['Body'].read())
+    return sorted(entry['url'] for entry in manifest['entries'])
+
+def test_parquet_files_of_a_failed_run_are_loaded_again(s3, db_config, monkeypatch):
+    pytest.importorskip('pyarrow')
+    import etl
+    monkeypatch.setitem(db_config, 'use_parquet', True)
+    s3.put_object(Bucket=BUCKET, Key='log_data/2018-11-01-events.json'
+                  ,Body=b'{"artist": "A", "song": "S", "ts": 1541105830796, "page": "NextSong"}\n')
+    s3.put_object(Bucket=BUCKET, Key='song_data/A/TRA.json'
+                  ,Body=b'{"song_id": "S1", "title": "S", "artist_id": "A1", "artist_name": "A", "duration": 1.0}')
+    cur = _Recording_cursor()
+    loaded = etl.load_staging_tables_from_parquet(cur, _Recording_connection(), s3, db_config, incremental=True)
+    parts = sorted(loaded['staging_events'])
+    assert len(parts) == 1 and _manifest_urls(s3, 'staging_events_parquet.manifest') == parts
+
+    # The upserts failed, so nothing was recorded: the next run loads the same file
+    cur = _Recording_cursor()
+    loaded = etl.load_staging_tables_from_parquet(cur, _Recording_connection(), s3, db_config, incremental=True)
+    assert sorted(loaded['staging_events']) == parts
+    assert sum('COPY staging_events' in query for query in cur.queries) == 1
+    etl.record_ledger(db_config, loaded, suffix=ledger.PARQUET_LOADED)
+
+    cur = _Recording_cursor()
+    loaded = etl.load_staging_tables_from_parquet(cur, _Recording_connection(), s3, db_config, incremental=True)
+    assert loaded['staging_events'] == {}
+    assert sum('COPY staging_events' in query for query in cur.queries) == 0
+    # Songs are copied in full every time
+    assert sum('COPY staging_songs' in query for query in cur.queries) == 1
@@ -0,0 +1,225 @@
+"""
+THIS MODULE INCLUDES TESTS OF THE PROVISIONING TASK GRAPH AND THE CLUSTER
+LIFECYCLE PATHS OF PROVISIONING.PY AGAINST MOTO IAM, REDSHIFT, EC2 AND S3
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import shutil
+import boto3
+import pytest
+import cluster_planner
+import provisioning
+from aws_functions import Redshift_cluster, Connect_cluster
+from conftest import BUCKET, REGION
+
+@pytest.fixture
+def iam(monkeypatch, request):
+    # The cluster role gets an AWS managed policy attached. Moto only loads
+    # those when asked, which is slow, so only tests using IAM do
+    monkeypatch.setenv('MOTO_IAM_LOAD_MANAGED_POLICIES', 'true')
+    request.getfixturevalue('aws')
+    return boto3.client('iam', region_name=REGION)
+
+@pytest.fixture
+def redshift(aws):
+    return boto3.client('redshift', region_name=REGION)
+
+@pytest.fixture
+def cluster_config(db_config, monkeypatch):
+    for name, value in {'cluster_identifier': 'sparkify-test'
+                        ,'cluster_type': 'single-node'
+                        ,'node_type': 'dc2.large'
+                        ,'n_nodes': '1'
+                        ,'lifecycle_mode': 'create'
+                        ,'teardown_mode': 'delete'}.items():
+        monkeypatch.setitem(db_config, name, value)
+    return db_config
+
+@pytest.fixture
+def ec2(aws):
+    return boto3.resource('ec2', region_name=REGION)
+
+@pytest.fixture
+def provision_config(cluster_config, s3, tmp_path, monkeypatch):
+    """ Sources in the test bucket, cluster sizing on, and a copy of dwh.cfg
+    for create_role() to write the role ARN to """
+    for key in ['log_data/2018-11-01-events.json', 'log_json_path.json', 'song_data/A/TRA.json']:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'{}')
+    for name, value in {'s3_log_metadata': f"s3://{BUCKET}/log_json_path.json"
+                        ,'size_cluster': True
+                        ,'benchmark_path': ''
+                        ,'load_mode': 'full'
+                        ,'target_runtime': 1800
+                        ,'planner_node_types': 'dc2.large'}.items():
+        monkeypatch.setitem(cluster_config, name, value)
+    (tmp_path / 'config').mkdir()
+    shutil.copy('config/dwh.cfg', tmp_path / 'config' / 'dwh.cfg')
+    monkeypatch.chdir(tmp_path)
+    return cluster_config
+
+def _record_steps(monkeypatch):
+    """ Wraps the steps of provision() so the order they ran in, and the
+    security group open_port was given, are recorded """
+    steps = []
+
+    def wrap(owner, name, step):
+        original = getattr(owner, name)
+        def run(*args, **kwargs):
+            steps.append((step, args))
+            return original(*args, **kwargs)
+        monkeypatch.setattr(owner, name, run)
+
+    wrap(provisioning, 'create_role', 'iam_role')
+    wrap(cluster_planner, 'size_cluster', 'size_cluster')
+    wrap(provisioning, 'start_cluster', 'start_cluster')
+    wrap(provisioning, 'wait_for_cluster', 'wait_cluster')
+    wrap(Connect_cluster, 'attach_security_group', 'open_port')
+    return steps
+
+def _order(steps):
+    return {step: i for i, (step, _) in enumerate(steps)}
+
+def _status(redshift, db_config):
+    cluster_props = Redshift_cluster.describe_cluster(redshift, db_config['cluster_identifier'])
+    return None if cluster_props is None else cluster_props['ClusterStatus'].lower()
+
+def test_create_then_reuse(redshift, cluster_config):
+    provisioning.start_cluster(redshift, cluster_config)
+    cluster_props = provisioning.wait_for_cluster(redshift, cluster_config['cluster_identifier'], sleep=lambda s: None)
+    assert cluster_props['NodeType'] == 'dc2.large'
+    # A second run reuses the cluster instead of creating one
+    provisioning.start_cluster(redshift, cluster_config)
+    assert len(redshift.describe_clusters()['Clusters']) == 1
+
+def test_attach_and_resume_need_a_cluster(redshift, cluster_config, monkeypatch):
+    for mode in ['attach', 'resume']:
+        monkeypatch.setitem(cluster_config, 'lifecycle_mode', mode)
+        with pytest.raises(ValueError):
+            provisioning.start_cluster(redshift, cluster_config)
+    assert _status(redshift, cluster_config) is None
+
+def test_pause_then_resume(redshift, cluster_config, monkeypatch):
+    provisioning.start_cluster(redshift, cluster_config)
+    monkeypatch.setitem(cluster_config, 'teardown_mode', 'pause')
+    provisioning.teardown(cluster_config, None, redshift)
+    assert _status(redshift, cluster_config) == 'paused'
+    monkeypatch.setitem(cluster_config, 'lifecycle_mode', 'attach')
+    with pytest.raises(ValueError):
+        provisioning.start_cluster(redshift, cluster_config)
+    monkeypatch.setitem(cluster_config, 'lifecycle_mode', 'resume')
+    provisioning.start_cluster(redshift, cluster_config)
+    assert _status(redshift, cluster_config) == 'available'
+
+def test_snapshot_then_restore(iam, redshift, cluster_config, tmp_path, monkeypatch):
+    config_path = tmp_path / 'dwh.cfg'
+    shutil.copy('config/dwh.cfg', config_path)
+    provisioning.create_role(iam, cluster_config, str(config_path))
+    assert cluster_config['iam_role_arn'] in config_path.read_text()
+    provisioning.start_cluster(redshift, cluster_config)
+
+    monkeypatch.setitem(cluster_config, 'teardown_mode', 'snapshot')
+    provisioning.teardown(cluster_config, iam, redshift)
+    assert _status(redshift, cluster_config) is None
+    assert iam.list_roles()['Roles'] == []
+    snapshot_identifier = Redshift_cluster.latest_snapshot(redshift, cluster_config['cluster_identifier'])
+    assert snapshot_identifier.startswith('sparkify-test-final-')
+
+    monkeypatch.setitem(cluster_config, 'lifecycle_mode', 'restore')
+    provisioning.start_cluster(redshift, cluster_config)
+    assert _status(redshift, cluster_config) == 'available'
+
+def test_restore_without_snapshot_creates(redshift, cluster_config, monkeypatch):
+    assert Redshift_cluster.latest_snapshot(redshift, cluster_config['cluster_identifier']) is None
+    monkeypatch.setitem(cluster_config, 'lifecycle_mode', 'restore')
+    provisioning.start_cluster(redshift, cluster_config)
+    assert _status(redshift, cluster_config) == 'available'
+
+def test_provision_runs_steps_in_order(iam, redshift, ec2, s3, provision_config, monkeypatch):
+    steps = _record_steps(monkeypatch)
+    cluster_props = provisioning.provision(provision_config, iam, redshift, ec2, s3, sleep=lambda s: None)
+    order = _order(steps)
+    assert order['iam_role'] < order['start_cluster']
+    assert order['size_cluster'] < order['start_cluster']
+    assert order['start_cluster'] < order['wait_cluster'] < order['open_port']
+    assert provision_config['db_host'] == cluster_props['Endpoint']['Address']
+    assert provision_config['db_iam_role_arn'] == provision_config['iam_role_arn']
+    assert cluster_props['NodeType'] == 'dc2.large'
+
+def test_provision_fails_on_missing_sources_before_starting_the_cluster(iam, redshift, ec2, s3
+                                                                        ,provision_config, monkeypatch):
+    s3.delete_object(Bucket=BUCKET, Key='song_data/A/TRA.json')
+    steps = _record_steps(monkeypatch)
+    with pytest.raises(ValueError, match='song_data'):
+        provisioning.provision(provision_config, iam, redshift, ec2, s3, sleep=lambda s: None)
+    # size_cluster waits for the sources, and start_cluster for size_cluster
+    assert 'size_cluster' not in _order(steps)
+    assert 'start_cluster' not in _order(steps)
+    assert _status(redshift, provision_config) is None
+
+@pytest.mark.parametrize('other_vpc', [False, True])
+def test_provision_reuses_security_group_of_the_cluster_vpc(iam, redshift, ec2, s3, provision_config
+                                                            ,monkeypatch, other_vpc):
+    default_vpc = list(ec2.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]))[0]
+    vpc_id = ec2.create_vpc(CidrBlock='10.1.0.0/16').id if other_vpc else default_vpc.id
+    wait_for_cluster = provisioning.wait_for_cluster
+    monkeypatch.setattr(provisioning, 'wait_for_cluster'
+                        ,lambda *args, **kwargs: {**wait_for_cluster(*args, **kwargs), 'VpcId': vpc_id})
+    steps = _record_steps(monkeypatch)
+    provisioning.provision(provision_config, iam, redshift, ec2, s3, sleep=lambda s: None)
+    security_group = dict(steps)['open_port'][3]
+    # The group looked up while the cluster booted is only used in the default VPC
+    if other_vpc:
+        assert security_group is None
+    else:
+        assert security_group.vpc_id == default_vpc.id
+
+class _Polled_redshift:
+    """ Redshift client stub returning the given statuses, one per poll """
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    def describe_clusters(self, ClusterIdentifier):
+        cluster_props = {'ClusterStatus': self.statuses.pop(0)}
+        if not self.statuses:
+            cluster_props['Endpoint'] = {'Address': 'localhost'}
+        return {'Clusters': [cluster_props]}
+
+def test_wait_for_cluster_resets_backoff_when_status_changes(monkeypatch):
+    # Waits the upper bound of the jitter, so delays are exact
+    monkeypatch.setattr(provisioning.random, 'uniform', lambda low, high: high)
+    delays = []
+    redshift = _Polled_redshift(['creating'] * 3 + ['modifying'] * 2 + ['available'])
+    cluster_props = provisioning.wait_for_cluster(redshift, 'sparkify-test', initial_delay=5, max_delay=20
+                                                  ,sleep=delays.append)
+    assert cluster_props['ClusterStatus'] == 'available'
+    assert delays == [5, 10, 20, 5, 10]
+
+@pytest.mark.parametrize('lifecycle_mode', ['attach', 'resume'])
+def test_warm_cluster_is_never_deleted(cluster_config, monkeypatch, lifecycle_mode):
+    monkeypatch.setitem(cluster_config, 'lifecycle_mode', lifecycle_mode)
+    for mode in ['delete', 'snapshot']:
+        monkeypatch.setitem(cluster_config, 'teardown_mode', mode)
+        with pytest.raises(ValueError):
+            provisioning.check_lifecycle(cluster_config)
+    for mode in ['pause', 'keep']:
+        monkeypatch.setitem(cluster_config, 'teardown_mode', mode)
+        provisioning.check_lifecycle(cluster_config)
+
+@pytest.mark.parametrize('failure', ['config', 'lifecycle'])
+def test_main_tears_nothing_down_when_it_fails_early(cluster_config, tmp_path, monkeypatch, failure):
+    import sparkify_redshift_db
+
+    def get_config():
+        if failure == 'config':
+            raise FileNotFoundError('dwh.cfg')
+        return cluster_config
+
+    torn_down = []
+    monkeypatch.setitem(cluster_config, 'lifecycle_mode', 'attach')
+    monkeypatch.setitem(cluster_config, 'metrics_dir', str(tmp_path / 'metrics'))
+    monkeypatch.setattr(sparkify_redshift_db, 'get_config', get_config)
+    monkeypatch.setattr(provisioning, 'teardown', lambda *args: torn_down.append(args))
+    # The error is logged, not hidden by the cleanup
+    sparkify_redshift_db.main()
+    assert torn_down == []
@@ -0,0 +1,110 @@
+"""
+THIS MODULE INCLUDES TESTS OF TOLERANT COPYS, AGAINST A MOTO S3 BUCKET AND A
+CURSOR STUB STANDING IN FOR REDSHIFT'S COPY AND STL_LOAD_ERRORS
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import re
+import json
+import psycopg2
+import pytest
+import ledger
+import quarantine
+from conftest import BUCKET
+
+class _Copy_cursor:
+    """ Runs manifest COPYs the way Redshift does: each bad record is logged
+    to STL_LOAD_ERRORS, and the COPY fails when there are more than MAXERROR.
+    Loaded records are kept apart by transaction, so a rollback drops them """
+    def __init__(self, s3, bad_records):
+        self.s3 = s3
+        self.bad_records = bad_records
+        self.load_errors = []
+        self.loaded, self.uncommitted = [], []
+        self.copies = []
+        self.rowcount = 0
+        self.result = []
+
+    def execute(self, query, params=None):
+        if 'stl_load_errors' in query and 'MAX(query)' in query:
+            self.result = [(max([error[0] for error in self.load_errors], default=0),)]
+        elif 'stl_load_errors' in query:
+            self.result = [error for error in self.load_errors if error[0] > params['after']]
+        elif query.strip().startswith('COPY'):
+            self._copy(query)
+
+    def _copy(self, query):
+        manifest_url = re.search(r"FROM\s+'([^']+)'", query).group(1)
+        bucket, key = ledger.parse_s3_url(manifest_url)
+        urls = [entry['url'] for entry in json.loads(self.s3.get_object(Bucket=bucket, Key=key)['Body'].read())['entries']]
+        max_errors = int(re.search(r'MAXERROR (\d+)', query).group(1))
+        self.copies.append(urls)
+        query_id = len(self.copies)
+        errors = [(query_id, url, line, 'ts', 1206, 'Invalid timestamp', 'x', 'x')
+                  for url in urls for line in self.bad_records.get(url, [])]
+        self.load_errors += errors
+        if len(errors) > max_errors:
+            raise psycopg2.Error('Load into table failed. Check stl_load_errors')
+        self.uncommitted += [(url, line) for url in urls for line in range(1, 11)
+                             if line not in self.bad_records.get(url, [])]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+class _Copy_connection:
+    def __init__(self, cur):
+        self.cur = cur
+
+    def rollback(self):
+        self.cur.uncommitted = []
+
+    def commit(self):
+        self.cur.loaded += self.cur.uncommitted
+        self.cur.uncommitted = []
+
+@pytest.fixture
+def files(s3):
+    urls = [f"s3://{BUCKET}/log_data/{name}.json" for name in ['a', 'b', 'c']]
+    for url in urls:
+        s3.put_object(Bucket=BUCKET, Key=ledger.parse_s3_url(url)[1], Body=b'{}\n' * 10)
+    return ledger.list_objects(s3, f"s3://{BUCKET}/log_data/")
+
+def _copy(s3, cur, files, max_errors):
+    return quarantine.copy_with_quarantine(cur, _Copy_connection(cur), s3, 'staging_events', files
+                                           ,f"s3://{BUCKET}/manifests/staging_events.manifest"
+                                           ,'staging_events_manifest_copy'
+                                           ,{'iam_role_arn': 'arn', 'region': 'us-west-2', 'jsonpaths': 'auto'
+                                             ,'compression': '', 'maxerror': f" MAXERROR {max_errors}"}
+                                           ,f"s3://{BUCKET}/quarantine")
+
+def _quarantined_errors(s3):
+    keys = [key for key in ledger.list_objects(s3, f"s3://{BUCKET}/quarantine/") if key.endswith('errors.json')]
+    return [json.loads(line) for key in keys
+            for line in s3.get_object(Bucket=BUCKET, Key=ledger.parse_s3_url(key)[1])['Body'].read().splitlines()]
+
+def test_files_failing_the_copy_are_retried_on_their_own(s3, db_config, files):
+    bad_url = f"s3://{BUCKET}/log_data/b.json"
+    cur = _Copy_cursor(s3, {bad_url: [2, 3, 5]})
+    quarantined = _copy(s3, cur, files, max_errors=2)
+    # Failed with every file, then the good files, then the bad file alone
+    assert cur.copies == [sorted(files), sorted(set(files) - {bad_url}), [bad_url]]
+    assert list(quarantined) == [bad_url]
+    _Copy_connection(cur).commit()
+    # Every good record is loaded, from the bad file too, and only its bad records are quarantined
+    assert len(cur.loaded) == 27
+    assert sorted(error['line_number'] for error in _quarantined_errors(s3)) == [2, 3, 5]
+    copies = [url for url in ledger.list_objects(s3, f"s3://{BUCKET}/quarantine/") if url.endswith('.json')]
+    assert [url for url in copies if not url.endswith('errors.json')][0].endswith('/log_data/b.json')
+
+def test_records_skipped_under_maxerror_are_quarantined(s3, db_config, files):
+    bad_url = f"s3://{BUCKET}/log_data/c.json"
+    cur = _Copy_cursor(s3, {bad_url: [7]})
+    quarantined = _copy(s3, cur, files, max_errors=2)
+    assert cur.copies == [sorted(files)]
+    assert list(quarantined) == [bad_url]
+    assert len(cur.uncommitted) == 29
+    assert [error['line_number'] for error in _quarantined_errors(s3)] == [7]
@@ -0,0 +1,73 @@
+"""
+THIS MODULE INCLUDES TESTS OF THE TIME BUDGET OF THE POOLED DATA VALIDATION
+CHECKS, AGAINST A STUB CONNECTION POOL
+
+Author: Lucas Aledi
+Date: December 2022
+"""
+import threading
+from time import monotonic
+from aws_functions import Data_validation
+
+class _Stub_cursor:
+    """ Cursor whose statements block until their connection is cancelled """
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        if self.conn.cancelled.wait(timeout=5):
+            raise Exception('canceling statement due to user request')
+
+    def fetchall(self):
+        return []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+class _Counts_cursor(_Stub_cursor):
+    """ Cursor of the caller, on which the row counts return no tables """
+    def execute(self, query, params=None):
+        pass
+
+class _Stub_connection:
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cursor(self):
+        return _Stub_cursor(self)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class _Stub_pool:
+    """ Pool of maxconn connections, blocking getconn() while all are out """
+    def __init__(self, maxconn):
+        self.maxconn = maxconn
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self.slots.acquire()
+        return _Stub_connection()
+
+    def putconn(self, conn):
+        self.slots.release()
+
+def test_checks_stop_at_the_time_budget(db_config):
+    pool = _Stub_pool(2)
+    # The caller's own connection is one of the pool's
+    conn = pool.getconn()
+    start = monotonic()
+    report = Data_validation.testing_queries(_Counts_cursor(conn), conn, pool, time_budget=0.2)
+    assert monotonic() - start < 2
+    assert not report['passed']
+    assert {result['status'] for result in report['checks'][1:]} == {'timeout'}